@@ -0,0 +1,183 @@
+'''PyNMR, J.Maxwell 2020
+'''
+import threading
+import numpy as np
+from scipy import optimize
+
+from app.deuteron_fits import DFits, DTable, DFitPool, fit_dict
+
+POLY_GUESS = {          # initial coefficients for each polynomial order
+    2 : [0.01, 0.8, 0.01],
+    3 : [0.01, 0.8, 0.01, 0.001],
+    4 : [0.01, 0.8, 0.01, 0.001, 0.00001],
+    6 : [0.01, 0.8, 0.01, 0.001, 0.00001, 0.00001, 0.00001],
+    8 : [0.01, 0.8, 0.01, 0.001, 0.00001, 0.00001, 0.00001, 0.00001, 0.00001],
+}
+
+
+def range_mask(n, wings):
+    '''Boolean mask of points inside bounds for a sweep of n points
+
+    Arguments:
+        n: Number of points in sweep
+        wings: Start and stop of range as fractions of sweep, 0 to 1
+    '''
+    x = np.arange(n)
+    bounds = [w*n for w in wings]
+    return (bounds[0]<x) & (x<bounds[1])
+
+
+def wings_mask(n, wings):
+    '''Boolean mask of points inside either wing for a sweep of n points
+
+    Arguments:
+        n: Number of points in sweep
+        wings: Start and stop of lower then upper wing as fractions of sweep, 0 to 1
+    '''
+    return range_mask(n, wings[:2]) | range_mask(n, wings[2:])
+
+
+def poly(x, *p):
+    '''Polynomial with coefficients p, lowest order first'''
+    return sum(c*np.power(x, i) for i, c in enumerate(p))
+
+
+def polyfit_wings(freqs, sweep, wings, order):
+    '''Polynomial fit to the wings of a sweep
+
+    Arguments:
+        freqs: Frequency points
+        sweep: Signal points
+        wings: Start and stop of lower then upper wing as fractions of sweep, 0 to 1
+        order: Polynomial order, a key of POLY_GUESS
+
+    Returns:
+        fit over whole sweep, coefficients, their standard deviations, and r-squared of fit in wings
+    '''
+    mask = wings_mask(len(sweep), wings)
+    X, Y = freqs[mask], sweep[mask]
+    pf, pcov = optimize.curve_fit(poly, X, Y, p0 = POLY_GUESS[order])
+    pstd = np.sqrt(np.diag(pcov))
+    ss_res = np.sum((Y - poly(X, *pf))**2)
+    ss_tot = np.sum((Y - np.mean(Y))**2)
+    return poly(freqs, *pf), pf, pstd, 1 - (ss_res / ss_tot)
+
+
+def sum_all(event):
+    '''Sum of all fit subtracted points, returning empty curve and area'''
+    return np.zeros(len(event.fitsub)), event.window_sums(-1, 2)    # window wider than sweep covers every point
+
+
+def sum_range(event, wings, mask=None):
+    '''Sum of fit subtracted points within range, returning signal within range and area
+
+    Arguments:
+        event: Event with fit subtracted sweep
+        wings: Start and stop of range as fractions of sweep, 0 to 1
+        mask: range_mask for these wings if already made
+    '''
+    if mask is None or len(mask) != len(event.fitsub):
+        mask = range_mask(len(event.fitsub), wings)
+    return np.where(mask, event.fitsub, 0), event.window_sums(*wings)
+
+
+def peak_height(sweep):
+    '''Largest magnitude point of sweep, with sign'''
+    max, min = np.max(sweep), np.min(sweep)
+    return max if abs(max)>abs(min) else min
+
+
+def deuteron_pol(r):
+    '''Polarization from deuteron peak asymmetry r'''
+    return (r*r-1)/(r*r + r +1)
+
+
+class DeuteronFitter():
+    '''Deuteron lineshape fits as set in the analysis settings. If enabled, the lineshape table is loaded or built in
+    the background, fits using the exact lineshape until it is ready, and the multi-start pool is started once it is.
+
+    Arguments:
+        settings: Dict of analysis settings from config file, using d_fit_params, d_fit_table and d_fit_pool
+    '''
+    def __init__(self, settings):
+        self.default = settings['d_fit_params']
+        self.table_settings = settings['d_fit_table']
+        self.pool_settings = settings['d_fit_pool']
+        self.table = None
+        self.pool = None
+        self.closed = False
+        if self.table_settings['enable']:       # table can take a minute to build
+            threading.Thread(target=self.load_table, name='DTableLoad', daemon=True).start()
+        else:
+            self.start_pool()
+
+    def load_table(self):
+        '''Load or build lineshape table, then start pool so its workers load the finished table'''
+        try:
+            self.table = DTable(self.table_settings)
+        except Exception as e:
+            print('Exception loading deuteron fit table, using exact lineshape: '+str(e))
+        self.start_pool()
+
+    def start_pool(self):
+        '''Start multi-start fit pool if enabled, unless closed while the table loaded'''
+        if self.pool_settings['enable'] and not self.closed:
+            self.pool = DFitPool(self.pool_settings, self.default, self.table_settings if self.table else None)
+
+    def fit(self, freqs, sweep, p):
+        '''Fit sweep, with the pool if running
+
+        Arguments:
+            freqs: Frequency points
+            sweep: Signal points
+            p: Dict of initial parameters
+
+        Returns:
+            Dict from fit_dict, or None if the pool timed out
+        '''
+        if self.pool:       # multi-start fits in parallel, best reduced chi-square returned
+            return self.pool.fit(freqs, sweep, p)
+        return fit_dict(DFits(freqs, sweep, p, self.table).result)
+
+    def close(self):
+        '''Shut down pool'''
+        self.closed = True
+        if self.pool:
+            self.pool.close()
+
+
+def estimate(X, Y, cent_freq, mod_freq):
+    '''Initial amplitude, centroid and width from the moments of the peak, which may be either sign. Falls back to
+    channel center and a tenth of the modulation if there is no peak to take moments of.
+
+    Arguments:
+        X: Frequency points
+        Y: Signal points
+        cent_freq: Channel center frequency in MHz
+        mod_freq: Channel modulation in kHz
+    '''
+    amp = Y[np.argmax(np.abs(Y))] if len(Y) else 0
+    w = np.clip(Y*np.sign(amp), 0, None)
+    if w.sum() > 0:
+        cent = np.sum(w*X)/w.sum()
+        width = np.sqrt(np.sum(w*np.power(X-cent, 2))/w.sum())
+        if width > 0:
+            return [amp, cent, width]
+    return [-0.1, cent_freq, mod_freq*1E-3/10]
+
+
+def gaussian(x, *p): return p[0]*np.exp(-np.power((x-p[1]),2)/(2*np.power(p[2],2)))
+
+
+def gaussian_jac(x, *p):
+    '''Jacobian of gaussian with respect to amplitude, centroid and width'''
+    e = np.exp(-np.power((x-p[1]),2)/(2*np.power(p[2],2)))
+    return np.column_stack((e, p[0]*e*(x-p[1])/np.power(p[2],2), p[0]*e*np.power(x-p[1],2)/np.power(p[2],3)))
+
+
+def sum_gaussians(x, *p): return gaussian(x, *p[:3]) + gaussian(x, *p[3:])
+
+
+def sum_gaussians_jac(x, *p):
+    '''Jacobian of sum_gaussians, the columns of gaussian_jac for each peak side by side'''
+    return np.hstack((gaussian_jac(x, *p[:3]), gaussian_jac(x, *p[3:])))
@@ -5,14 +5,19 @@ from PyQt5.QtCore import QThread, pyqtSignal, Qt
 import random
 import os.path
 import datetime
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
 from dateutil.parser import parse
 import json
 import pytz
-from scipy import optimize
 import numpy as np
 import yaml
 from bitstring import Bits
 
+from app.trace import tracer
+
 class ConfigItem():
     '''Single configurable item with validator
             
@@ -132,45 +137,122 @@ class Scan():
       
         
 class RunningScan():
-    '''Data object for averaged set of sweeps, with method to perform running average.
+    '''Data object for running average of the most recent sweeps, for tuning. Chunks are kept in a ring buffer of
+    preallocated arrays, with sums over the window updated as each chunk comes in and the oldest drops out, so the
+    average is exactly that of the chunks in the window. Sums are recomputed from the buffer each time it wraps, so
+    rounding errors don't build up.
     
     Args:
         config: Config object for scan
-        to_avg: Number of sweeps to keep in running average
+        to_avg: Number of sweeps to keep in running average, rounded down to whole tune chunks, at least one chunk
+        stats: Also keep standard deviation of chunks in the window at each frequency point
         
     Attributes:
         freq_list: Frequency points of sweep in MHz, from config
         phase: List of measurements at each frequency points for the phase
         diode: List of measurements at each frequency points for the diode
+        phase_std: Standard deviation of chunks in window at each point for the phase, zeros unless stats
+        diode_std: Standard deviation of chunks in window at each point for the diode, zeros unless stats
         points_in: Number of sweeps currently in the average
+        capacity: Number of chunks in the window
     '''
-    def __init__(self, config, to_avg):
+    def __init__(self, config, to_avg, stats=False):
 
         self.freq_list = config.freq_list
-        self.phase = np.zeros(len(self.freq_list))       # list of phase curve points
-        self.diode = np.zeros(len(self.freq_list))       # list of diode curve points
-        self.points_in = 0              # sweeps currently in average
+        self.per_chunk = config.settings['tune_per_chunk']
+        self.stats = stats
+        steps = len(self.freq_list)
+        self.means = np.zeros((2, steps))       # phase and diode curve points
+        self.spread = np.zeros((2, steps))      # phase and diode standard deviations
+        self.phase, self.diode = self.means
+        self.phase_std, self.diode_std = self.spread
+        self.sums = np.zeros((2, steps))        # sweep weighted sums of chunks in window
+        self.sq_sums = np.zeros((2, steps))     # sweep weighted sums of squares of chunks in window
+        self.scratch = np.zeros((2, steps))
+        self.capacity = 0
+        self.resize(to_avg)
+
+    def resize(self, to_avg):
+        '''Change number of sweeps in running average, keeping the most recent chunks that fit. Only reallocates
+        the buffer if the number of chunks changes.
+
+        Args:
+            to_avg: Number of sweeps to keep in running average
+        '''
         self.to_avg = to_avg
+        capacity = max(1, to_avg//self.per_chunk)
+        if capacity == self.capacity:
+            return
+        steps = len(self.freq_list)
+        data = np.zeros((capacity, 2, steps))               # sweep weighted chunks, phase and diode
+        squares = np.zeros((capacity, 2, steps)) if self.stats else None
+        weights = np.zeros(capacity, dtype=int)              # sweeps in each chunk
+        keep = min(self.count, capacity) if self.capacity else 0
+        if keep:
+            order = [(self.head - keep + k) % self.capacity for k in range(keep)]     # oldest first
+            data[:keep] = self.data[order]
+            weights[:keep] = self.weights[order]
+            if self.stats:
+                squares[:keep] = self.squares[order]
+        self.data, self.squares, self.weights = data, squares, weights
+        self.capacity = capacity
+        self.count = keep                   # chunks in buffer
+        self.head = keep % capacity         # next slot to fill
+        self.resum()
+
+    def resum(self):
+        '''Recompute sums from chunks in buffer and update averages'''
+        np.sum(self.data[:self.count], axis=0, out=self.sums)
+        if self.stats:
+            np.sum(self.squares[:self.count], axis=0, out=self.sq_sums)
+        self.points_in = int(self.weights[:self.count].sum())
+        self.update()
+
+    def update(self):
+        '''Averages and standard deviations from sums'''
+        if not self.points_in:
+            self.means.fill(0)
+            self.spread.fill(0)
+            return
+        np.divide(self.sums, self.points_in, out=self.means)
+        if self.stats:
+            np.divide(self.sq_sums, self.points_in, out=self.spread)
+            np.multiply(self.means, self.means, out=self.scratch)
+            self.spread -= self.scratch
+            np.maximum(self.spread, 0, out=self.spread)
+            np.sqrt(self.spread, out=self.spread)
 
     def running_avg(self, new_sigs):
-        '''Performs running average for tuning
+        '''Adds chunk to running average, in place of the oldest chunk once the window is full
         
         Args:
-            new_sigs: tuple of number of sweeps in the chunk, new phase data list and new diode data list
+            new_sigs: tuple of chunk number, number of sweeps in the chunk, new phase data list and new diode data list
         '''
         chunk_num, num_in_chunk, new_phase, new_diode = new_sigs
-        if self.points_in < self.to_avg:
-            self.points_in += num_in_chunk
+        i = self.head
+        if self.count == self.capacity:                 # drop oldest
+            self.sums -= self.data[i]
+            if self.stats:
+                self.sq_sums -= self.squares[i]
+            self.points_in -= int(self.weights[i])
         else:
-            self.points_in = self.to_avg
-            
-        self.phase = (new_phase*num_in_chunk + self.phase*(self.points_in - num_in_chunk))/self.points_in 
-        self.diode = (new_diode*num_in_chunk + self.diode*(self.points_in - num_in_chunk))/self.points_in 
-        
-        
-        # self.phase = [(i*num_in_chunk + j*(self.points_in - num_in_chunk))/self.points_in for i, j in zip(new_phase, self.phase)]
-        # self.diode = [(i*num_in_chunk + j*(self.points_in - num_in_chunk))/self.points_in for i, j in zip(new_diode, self.diode)]
-            
+            self.count += 1
+        np.multiply(new_phase, num_in_chunk, out=self.data[i, 0])
+        np.multiply(new_diode, num_in_chunk, out=self.data[i, 1])
+        self.weights[i] = num_in_chunk
+        if self.stats:
+            np.multiply(self.data[i, 0], new_phase, out=self.squares[i, 0])
+            np.multiply(self.data[i, 1], new_diode, out=self.squares[i, 1])
+        self.head = (i + 1) % self.capacity
+        if self.head == 0:                              # wrapped, start sums afresh
+            self.resum()
+            return
+        self.sums += self.data[i]
+        if self.stats:
+            self.sq_sums += self.squares[i]
+        self.points_in += num_in_chunk
+        self.update()
+
 
 class Event():
     '''Data and method object for single event point. Takes config instance on init.
@@ -193,11 +275,17 @@ class Event():
         cc: Calibration constant float
         area: Area under polyfit curve float
         pol: Measured polarization for event, CC*Area, float
+        results: Dict of area and pol from each results method run, keyed on method name
+        res_curves: Dict of result curves from each results method run, keyed on method name
+        timings: Dict of seconds taken by each stage of closing the event, keyed on stage name
         base_time: Datetime object for stop of baseline event
         base_stamp: Timestamp int of baseline event
         base_file: Filename string where baseline event can be found
-        uwave_freq: Microwave frequency (GHz) as read from GPIB
-        uwave_power: Microwave power (W) as read from serial
+        uwave_freq: Microwave frequency (GHz) as read from GPIB, averaged over event once closed
+        uwave_power: Microwave power (W) as read from serial, averaged over event once closed
+        uwave_series: Dict of lists of (timestamp, value) microwave readings during event, keyed on 'freq' and 'power'
+        uwave_freq_min, uwave_freq_max, uwave_freq_samples: Range and number of good frequency readings over event
+        uwave_power_min, uwave_power_max, uwave_power_samples: Range and number of good power readings over event
         elapsed: Number of seconds taken to finish sweeps
         label: type of event from combobox
     '''
@@ -216,12 +304,16 @@ class Event():
         self.basesweep = np.zeros(len(self.scan.phase))
         self.basesub = []
         self.fitsub = []
+        self.fitsub_cumsum = (None, None)     # fitsub array and its prefix sums with leading zero, for window_sums
         self.wings = [0.01,0.25,.75,0.99]  # portion of sweep to use for fit
         
 
         self.cc = self.config.controls['cc'].value
         self.area = 0.
         self.pol = 0.
+        self.results = {}
+        self.res_curves = {}
+        self.timings = {}
         self.stop_time = datetime.datetime(2000,1,1)
         self.stop_stamp = datetime.datetime(2000,1,1).timestamp()
         
@@ -233,6 +325,7 @@ class Event():
         
         self.uwave_freq = 0
         self.uwave_power = 0
+        self.uwave_series = {'freq':[], 'power':[]}
         
         self.chassis_temp = self.parent.chassis_temp
         self.shimA = self.parent.shimA
@@ -262,7 +355,7 @@ class Event():
             eventfile: File object to write event to
         '''
         
-        exclude_list = [ 'freq_bytes', 'parent', 'anal_thread' ]
+        exclude_list = [ 'freq_bytes', 'parent', 'anal_thread', 'fitsub_cumsum', 'res_curves' ]
         json_dict = {}        
         json_dict.update(self.scan.__dict__)
         for key, entry in self.__dict__.items():               # filter event attributes for json dict
@@ -308,6 +401,7 @@ class Event():
         self.stop_time =  datetime.datetime.now(tz=datetime.timezone.utc)
         self.stop_stamp = self.stop_time.timestamp()
         self.elapsed = (self.stop_time - self.start_time).seconds
+        self.uwave_stats()
         #print(self.stop_time, self.stop_stamp, self.elapsed)
              
         self.signal_analysis(base_method, sub_method, res_method)       
@@ -333,7 +427,31 @@ class Event():
             self.fitsub = np.zeros(len(self.basesweep))
             self.rescurve = np.zeros(len(self.basesweep))
             self.pol, self.area = 0, 0
+            self.results, self.res_curves = {}, {}
             
+    def window_sums(self, start, stop):
+        '''Sum fitsub over windows from prefix sums, each window in constant time. Points x with
+        start*N < x < stop*N are included, matching the range convention of the result methods. Prefix sums are
+        kept with the fitsub array they came from and redone whenever fitsub is assigned a different array, so
+        fitsub should be replaced rather than changed in place.
+        
+        Args:
+            start: Window start as portion of sweep from 0 to 1, float or Numpy array
+            stop: Window stop as portion of sweep from 0 to 1, float or Numpy array
+            
+        Returns:
+            Sum in each window, float or Numpy array
+        '''
+        n = len(self.fitsub)
+        summed, cumsum = self.fitsub_cumsum
+        if summed is not self.fitsub:       # fitsub assigned since last sums, kept with them so it can't be another array at same id
+            cumsum = np.concatenate(([0], np.cumsum(self.fitsub)))
+            self.fitsub_cumsum = (self.fitsub, cumsum)
+        first = np.clip(np.floor(np.multiply(start, n)).astype(int) + 1, 0, n)
+        last = np.clip(np.ceil(np.multiply(stop, n)).astype(int), 0, n)     # one past last point in window
+        sums = np.where(last > first, cumsum[last] - cumsum[np.minimum(first, last)], 0)
+        return sums if sums.ndim else float(sums)
+        
     def poly(self,p,x):
         '''Third order polynomial for fitting
         
@@ -359,23 +477,56 @@ class Event():
         X = np.array([x for x,y in data])
         Y = np.array([y for x,y in data])
         
+        from scipy import optimize      # slow import, only needed here
         errfunc = lambda p, x, y: self.poly(p,x) - y
         pi = [0.01, 0.8, 0.01, 0.001, 0.00001]  # initial guess
         pf, success = optimize.leastsq(errfunc, pi[:], args=(X,Y))  # perform fit
         return pf
         
-    def set_uwave(self, freq, power):
-        '''Set microwave power and frequency'''
-        self.uwave_freq = freq
-        self.uwave_power = power
+    def add_uwave(self, kind, value, stamp):
+        '''Add microwave reading to event, unless it was taken before the event started or after it closed
+        
+        Args:
+            kind: 'freq' or 'power'
+            value: Reading, NaN if it failed
+            stamp: Timestamp of reading
+        '''
+        if stamp < self.start_stamp or self.stop_stamp > self.start_stamp:
+            return
+        self.uwave_series[kind].append((stamp, value))
+        setattr(self, f'uwave_{kind}', value)
+        
+    def uwave_stats(self):
+        '''Set average, min, max and number of good microwave readings over event'''
+        for kind, series in self.uwave_series.items():
+            values = np.array([v for s, v in series], dtype=float)
+            values = values[np.isfinite(values)]
+            setattr(self, f'uwave_{kind}_samples', len(values))
+            if len(values):
+                setattr(self, f'uwave_{kind}', values.mean())
+                setattr(self, f'uwave_{kind}_min', values.min())
+                setattr(self, f'uwave_{kind}_max', values.max())
+            else:
+                setattr(self, f'uwave_{kind}', 0)
+                setattr(self, f'uwave_{kind}_min', 0)
+                setattr(self, f'uwave_{kind}_max', 0)
         
-    def sum_beam_current(self, current):
-        '''Sum in time-weighted beam current to make average over event'''
+    def sum_beam_current(self, current, stamp=None):
+        '''Sum in time-weighted beam current to make average over event. Current is taken over the time since the
+        last update, up to the stop of the event once closed.
         
-        time = (datetime.datetime.now(tz=datetime.timezone.utc) - self.beam_current_update_time).total_seconds()
+        Args:
+            current: Beam current over the time since last update
+            stamp: Timestamp of end of that time, ie from channel access, or now if None
+        '''
+        if stamp is None:
+            stamp = datetime.datetime.now(tz=datetime.timezone.utc).timestamp()
+        if self.stop_stamp > self.start_stamp:      # closed
+            stamp = min(stamp, self.stop_stamp)
+        time = max(stamp - self.beam_current_update_time.timestamp(), 0)
         self.beam_current_sum = self.beam_current_sum + current*time
         self.beam_time_sum = self.beam_time_sum + time
-        self.beam_current_update_time = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.beam_current_update_time = datetime.datetime.fromtimestamp(self.beam_current_update_time.timestamp() + time, tz=datetime.timezone.utc)
         
 class Baseline():
     '''Data object for baseline event.
@@ -425,6 +576,7 @@ class HistPoint():
         uwave_freq: microwave frequency in GHz
         epics_reads: dict of all epics variables read
         average_beam_current: time averaged beam current
+        results: dict of area and pol from each results method run
     '''
     def __init__(self, event):
         if isinstance(event, Event):
@@ -443,6 +595,7 @@ class HistPoint():
         self.uwave_freq = entry['uwave_freq']
         self.epics_reads = entry['epics_reads']
         self.beam_current = entry['beam_current']    
+        self.results = entry.get('results', {})     # not in histories from before multiple results
     
     def new_point(self, event):
         '''Make new point from event'''
@@ -454,6 +607,7 @@ class HistPoint():
         self.label = event.label
         self.uwave_freq = event.uwave_freq
         self.epics_reads = event.epics   
+        self.results = event.results
         try:
             self.beam_current = event.beam_current_sum/event.beam_time_sum
         except ZeroDivisionError:
@@ -488,6 +642,45 @@ class History():
             return hist_data
       
 
+class StageTimings():
+    '''Rolling record of time taken by each stage of closing out events, for diagnostics
+    
+    Arguments:
+        length: Number of recent measurements kept for each stage
+        
+    Attributes:
+        data: Dict of deques of durations in seconds, keyed on stage name
+    '''
+    def __init__(self, length=200):
+        self.length = length
+        self.data = {}
+        self.lock = threading.Lock()
+        
+    @contextmanager
+    def stage(self, name, event=None):
+        '''Time the enclosed block, adding to the rolling record and to the event's timings if given'''
+        start = time.perf_counter()
+        try:
+            with tracer.span(name, 'stage'):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if event is not None:
+                event.timings[name] = elapsed
+            with self.lock:
+                self.data.setdefault(name, deque(maxlen=self.length)).append(elapsed)
+                
+    def stats(self):
+        '''Statistics for each stage
+        
+        Returns:
+            Dict keyed on stage name of dicts with last, p50, p95 and max in seconds, and number of measurements n
+        '''
+        with self.lock:
+            data = {k:np.array(v) for k,v in self.data.items()}
+        return {k:{'last':v[-1], 'p50':np.percentile(v, 50), 'p95':np.percentile(v, 95), 'max':v.max(), 'n':len(v)} for k,v in data.items()}
+      
+
 class AnalThread(QThread):
     '''Thread class for analysis. Calls for epics reads and writes once done.
     Args:
@@ -509,12 +702,17 @@ class AnalThread(QThread):
     def run(self):
         '''Main analysis loop. 
         '''
-        self.parent.basesweep, self.parent.basesub  = self.base_method(self.parent)        
-        self.parent.fitcurve, self.parent.fitsub = self.sub_method(self.parent)
-        self.parent.rescurve, self.parent.area, self.parent.pol = self.res_method(self.parent) 
+        timings = self.parent.parent.timings
+        with timings.stage('baseline', self.parent):
+            self.parent.basesweep, self.parent.basesub  = self.base_method(self.parent)        
+        with timings.stage('subtraction', self.parent):
+            self.parent.fitcurve, self.parent.fitsub = self.sub_method(self.parent)
+        with timings.stage('result', self.parent):
+            self.parent.rescurve, self.parent.area, self.parent.pol = self.res_method(self.parent) 
         #print("Analysis done, waiting on epics.")
         
-        self.parent.parent.epics_update(self.parent)
+        with timings.stage('epics_update', self.parent):
+            self.parent.parent.epics_update(self.parent)
                 
         self.finished.emit()
   
@@ -0,0 +1,294 @@
+'''PyNMR, J.Maxwell 2020
+'''
+import datetime
+import os
+import json
+import yaml
+import logging
+import numpy as np
+from dateutil.parser import parse
+from PyQt5.QtCore import QObject, QCoreApplication, QTimer
+from PyQt5.QtNetwork import QTcpServer, QHostAddress
+from logging.handlers import TimedRotatingFileHandler
+
+from app.classes import Config, Event, Baseline, HistPoint, History, StageTimings
+from app.epics import EPICS
+from app.daq import RS_Connection
+from app.gui_run_tab import RunThread
+from app.recipe import Recipe
+from app.trace import tracer
+from app.publisher import Publisher
+from app import instruments
+
+
+class Daemon(QObject):
+    '''Headless acquisition service. Runs sweeps, analysis by recipe, EPICS writes and file writing as the main
+    window does, but with no widgets. Controlled by text commands over a local TCP socket, one per line, each
+    answered by a JSON line. Subscribed clients, like the GUI daemon tab, also get a JSON line for each event.
+
+    Commands:
+        status: running state, sweeps in current event and last event summary
+        start: run events continuously
+        stop: stop after the current event
+        abort: abort current event now
+        label <text>: label for following events
+        sweeps <n>: sweeps per event
+        cc <value>: calibration constant
+        baseline: use last event as baseline
+        subscribe: send event summaries to this connection
+        quit: stop and exit
+
+    Arguments:
+        config_file: YAML config filename
+    '''
+    def __init__(self, config_file):
+        super().__init__()
+        self.config_filename = config_file
+        with open(self.config_filename) as f:
+            self.config_dict = yaml.load(f, Loader=yaml.FullLoader)
+        self.channels = list(self.config_dict['channels'].keys())
+        self.settings = self.config_dict['settings']
+        self.epics_reads = self.config_dict['epics_reads']
+        self.epics_writes = self.config_dict['epics_writes']
+        self.start_logger()
+
+        self.chassis_temp = 0
+        self.shimA, self.shimB, self.shimC, self.shimD = 0, 0, 0, 0
+        self.label = 'None'
+        self.abort_now = False      # checked by run thread
+        self.running = False        # run events continuously
+        self.last = {}              # summary of last event
+        self.clients = []           # connections from clients
+        self.subscribers = []       # connections to send event summaries to
+
+        with open(f'app/{self.settings["session_file"]}.yaml') as f:
+            self.restore_dict = yaml.load(f, Loader=yaml.FullLoader)
+        self.config = Config(self.config_dict['channels'][self.channels[self.restore_dict['channel']]], self.settings)
+        self.config.controls['cc'].set_config(f"{self.restore_dict['cc']:.6f}")
+        self.timings = StageTimings()
+        tracer.configure(self.settings['trace'])
+        self.publisher = Publisher(self.settings['publish'])
+        self.recipe = Recipe(self.settings)
+
+        self.baseline = self.recent_baseline()
+        self.new_event()
+        self.previous_event = self.event
+        self.restore_history()
+        self.new_eventfile()
+        self.epics = EPICS(self)
+        self.rs = RS_Connection(self.config)
+
+        self.server = QTcpServer(self)
+        self.server.newConnection.connect(self.new_connection)
+        if not self.server.listen(QHostAddress.LocalHost, self.settings['daemon']['port']):
+            raise OSError(f"Daemon couldn't listen on port {self.settings['daemon']['port']}: {self.server.errorString()}")
+        logging.info(f"Daemon listening on port {self.settings['daemon']['port']}.")
+        print(f"Daemon listening on port {self.settings['daemon']['port']}.")
+
+    def start_logger(self):
+        '''Start logger as main window does'''
+        logHandler = TimedRotatingFileHandler(os.path.join(self.settings['log_dir'], "log"), when="midnight")
+        logHandler.suffix = "%Y-%m-%d.txt"
+        logHandler.setFormatter(logging.Formatter('%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+        logger = logging.getLogger()
+        logger.addHandler(logHandler)
+        logger.setLevel(logging.INFO)
+        logging.info(f"Started new daemon instance with {self.config_filename}.")
+
+    def recent_baseline(self):
+        '''Baseline from last line of the recent baselines file the baseline tab writes, or empty'''
+        basedict = {}
+        try:
+            with open(os.path.join(self.settings["event_dir"], 'recent_baselines.txt')) as f:
+                for line in f:
+                    if line.strip():
+                        basedict = json.loads(line)
+            basedict['stop_time'] = parse(basedict['stop_time'])
+        except (OSError, KeyError, ValueError) as e:
+            print('No recent baseline, using empty baseline:', e)
+        return Baseline(self.config, basedict)
+
+    def new_event(self):
+        '''Create new event instance with current baseline'''
+        self.event = Event(self)
+        self.event.base_stamp = self.baseline.stop_stamp
+        self.event.base_time = self.baseline.stop_time
+        self.event.base_file = self.baseline.base_file
+        self.event.baseline = self.baseline.phase
+
+    def new_eventfile(self):
+        '''Open new eventfile'''
+        self.close_eventfile()
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.eventfile_start = now.strftime("%Y-%m-%d_%H-%M-%S")
+        self.eventfile_name = os.path.join(self.settings["event_dir"], f'current_{self.eventfile_start}.txt')
+        self.eventfile = open(self.eventfile_name, "w")
+        self.eventfile_lines = 0
+        logging.info(f"Opened new evenfile {self.eventfile_name}")
+
+    def close_eventfile(self):
+        '''Try to close and rename eventfile'''
+        try:
+            self.eventfile.close()
+            now = datetime.datetime.now(tz=datetime.timezone.utc)
+            new = f'{self.eventfile_start}__{now.strftime("%Y-%m-%d_%H-%M-%S")}.txt'
+            os.rename(self.eventfile_name, os.path.join(self.settings["event_dir"], new))
+            logging.info(f"Closed eventfile and moved to {new}.")
+        except AttributeError:
+            pass
+
+    def restore_history(self):
+        '''Open history file and restore previous history'''
+        self.hist_file = open(f"app/{self.settings['history_file']}.json", "a+")
+        self.hist_file.seek(0)
+        self.history = History()
+        for line in self.hist_file:
+            self.history.res_hist(HistPoint(json.loads(line.rstrip('\n|\r'))))
+
+    def start_thread(self):
+        '''Start new event and run thread'''
+        self.new_event()
+        try:
+            self.run_thread = RunThread(self, self.config)
+            self.run_thread.finished.connect(self.done)
+            self.run_thread.reply.connect(self.event.update_event)
+            self.run_thread.start()
+        except Exception as e:
+            print('Exception starting run thread, lost connection: '+str(e))
+
+    def done(self):
+        '''Sweeps finished, close event and analyze with recipe'''
+        self.previous_event = self.event
+        self.previous_event.label = self.label
+        self.start_end = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.previous_event.close_event(self.recipe.base, self.recipe.sub, self.recipe.res)
+        if not np.any(self.previous_event.scan.phase) and self.running:      # no analysis thread for empty event, so go again
+            self.start_thread()
+
+    def epics_update(self, event):
+        '''Writes current event data to EPICS and reads status variables from EPICS.'''
+        self.epics.end_beam(event)
+        self.epics.write_event(event)       # queued, written by EPICS write thread
+        event.epics = self.epics.snapshot()
+
+    def end_finished(self):
+        '''Analysis returned. Write event and history, send to subscribers, and run again if running.'''
+        event = self.previous_event
+        with self.timings.stage('print_event', event):
+            event.print_event(self.eventfile)
+        self.eventfile.flush()
+        self.eventfile_lines += 1
+        if self.eventfile_lines > 500:
+            self.new_eventfile()
+        with self.timings.stage('add_hist', event):
+            self.history.add_hist(HistPoint(event), self.hist_file)
+        self.hist_file.flush()
+        self.publisher.event(event)
+
+        self.last = self.summary(event)
+        mes = f"Finished event at {event.stop_time:%H:%M:%S} UTC, after {event.elapsed}s, pol {event.pol:.4f}."
+        logging.info(mes)
+        print(mes)
+        for client in self.subscribers:
+            self.send(client, {'event':self.last})
+        tracer.dump()
+        if self.running:
+            self.start_thread()
+
+    def summary(self, event):
+        '''Dict of event results and curves sent to clients'''
+        return {'stop_time':str(event.stop_time), 'stop_stamp':event.stop_stamp, 'elapsed':event.elapsed, 'label':event.label,
+                'sweeps':event.scan.num, 'cc':event.cc, 'area':float(event.area), 'pol':float(event.pol), 'message':self.recipe.message,
+                'freq_list':event.scan.freq_list.tolist(), 'fitsub':np.asarray(event.fitsub).tolist(), 'rescurve':np.asarray(event.rescurve).tolist(),
+                'timings':event.timings}
+
+    def new_connection(self):
+        '''Accept client connection'''
+        while self.server.hasPendingConnections():
+            client = self.server.nextPendingConnection()
+            client.readyRead.connect(lambda client=client: self.read_commands(client))
+            client.disconnected.connect(lambda client=client: self.drop(client))
+            self.clients.append(client)
+
+    def drop(self, client):
+        '''Forget disconnected client'''
+        if client in self.subscribers:
+            self.subscribers.remove(client)
+        if client in self.clients:
+            self.clients.remove(client)
+        client.deleteLater()
+
+    def send(self, client, reply):
+        '''Send dict to client as JSON line'''
+        client.write((json.dumps(reply, default=str) + '\n').encode())
+
+    def read_commands(self, client):
+        '''Read and answer complete command lines from client'''
+        while client.canReadLine():
+            line = bytes(client.readLine()).decode().strip()
+            if line:
+                self.send(client, self.command(line, client))
+
+    def command(self, line, client=None):
+        '''Carry out command line
+
+        Returns:
+            Reply dict, with ok true if done
+        '''
+        name, _, arg = line.partition(' ')
+        reply = {'reply':name, 'ok':True}
+        try:
+            if name == 'status':
+                reply.update({'running':self.running, 'active':hasattr(self, 'run_thread') and self.run_thread.isRunning(),
+                              'sweeps':self.event.scan.num, 'label':self.label, 'last':{k:v for k,v in self.last.items() if k not in ['freq_list', 'fitsub', 'rescurve']}})
+            elif name == 'start':
+                if not self.running:
+                    self.running = True
+                    if not (hasattr(self, 'run_thread') and self.run_thread.isRunning()):
+                        self.start_thread()
+            elif name == 'stop':
+                self.running = False
+            elif name == 'abort':
+                self.running = False
+                self.abort_now = True
+            elif name == 'label':
+                self.label = arg or 'None'
+            elif name == 'sweeps':
+                self.config.controls['sweeps'].set_config(arg)
+            elif name == 'cc':
+                self.config.controls['cc'].set_config(arg)
+            elif name == 'baseline':
+                self.baseline = Baseline(self.config, {'stop_stamp':self.previous_event.stop_stamp, 'stop_time':self.previous_event.stop_time,
+                                                       'base_file':self.eventfile_name, 'phase':self.previous_event.scan.phase})
+                reply['base_time'] = str(self.baseline.stop_time)
+            elif name == 'subscribe':
+                if client is not None and client not in self.subscribers:
+                    self.subscribers.append(client)
+            elif name == 'quit':
+                QTimer.singleShot(100, self.quit)       # after reply is sent
+            else:
+                reply.update({'ok':False, 'error':f'Unknown command {name}'})
+        except Exception as e:
+            reply.update({'ok':False, 'error':str(e)})
+        logging.info(f"Daemon command: {line}")
+        return reply
+
+    def quit(self):
+        '''Stop running, close files and save session, then exit'''
+        self.running = False
+        self.abort_now = True
+        if hasattr(self, 'run_thread'):
+            self.run_thread.wait()
+        self.recipe.close()
+        self.epics.close()
+        self.publisher.close()
+        self.rs.close()
+        instruments.close_all()
+        self.close_eventfile()
+        self.hist_file.close()
+        tracer.dump()
+        saved_dict = {'phase_tune':self.config.phase_vout, 'diode_tune':self.config.diode_vout,
+                      'cc':self.config.controls['cc'].value, 'channel':self.channels.index(self.config.channel['name'])}
+        with open(f'app/{self.settings["session_file"]}.yaml', 'w') as file:
+            yaml.dump(saved_dict, file)
+        QCoreApplication.quit()
@@ -0,0 +1,33 @@
+'''PyNMR, J.Maxwell 2020
+'''
+import json
+import socket
+
+
+class DaemonClient():
+    '''Blocking client for daemon commands, for scripts and the command line
+
+    Arguments:
+        port: Daemon TCP port
+        host: Daemon host, local by default
+        timeout: Seconds to wait for reply
+    '''
+    def __init__(self, port, host='127.0.0.1', timeout=5):
+        self.s = socket.create_connection((host, port), timeout=timeout)
+        self.file = self.s.makefile('r')
+
+    def send(self, command):
+        '''Send command line, returning reply dict'''
+        self.s.sendall((command.strip() + '\n').encode())
+        return self.read()
+
+    def read(self):
+        '''Read next JSON line from daemon, a reply or an event'''
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('Daemon closed connection')
+        return json.loads(line)
+
+    def close(self):
+        self.file.close()
+        self.s.close()
@@ -3,14 +3,15 @@
 import socket
 import time
 import json
-import telnetlib
-import unyt
+import logging
+import threading
 import numpy as np
-import nidaqmx
-from nidaqmx.constants import (DigitalWidthUnits, AcquisitionType,
-                               ReadRelativeTo, OverwriteMode, DigitalWidthUnits,
-                               TriggerType, TaskMode, READ_ALL_AVAILABLE)
-                               
+from PyQt5.QtCore import QThread
+
+from app import instruments
+
+TEST_TUNE = {1: 0.42, 2: 0.63}     # phase and diode DAC values the Test DAQ's tune mode curves are best at
+
 class DAQConnection():
     '''Handle connection to and communication with DAQ system. Designed to hide all the specifics of different DAQ systems with generic actions for all. Init will open connections and send configuration settings to DAQ.
     
@@ -58,6 +59,7 @@ class DAQConnection():
                     self.test_phase = np.array(event['phase'])
                     self.test_diode = np.array(event['diode'])
                     self.test_freqs = np.array(event['freq_list'])
+            self.test_dac = {1: 0, 2: 0}
             self.message = 'DAQ Test mode.'
             self.name = 'Test'
             
@@ -118,6 +120,11 @@ class DAQConnection():
             
             p_test = self.test_phase + np.random.rand(len(self.test_phase))*0.00001*num_in_chunk   # numpy arrays
             d_test = -self.test_diode + np.random.rand(len(self.test_diode))*0.00001*num_in_chunk 
+            if self.tune_mode:      # phase tilts, diode dip moves off center and fades as DACs move from TEST_TUNE
+                x = np.linspace(-1, 1, len(p_test))
+                off = self.test_dac[2] - TEST_TUNE[2]
+                p_test = p_test + 0.05*(self.test_dac[1] - TEST_TUNE[1])*x
+                d_test = d_test - 0.05/(1 + (off/0.1)**2)/(1 + ((x - 2*off)/0.3)**2)
             return (0, num_in_chunk, p_test, d_test)
       
     def set_dac(self, dac_v, dac_c):
@@ -129,6 +136,7 @@ class DAQConnection():
             return self.udp.set_register()        
         if self.daq_type=='Test':
             #print("DAC", dac_v, dac_c)
+            self.test_dac.update({c: dac_v for c in ([1, 2] if dac_c == 3 else [dac_c])})
             return True
       
     def read_stat(self):
@@ -386,72 +394,132 @@ class TCP():
         #return chunk_num, num_in_chunk, pchunk*3/8388607/0.5845, dchunk*3/8388607/0.5845  # converting value to voltage
         
 class RS_Connection():
-    '''Handle connection to Rohde and Schwarz SMA100A via Telnet. 
+    '''Handle connection to Rohde and Schwarz SMA100A, over a session shared with anything else using it. Settings
+    are sent by a thread, all in one message, and all read back in one round trip to check against the config. If
+    the R&S can't be reached, like while it is power cycled, sending is retried until it can.
     
     Arguments:
         config: Current Config object
     '''
     def __init__(self, config):        
-        '''Open connection to R&S, send commands for all settings, and read all back to check. Close.
+        '''Start thread and queue settings of config to send.
         '''
         self.host = config.settings['RS_settings']['ip']
         self.port = config.settings['RS_settings']['port']
+        self.retry_time = config.settings['RS_settings']['retry_time']
+        self.session = instruments.session(self.host, self.port, config.settings['RS_settings']['timeout'])
+        self.sending = threading.Condition()        # guards pending, wakes thread
+        self.pending = None                          # config waiting to be sent, only the latest is kept
+        self.running = True
+        self.thread = RSThread(self)
+        self.thread.start()
+        self.configure(config)
         
-        try:
-            tn = telnetlib.Telnet(self.host, port=self.port, timeout=config.settings['RS_settings']['timeout'])
-            
-            # Write all required settings
-            
-            tn.write(bytes(f"FREQ {config.channel['cent_freq']*1000000}\n", 'ascii'))
-            tn.write(bytes(f"POWer {config.channel['power']} mV\n", 'ascii'))
-            if 'FPGA' in config.settings['daq_type']:
-                tn.write(b"FM:SOUR EDIG\n")
-            elif 'NIDAQ' in config.settings['daq_type']:
-                tn.write(b"FM:SOUR EXT\n")
-            else:
-                tn.write(b"FM:SOUR EXT\n")  
-            tn.write(bytes(f"FM:EXT:DEV {config.channel['mod_freq']*1000}\n", 'ascii'))
-            tn.write(b"FM:EXT:DIG:BFOR DCOD\n")
-            tn.write(b"FM:STATE ON\n")
-            tn.write(b"OUTP ON\n")
-            tn.write(b"FREQ?\n")
-            freq = tn.read_some().decode('ascii')
-            tn.write(b"POW?\n")
-            pow = tn.read_some().decode('ascii')
-            tn.write(b"FM:SOUR?\n")
-            sour = tn.read_some().decode('ascii')
-            tn.write(b"FM:EXT:DEV?\n")
-            dev = tn.read_some().decode('ascii')
-            tn.write(b"FM:EXT:DIG:BFOR?\n")
-            bfor = tn.read_some().decode('ascii')
-            tn.write(b"FM:STATE?\n")
-            fmstate = tn.read_some().decode('ascii')
-            tn.write(b"OUTP?\n")
-            outp = tn.read_some().decode('ascii')
-            
-            tn.close()
-            print(f"Successfully sent settings to R&S on {self.host}")
+    def configure(self, config):
+        '''Queue settings of config to be sent by thread, replacing any not yet sent'''
+        with self.sending:
+            self.pending = config
+            self.sending.notify()
             
-        except Exception as e:
-            print(f"R&S connection failed on {self.host}: {e}")
+    def settings(self, config):
+        '''Setting commands for config, and the replies expected to the query of each
+        
+        Returns:
+            List of commands, dict of expected replies keyed on command header
+        '''
+        sour = 'EDIG' if 'FPGA' in config.settings['daq_type'] else 'EXT'
+        expected = {'FREQ':round(config.channel['cent_freq']*1000000, 3), 'POW':config.channel['power'], 'FM:SOUR':sour,
+                    'FM:EXT:DEV':round(config.channel['mod_freq']*1000, 3), 'FM:EXT:DIG:BFOR':'DCOD', 'FM:STATE':'1', 'OUTP':'1'}
+        commands = [f"FREQ {expected['FREQ']}", f"POW {expected['POW']} mV", f"FM:SOUR {sour}", f"FM:EXT:DEV {expected['FM:EXT:DEV']}",
+                    "FM:EXT:DIG:BFOR DCOD", "FM:STATE ON", "OUTP ON"]
+        return commands, expected
+        
+    def send(self, config):
+        '''Send all settings as one message, then query all in one, and check replies.
+        
+        Returns:
+            List of settings that didn't read back as sent
+        '''
+        commands, expected = self.settings(config)
+        with self.session.lock:
+            self.session.write(instruments.compound(commands))
+            replies = self.session.query(instruments.compound([f"{header}?" for header in expected])).strip().split(';')
+        if len(replies) != len(expected):
+            return list(expected)
+        return [header for (header, value), reply in zip(expected.items(), replies) if not self.matches(header, value, reply)]
+        
+    def matches(self, header, value, reply):
+        '''Check reply to query of setting against value sent. Power is sent in mV but read back in dBm, as rms volts
+        into 50 Ohm.'''
+        reply = reply.strip().strip('"').upper()
+        try:
+            if header == 'POW':
+                return value <= 0 or abs(float(reply) - 10*np.log10((value/1000)**2/50/0.001)) < 0.1
+            if isinstance(value, str):
+                return reply == value or reply == {'1':'ON', '0':'OFF'}.get(value)
+            return abs(float(reply) - value) <= 1e-6*abs(value)
+        except ValueError:
+            return False
         
     def rf_off(self):
-        '''Connect to turn off RF, then close.'''        
+        '''Turn off RF'''        
         try:
-            tn = telnetlib.Telnet(self.host, port=self.port)
-            tn.write(b"FM:STATE OFF\n")
-            tn.close()
+            self.session.write("FM:STATE OFF")
         except Exception as e:
             print(f"R&S connection failed on {self.host}: {e}")
         
     def rf_on(self):
-        '''Connect to turn on RF, then close.'''
+        '''Turn on RF'''
         try:
-            tn = telnetlib.Telnet(self.host, port=self.port)
-            tn.write(b"FM:STATE ON\n")
-            tn.close()
+            self.session.write("FM:STATE ON")
         except Exception as e:
             print(f"R&S connection failed on {self.host}: {e}")
+            
+    def close(self):
+        '''Stop thread, waiting for any send in progress'''
+        with self.sending:
+            self.running = False
+            self.sending.notify()
+        self.thread.wait()
+        
+        
+class RSThread(QThread):
+    '''Thread sending queued settings to the R&S, so the window never waits on it. If sending fails, tries again
+    every retry_time until it works or newer settings are queued.
+    Args:
+        parent: RS_Connection with pending config
+    '''
+    def __init__(self, parent):
+        QThread.__init__(self)
+        self.parent = parent
+
+    def run(self):
+        '''Main send loop'''
+        rs = self.parent
+        while True:
+            with rs.sending:
+                while rs.running and rs.pending is None:
+                    rs.sending.wait()
+                if not rs.running:
+                    break
+                config = rs.pending
+                rs.pending = None
+            try:
+                wrong = rs.send(config)
+            except Exception as e:
+                print(f"R&S connection failed on {rs.host}: {e}")
+                with rs.sending:            # retry after wait, unless closing or newer settings come
+                    if rs.pending is None:
+                        rs.sending.wait(rs.retry_time)
+                        if rs.pending is None:
+                            rs.pending = config
+                continue
+            if wrong:
+                print(f"R&S on {rs.host} didn't read back {', '.join(wrong)} as set for {config.channel['name']}")
+                logging.warning(f"R&S on {rs.host} didn't read back {', '.join(wrong)} as set for {config.channel['name']}")
+            else:
+                print(f"Successfully sent settings to R&S on {rs.host}")
+                logging.info(f"Sent {config.channel['name']} settings to R&S on {rs.host}")
         
         
         
@@ -465,6 +533,9 @@ class NI_Connection():
     '''
     
     def __init__(self, config):
+        import nidaqmx          # NI and unit libraries are slow to import, so only import them when using NIDAQ
+        import unyt
+        from nidaqmx.constants import (DigitalWidthUnits, AcquisitionType, ReadRelativeTo, OverwriteMode, TriggerType, TaskMode)
     
         self.ai = nidaqmx.Task()
         self.ao = nidaqmx.Task()
@@ -546,6 +617,7 @@ class NI_Connection():
             Results stream from the NI board and we ask for them after a second. What comes back is a number of sweeps, probably not ending in a whole numnber of sweeps. Have to save the last set of numbers to tack on to the front of the next chunk. Or we could discard the extra on the end...? 
         
         '''
+        from nidaqmx.constants import READ_ALL_AVAILABLE
         samples = self.ai.read(READ_ALL_AVAILABLE, timeout=self.pretri_delay_s)  # list of lists
         pchunks, dchunks = samples              # split into phase and diode        
         num_in_chunk = len(pchunks)//(self.pts_per_ramp)
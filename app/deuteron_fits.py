@@ -1,28 +1,41 @@
 '''PyNMR, J.Maxwell 2021
 '''
+import functools
+import os.path
+import collections
+import concurrent.futures
 import numpy as np
-from lmfit import Model
 
 
 class DFits():
     '''Fit to Deuteron lineshape, translated to Python by J.Maxwell from C code by C.Dulya.
     "A line-shape analysis for spin-1 NMR signals", C. Dulya et. al., SMC Collaboration, NIM A 398 (1997) 109-125.
     '''
+    order = 5       # number of interval halvings for the integral over phi when eta is non-zero
+    table = None    # DTable used by F in place of FandDerivs, if set
     
-    def __init__(self, freqs, signal, p):
-        '''Fits on signal 
+    def __init__(self, freqs, signal, p, table=None, max_nfev=None):
+        '''Fits on signal. If a DTable is passed, the fit is first run on the interpolated lineshape, then refined
+        with the exact lineshape starting from that result.
         
         Args:
             freqs: list of frequency points (X axis)
             signal: list of signal points   (Y axis)
             p: dict of initial parameters (A, G, r, wQ, wL, eta, xi)
+            table: optional DTable of precomputed lineshape components
+            max_nfev: optional limit on function evaluations for each fit
             
         Returns:
             result object from lmfit
         '''
+        from lmfit import Model      # slow import, so not until the first fit
         mod = Model(self.FitFunc)
         params = mod.make_params(A=p['A'], G=p['G'], r=p['r'], wQ=p['wQ'], wL=p['wL'], eta=p['eta'], xi=p['xi'])  
-        self.result = mod.fit(signal, params=params, w=freqs)        
+        self.table = table
+        self.result = mod.fit(signal, params=params, w=freqs, max_nfev=max_nfev)
+        if self.table is not None:       # refine with exact lineshape, should only take a few iterations
+            self.table = None
+            self.result = mod.fit(signal, params=self.result.params, w=freqs, max_nfev=max_nfev)
         return
             
     def FitFunc(self, w, A, G, r, wQ, wL, eta, xi):
@@ -32,18 +45,8 @@ class DFits():
         Ip, dIpdr = self.Iplus(r, wQ/wL, R)
         Im, dImdr = self.Iminus(r, wQ/wL, R)
 
-        Fm, dFm_dR, dFm_dA, dFm_dEta = self.FandDerivs(R, A, -1, eta)
-        Fp, dFp_dR, dFp_dA, dFp_dEta = self.FandDerivs(R, A, 1, eta)
-
-        Fm /= wQ 
-        dFm_dR /= wQ
-        dFm_dA /= wQ 
-        dFm_dEta /= wQ 
-
-        Fp /= wQ 
-        dFp_dR /= wQ
-        dFp_dA /= wQ
-        dFp_dEta /= wQ
+        Fm = self.F(R, A, -1, eta)/wQ
+        Fp = self.F(R, A, 1, eta)/wQ
 
         F = G * (Im*Fm + Ip*Fp)  # Lineshape
         Fm = G * (Im*Fm)  # Lineshape from minus
@@ -58,6 +61,12 @@ class DFits():
         yp =  fAsym*Fp 
         return y
 
+    def F(self, R, A, eps, eta):
+        '''Lineshape component for transition eps, interpolated from the table if one is set and covers the point'''
+        if self.table is not None and self.table.covers(eps*R, A, eta):
+            return self.table.F(eps*R, A, eta)
+        return self.FandDerivs(R, A, eps, eta)[0]
+
     def Iplus(self, r, Q, R):    
         '''Returns: II, dI_dr '''
         r3QR = np.power(r, -3*Q*R)
@@ -112,56 +121,245 @@ class DFits():
             dFdR = ( (1 - eps * R) * I3 - I4 ) * 2 * A * eps  
             dFdEta = 0
         else:
-            Y2 = 3
-            I1, I2, I3, I4 = self.Integrals(R, A, eps, Y2, 0)
-            FF, dFdA, dFdR, dFdEta = (0,0,0,0) 
-            eRm1 = 1 - eps*R
-            dphi = 1
-
-            for i in (0,1):
-                c2p = np.cos(np.pi*dphi*i)
-                ec2p = eta*c2p       
-                Y2 = 3 - ec2p
-                Y = np.sqrt(Y2) 
-                z2 = eRm1 - ec2p 
-          
-                I1, I2, I3, I4 = self.Integrals(R, A, eps, Y2, 0)
-          
-                fac = 0.5 * np.sqrt(3) / Y       
-                FF += fac * I1 * A  
-          
-                dFdA += fac * (I1 - 2 * A*A * I3 )       
-                dFdR += fac*( z2*I3 - I4 )*2*A*eps 
-                gY =  Y2 * (Y2 - 2*z2) + A*A + z2*z2    
-                dFdEta += 2*A*c2p*fac * (z2*I3 - I4 + I1/(4*Y2) - 1/(4*Y*gY))
-            
-            order = 5
-            for N in [np.power(2,n) for n in range(2,order+1)]:
-                dphi = 1/N
+            c2p, weight, shift = eta_nodes(self.order)
+            c2p = c2p[:, np.newaxis]            # phi nodes down axis 0, frequency points along axis 1
+            weight = weight[:, np.newaxis]
+            shift = shift[:, np.newaxis]
+
+            ec2p = eta*c2p
+            Y2 = 3 - ec2p
+            Y = np.sqrt(Y2)
+            z2 = (1 - eps*R) - ec2p
 
-                for i in range(N-1, 0, -2):
-                    c2p = np.cos(np.pi*dphi*i)
-                    ec2p = eta*c2p
+            I1, I2, I3, I4 = self.Integrals(R, A, eps, Y2, ec2p*shift)
 
-                    Y2 = 3 - ec2p
-                    Y = np.sqrt(Y2)
-                    z2 = eRm1 - ec2p
+            fac = weight*np.sqrt(3)/Y
+            gY = Y2 * (Y2 - 2*z2) + A*A + z2*z2
 
-                    I1, I2, I3, I4 = self.Integrals(R, A, eps, Y2, ec2p)
+            FF = np.sum(fac*I1*A, axis=0)
+            dFdA = np.sum(fac*(I1 - 2*A*A*I3), axis=0)
+            dFdR = np.sum(fac*(z2*I3 - I4), axis=0)*2*A*eps
+            dFdEta = np.sum(2*A*c2p*fac * (z2*I3 - I4 + I1/(4*Y2) - 1/(4*Y*gY)), axis=0)
+
+        return FF, dFdA, dFdR, dFdEta
 
-                    fac = np.sqrt(3)/Y
 
-                    FF += fac*I1*A
+@functools.lru_cache(maxsize=None)
+def eta_nodes(order):
+    '''Quadrature nodes for the integral over phi in FandDerivs, cached per order. Nodes are laid out as in the
+    original C code: the end points carry half weight and are integrated without the eta*cos(2phi) shift in z2,
+    then each halving N = 4, 8, ... 2**order adds the odd multiples of 1/N.
 
-                    dFdA += fac*(I1 - 2*A*A*I3)
-                    dFdR += fac*(z2*I3 - I4)*2*A*eps
-                    gY = Y2 * (Y2 - 2*z2) + A*A + z2*z2 
-                    dFdEta += 2*A*c2p*fac * (z2*I3 - I4 + I1/(4*Y2) - 1/(4*Y*gY)) 
+    Args:
+        order: Number of halvings of the phi interval
 
+    Returns:
+        c2p: cos(2phi) at each node
+        weight: trapezoid weight of each node, including the 1/N spacing
+        shift: 1 where eta*cos(2phi) is passed to Integrals, 0 where it is not
+    '''
+    dphi = 1
+    i = [0, 1]
+    for N in [np.power(2,n) for n in range(2,order+1)]:
+        dphi = 1/N
+        i.extend(np.arange(N-1, 0, -2)*dphi)
+    c2p = np.cos(np.pi*np.array(i))
+    weight = np.concatenate(([0.5, 0.5], np.ones(len(i)-2)))*dphi
+    shift = np.concatenate(([0, 0], np.ones(len(i)-2)))
+    for a in (c2p, weight, shift):
+        a.setflags(write=False)
+    return c2p, weight, shift
 
-            FF = dphi*FF
-            dFdA = dphi*dFdA
-            dFdR = dphi*dFdR
-            dFdEta = dphi*dFdEta
 
-        return FF, dFdA, dFdR, dFdEta
+class DTable():
+    '''Precomputed table of the deuteron lineshape component FF from DFits.FandDerivs on a grid of (A, eta, eps*R),
+    used to speed up fits. FF only depends on R through eps*R, so one table serves both transitions. The table is
+    saved to disk and memory-mapped when loaded. It is built if the file is missing or was made on a different grid.
+    If spot checks against the exact lineshape are off by more than the tolerance, the grid is too coarse and the
+    table is not used.
+
+    Arguments:
+        settings: Dict of table settings from config file (file, R, A, eta as [start, stop, num], tolerance)
+
+    Attributes:
+        R: 1D Numpy array of eps*R grid points
+        A: 1D Numpy array of A grid points
+        eta: 1D Numpy array of eta grid points
+        table: Memory-mapped 3D Numpy array of FF, indexed [eta, A, R]
+        valid: False if the table failed the tolerance check
+    '''
+    def __init__(self, settings):
+        self.file = settings['file']
+        self.axes_file = os.path.splitext(self.file)[0] + '_axes.npz'
+        self.R = np.linspace(*settings['R'])
+        self.A = np.geomspace(*settings['A'])       # lineshape changes fastest at small A
+        self.eta = np.linspace(*settings['eta'])
+        self.tolerance = settings['tolerance']
+
+        if not self.load():
+            self.build()
+            self.load()
+        error = self.check()
+        self.valid = error <= self.tolerance
+        if not self.valid:
+            print(f'Deuteron fit table {self.file} off by {error:.2e}, outside tolerance. Using exact lineshape.')
+
+    def load(self):
+        '''Memory-map table from file if it exists and was made on the same grid. Returns True if loaded.'''
+        if not (os.path.exists(self.file) and os.path.exists(self.axes_file)):
+            return False
+        with np.load(self.axes_file) as axes:
+            for key in ('R', 'A', 'eta'):
+                if axes[key].shape != getattr(self, key).shape or not np.allclose(axes[key], getattr(self, key)):
+                    return False
+        self.table = np.load(self.file, mmap_mode='r')
+        print(f'Loaded deuteron fit table from {self.file}.')
+        return True
+
+    def build(self):
+        '''Evaluate exact lineshape on the full grid and save to file'''
+        print(f'Building deuteron fit table {self.file}, this will take a while.')
+        d = DFits.__new__(DFits)       # only need the lineshape methods, not a fit
+        table = np.empty((len(self.eta), len(self.A), len(self.R)))
+        for i, eta in enumerate(self.eta):
+            for j, A in enumerate(self.A):
+                table[i, j] = d.FandDerivs(self.R, A, 1, eta)[0]
+        np.save(self.file, table)
+        np.savez(self.axes_file, R=self.R, A=self.A, eta=self.eta)
+
+    def check(self, n=5):
+        '''Compare interpolated lineshape to exact at random points inside the grid
+
+        Returns:
+            Largest difference, relative to the peak of the exact lineshape
+        '''
+        d = DFits.__new__(DFits)
+        rng = np.random.default_rng(0)
+        worst = 0
+        for A, eta in zip(rng.uniform(self.A[0], self.A[-1], n), rng.uniform(self.eta[0], self.eta[-1], n)):
+            exact = d.FandDerivs(self.R, A, 1, eta)[0]
+            worst = max(worst, np.abs(self.F(self.R, A, eta) - exact).max()/np.abs(exact).max())
+        return worst
+
+    def covers(self, x, A, eta):
+        '''True if the table is valid and A, eta and all points of x are inside the grid'''
+        return (self.valid and self.A[0] <= A <= self.A[-1] and self.eta[0] <= eta <= self.eta[-1]
+                and self.R[0] <= np.min(x) and np.max(x) <= self.R[-1])
+
+    def F(self, x, A, eta):
+        '''Bilinear interpolation in A and eta between the four neighbouring table rows, then linear in x
+
+        Args:
+            x: eps*R points
+            A: Asymmetry parameter A
+            eta: Asymmetry parameter eta
+
+        Returns:
+            Interpolated FF at x
+        '''
+        i = np.clip(np.searchsorted(self.eta, eta) - 1, 0, len(self.eta) - 2)
+        j = np.clip(np.searchsorted(self.A, A) - 1, 0, len(self.A) - 2)
+        u = (eta - self.eta[i])/(self.eta[i+1] - self.eta[i])
+        v = (A - self.A[j])/(self.A[j+1] - self.A[j])
+        rows = self.table[i:i+2, j:j+2]
+        row = (1-u)*((1-v)*rows[0, 0] + v*rows[0, 1]) + u*((1-v)*rows[1, 0] + v*rows[1, 1])
+        return np.interp(x, self.R, row)
+
+
+class DFitPool():
+    '''Runs several seeded DFits in a process pool and keeps the best reduced chi-square. Keeps a warm-start cache of
+    parameters from the last good fits, each tried as a seed, so a bad fit does not leave the next event stuck on a
+    stale seed.
+
+    Arguments:
+        settings: Dict of pool settings from config file (workers, cache, perturbations, spread, max_nfev, timeout)
+        default: Dict of default initial parameters from config file
+        table_settings: Dict of DTable settings from config file, or None to fit with the exact lineshape
+
+    Attributes:
+        good: Deque of parameter dicts from recent successful fits, newest last
+    '''
+    perturbed = ('A', 'G', 'r', 'wQ', 'eta', 'xi')     # parameters varied for perturbed seeds, wL is left alone
+
+    def __init__(self, settings, default, table_settings=None):
+        self.default = dict(default)
+        self.perturbations = settings['perturbations']
+        self.spread = settings['spread']
+        self.max_nfev = settings['max_nfev']
+        self.timeout = settings['timeout']
+        self.good = collections.deque(maxlen=settings['cache'])
+        self.rng = np.random.default_rng()
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=settings['workers'],
+                                                           initializer=init_worker, initargs=(table_settings,))
+
+    def seeds(self, p):
+        '''List of initial parameter dicts to try: each cached good fit, passed seed, config default, and perturbations
+        of the last good fit (or of the passed seed if there is no good fit yet)'''
+        centre = self.good[-1] if self.good else p
+        seeds = list(reversed(self.good)) + [p, self.default]
+        for i in range(self.perturbations):
+            seed = dict(centre)
+            for key in self.perturbed:
+                seed[key] = centre[key]*(1 + self.spread*self.rng.standard_normal())
+            seeds.append(seed)
+        return seeds
+
+    def fit(self, freqs, signal, p):
+        '''Fit all seeds in parallel, waiting at most the timeout.
+
+        Args:
+            freqs: list of frequency points (X axis)
+            signal: list of signal points   (Y axis)
+            p: dict of initial parameters (A, G, r, wQ, wL, eta, xi)
+
+        Returns:
+            Dict from fit_seed of the best fit, or None if no fit returned in time
+        '''
+        futures = [self.pool.submit(fit_seed, freqs, signal, seed, self.max_nfev) for seed in self.seeds(p)]
+        done, not_done = concurrent.futures.wait(futures, timeout=self.timeout)
+        for f in not_done:
+            f.cancel()
+        results = [f.result() for f in done if f.exception() is None]
+        good = [r for r in results if r['success'] and np.isfinite(r['redchi'])]
+        if good:
+            best = min(good, key=lambda r: r['redchi'])
+            self.good.append(best['params'])
+            return best
+        elif results:
+            return min(results, key=lambda r: r['redchi'] if np.isfinite(r['redchi']) else np.inf)
+        else:
+            return None
+
+    def close(self):
+        '''Shut down pool without waiting on running fits'''
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+worker_table = None     # DTable for each DFitPool worker process
+
+
+def init_worker(table_settings):
+    '''Load lineshape table once in each DFitPool worker process'''
+    global worker_table
+    if table_settings is not None:
+        worker_table = DTable(table_settings)
+
+
+def fit_seed(freqs, signal, p, max_nfev):
+    '''Run single DFits in a worker process, returning only plain data so it can be sent back to the main process
+
+    Returns:
+        Dict from fit_dict
+    '''
+    return fit_dict(DFits(freqs, signal, p, worker_table, max_nfev).result)
+
+
+def fit_dict(res):
+    '''Plain data of lmfit result: dict of params, stderr (nan if not estimated), best_fit, redchi and success'''
+    return {
+        'params': res.params.valuesdict(),
+        'stderr': {k: v.stderr if v.stderr is not None else np.nan for k, v in res.params.items()},
+        'best_fit': res.best_fit,
+        'redchi': res.redchi,
+        'success': res.success,
+    }
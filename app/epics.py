@@ -1,28 +1,49 @@
 '''PyNMR, J.Maxwell 2020
 '''
-from epics import caget_many, caput_many
+from epics import caget_many, caput_many, PV
 import time
-from PyQt5.QtCore import QThread, pyqtSignal, Qt
+import logging
+import threading
+import collections
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal, Qt
+
+from app.trace import tracer
 
 
 class EPICS():
-    '''Class to hold all EPICS channels to monitor and write, and methods on them. Includes test mode. Includes monitor thread to get values in intervals.
+    '''Class to hold all EPICS channels to monitor and write, and methods on them. Includes test mode. Read channels
+    are either subscribed to, with channel access monitors updating a cache as values change, or polled by a monitor
+    thread at intervals.
     
     Arguments:
         enable:  Won't contact server if false
-        monitor_time: How long to wait between calls to get
+        subscribe: Use channel access monitors if true, poll if false
+        monitor_time: How long to wait between calls to get when polling
+        refresh_time: Shortest time between run tab status updates when subscribed
+        write_retries: Times to retry writes that fail before giving up on those values
+        retry_time: Time to wait between write retries
         read_names: Dict of channel names string to read keyed on epics channel ie 'HBPT:targ_pol'
         write_atts: Dict of Event attributes to write keyed on epics channel
         
     Attributes:
-        read_PVs:  Dict of most recently read variable values keyed on PV name
+        read_pvs:  Dict of most recently read variable values keyed on PV name
+        cache: Dict of (value, channel access timestamp) of most recent monitor updates keyed on PV name
+        beam_held: Beam current since its last update, integrated into the event when the next arrives
+        clock_offsets: Local arrival time less channel access timestamp of recent beam current updates
+        pending: Dict of values waiting for the write thread keyed on PV name, newer values replacing older
+        tries: Dict of failed tries at writing each pending value keyed on PV name, restarting for newer values
     
     '''
     def __init__(self, parent):       
         
         self.parent = parent
         self.enable = parent.settings['epics_settings']['enable']
+        self.subscribe = parent.settings['epics_settings']['subscribe']
         self.monitor_time = parent.settings['epics_settings']['monitor_time']
+        self.refresh_time = parent.settings['epics_settings']['refresh_time']
+        self.beam_pv = parent.settings['epics_settings']['beam_current']
+        self.write_retries = parent.settings['epics_settings']['write_retries']
+        self.retry_time = parent.settings['epics_settings']['retry_time']
         self.timeout = parent.settings['epics_settings']['timeout']
         self.read_names = parent.epics_reads             # Dict of PV names and namestring
         self.read_list = self.read_names.keys()   # List of PV names to read from server
@@ -30,60 +51,186 @@ class EPICS():
         self.write_list = self.write_atts.keys()  # List of PV Names to write to EPICS
                 
         self.read_pvs   = {k:0 for k in self.read_list}    # Dict PVs and values    
+        self.cache = {k:(0, 0) for k in self.read_list}
+        self.lock = threading.Lock()        # monitor callbacks come on channel access threads
+        self.changed = False        # cache updated since last run tab update
+        self.beam_held = 0
+        self.clock_offsets = collections.deque(maxlen=50)
+        self.beam_signal = BeamSignal()
+        self.beam_signal.update.connect(self.beam_update, Qt.QueuedConnection)
+        self.pending = {}
+        self.tries = {}
+        self.writing = threading.Condition()        # guards pending, wakes write thread
+        self.write_running = False
         
         if not self.enable: 
             print('EPICS in test mode.')
             self.read_PVs   = {k:0 for k in self.read_list}     
             self.monitor_running = False
+        elif self.subscribe:
+            self.monitor_running = False
+            self.pvs = [PV(name, callback=self.pv_update, connection_callback=self.pv_connection, auto_monitor=True) for name in self.read_list]
+            self.refresh_timer = QTimer()
+            self.refresh_timer.timeout.connect(self.refresh)
+            self.refresh_timer.start(int(self.refresh_time*1000))
         else:               
             self.monitor_running = True            
             self.mon_thread = MonitorThread(self)
             self.mon_thread.reply.connect(self.mon_reply)
             self.mon_thread.finished.connect(self.mon_finished)
             self.mon_thread.start()
+        if self.enable:
+            self.write_running = True
+            self.write_thread = WriteThread(self)
+            self.write_thread.start()
     
     def mon_reply(self):
-        '''Update run tab after monitor update'''
-        self.parent.run_tab.update_status()
+        '''Integrate beam current and update run tab after monitor poll'''
+        try:
+            self.parent.event.sum_beam_current(self.read_pvs[self.beam_pv])
+        except (KeyError, TypeError):
+            pass
+        if hasattr(self.parent, 'run_tab'):         # headless daemon has no run tab
+            self.parent.run_tab.update_status()
+
+    def pv_update(self, pvname=None, value=None, timestamp=None, **kw):
+        '''Monitor callback: cache new value. Beam current updates are sent on to be integrated in the thread owning
+        the events, stamped on the local clock the events use. The IOC clock may be set differently, so channel access
+        timestamps are shifted by the smallest offset between arrival and timestamp of recent updates, which keeps
+        the IOC's spacing of updates without counting network delays.'''
+        with self.lock:
+            self.cache[pvname] = (value, timestamp)
+            self.read_pvs[pvname] = value
+            self.changed = True
+            if pvname == self.beam_pv:
+                arrival = time.time()
+                if timestamp is None:
+                    timestamp = arrival
+                self.clock_offsets.append(arrival - timestamp)
+                stamp = min(timestamp + min(self.clock_offsets), arrival)
+                try:
+                    current = float(value)
+                except (TypeError, ValueError):
+                    current = 0
+                self.beam_signal.update.emit(current, stamp)
+
+    def beam_update(self, current, stamp):
+        '''Integrate beam current held since its last update into the open event, then hold the new value'''
+        self.parent.event.sum_beam_current(self.beam_held, stamp)
+        self.beam_held = current
+
+    def pv_connection(self, pvname=None, conn=None, **kw):
+        '''Connection callback: log channels lost and regained'''
+        logging.info(f"EPICS channel {pvname} {'connected' if conn else 'disconnected'}.")
+
+    def refresh(self):
+        '''Update run tab if subscribed values have changed, at most once per refresh_time'''
+        if self.changed and hasattr(self.parent, 'run_tab'):
+            self.changed = False
+            with tracer.span('epics_refresh', 'epics'):
+                self.parent.run_tab.update_status()
+
+    def end_beam(self, event):
+        '''Integrate beam current held since its last update to the end of closed event'''
+        if self.enable and self.subscribe:
+            event.sum_beam_current(self.beam_held, event.stop_stamp)
         
     def mon_finished(self):
         '''Things to do when done'''
         return
             
     def read_all(self):
-        '''Read new values from EPICS PVs. Use caget_many to do quickly
+        '''Read new values from EPICS PVs. Use caget_many to do quickly, or the cache if subscribed
         
         Returns:
             Dict of values keyed on channel name
         '''
         if not self.enable:
             return {k:0 for k in self.read_list} 
+        elif self.subscribe:
+            with self.lock:
+                self.read_pvs = {k:v for k, (v, stamp) in self.cache.items()}
         else:
             try:
-                values = caget_many(self.read_list, timeout = self.timeout)
+                with tracer.span('caget_many', 'epics'):
+                    values = caget_many(self.read_list, timeout = self.timeout)
                 self.read_pvs = dict(zip(self.read_list, values))
             except Exception as e: 
                 print("Error getting EPICS variables:", e)
             #return {k:self.read_PVs[k].value for k in self.read_list}
         
+    def snapshot(self):
+        '''Copy of most recent values, from the cache if subscribed or the last poll, without waiting on EPICS'''
+        if self.enable and self.subscribe:
+            self.read_all()
+        with self.lock:
+            return dict(self.read_pvs)
+
     def write_event(self, event):
-        '''Write all new values from event to EPICS PVs
+        '''Queue all new values from event for the write thread to write to EPICS PVs, replacing any still waiting
         
         Arguments:
             event: Event class instance with values to write
         '''
-    
-        if self.enable:
-            try:
-                values = [event.__dict__[att] for key, att in self.write_atts.items()]
-                caput_many(self.write_atts.keys(), values, put_timeout = self.timeout)
-                #print("Tried to write to EPICS:", self.write_atts.keys(), values)
-            except Exception as e:    
-                print("Failed to put event data into EPICS server:", e)
-        else:
+        if not self.enable:
+            return
+        try:
+            values = {key:event.__dict__[att] for key, att in self.write_atts.items()}
+        except KeyError as e:
+            print("No event attribute to write to EPICS:", e)
             return
+        with self.writing:
+            self.pending.update(values)
+            for k in values:
+                self.tries.pop(k, None)
+            self.writing.notify()
+
+    def put_pending(self):
+        '''Write waiting values. Those that fail are kept to retry, unless newer values have been queued meanwhile,
+        and dropped once they have failed more than write_retries times.
+        
+        Returns:
+            True if none are left to retry
+        '''
+        with self.writing:
+            values = self.pending
+            self.pending = {}
+        try:
+            with tracer.span('caput_many', 'epics', pvs=len(values)):
+                status = caput_many(list(values.keys()), list(values.values()), connection_timeout = self.timeout, put_timeout = self.timeout)
+        except Exception as e:    
+            print("Failed to put event data into EPICS server:", e)
+            status = [-1]*len(values)
+        failed = {k:v for (k, v), stat in zip(values.items(), status) if stat != 1}
+        retry = False
+        with self.writing:
+            for k in values:
+                if k in self.pending:       # newer value queued, with its own tries
+                    continue
+                if k not in failed:
+                    self.tries.pop(k, None)
+                    continue
+                self.tries[k] = self.tries.get(k, 0) + 1
+                if self.tries[k] > self.write_retries:
+                    print(f"Gave up writing {k} to EPICS after {self.tries.pop(k)} tries.")
+                else:
+                    self.pending[k] = failed[k]
+                    retry = True
+        return not retry
+
+    def close(self):
+        '''Stop monitor and write threads'''
+        self.monitor_running = False
+        with self.writing:
+            self.write_running = False
+            self.writing.notify()
   
   
+class BeamSignal(QObject):
+    '''Carries beam current updates from channel access threads to the thread owning the events'''
+    update = pyqtSignal(float, float)      # beam current and local timestamp
+
+
 class MonitorThread(QThread):
     '''Thread class for monitor loop. Gets values from EPICS, then waits before doing it again.
     Args:
@@ -111,4 +258,27 @@ class MonitorThread(QThread):
         self.finished.emit()
 
 
-  
+class WriteThread(QThread):
+    '''Thread writing queued event values to EPICS, so an unresponsive server never holds up closing events.
+    Failed writes are retried every retry_time, each value up to write_retries times, then dropped.
+    Args:
+        parent: EPICS instance with pending values
+    '''
+    def __init__(self, parent):
+        QThread.__init__(self)
+        self.parent = parent
+
+    def run(self):
+        '''Main write loop'''
+        epics = self.parent
+        while True:
+            with epics.writing:
+                while epics.write_running and not epics.pending:
+                    epics.writing.wait()
+                if not epics.write_running:
+                    break
+            if epics.put_pending():
+                continue
+            with epics.writing:         # wait before retrying, unless closing
+                if epics.write_running:
+                    epics.writing.wait(epics.retry_time)
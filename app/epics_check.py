@@ -0,0 +1,120 @@
+'''PyNMR, check of EPICS monitoring, beam current integration and event writes against the soft IOC. Starts
+app.soft_ioc on this machine serving the channels of a config file, with steady beam and its clock skewed, runs an
+event for a while subscribed to the read channels, then checks every read channel updated, the event's average beam
+current matches the IOC's over nearly all of the event, and written values read back. Needs caproto. Run from the
+top directory:
+    python -m app.epics_check -c pynmr_config.yaml [-d duration_s] [-k skew_s]
+Exits with status 1 if any check fails.
+'''
+import os
+import sys
+import time
+import getopt
+import datetime
+import subprocess
+import yaml
+
+os.environ['EPICS_CA_ADDR_LIST'] = '127.0.0.1'      # only the soft IOC, set before channel access starts
+os.environ['EPICS_CA_AUTO_ADDR_LIST'] = 'NO'
+
+from PyQt5.QtCore import QCoreApplication, QTimer
+from epics import caget_many
+
+from app.classes import Config, Event
+from app.epics import EPICS
+
+
+class Owner():
+    '''Stand-in for the GUI or daemon owning the events, with what EPICS and Event use of it
+
+    Arguments:
+        config_dict: Dict of config file
+    '''
+    def __init__(self, config_dict):
+        self.settings = dict(config_dict['settings'])
+        self.settings['epics_settings'] = dict(self.settings['epics_settings'], enable=True, subscribe=True)
+        self.epics_reads = config_dict['epics_reads']
+        self.epics_writes = config_dict['epics_writes']
+        channel = config_dict['channels'][self.settings['default_channel']]
+        self.config = Config(channel, self.settings)
+        self.chassis_temp = 0
+        self.shimA, self.shimB, self.shimC, self.shimD = 0, 0, 0, 0
+        self.event = Event(self)
+
+
+def check(config_file, duration=10, skew=3600, beam=100):
+    '''Run event against soft IOC and check results
+
+    Returns:
+        List of failure messages, empty if all passed
+    '''
+    with open(config_file) as f:
+        config_dict = yaml.load(f, Loader=yaml.FullLoader)
+    ioc = subprocess.Popen([sys.executable, '-m', 'app.soft_ioc', '-c', config_file, '-u', '0.2', '-b', str(beam),
+                            '-s', '0', '-k', str(skew)], env=os.environ.copy())
+    failures = []
+    try:
+        time.sleep(3)           # server start
+        app = QCoreApplication.instance() or QCoreApplication([])
+        owner = Owner(config_dict)
+        epics = EPICS(owner)
+        time.sleep(1)           # channels connect, beam integration starts from the first update
+        owner.event = event = Event(owner)
+        QTimer.singleShot(int(duration*1000), app.quit)
+        app.exec_()
+
+        event.stop_time = datetime.datetime.now(tz=datetime.timezone.utc)
+        event.stop_stamp = event.stop_time.timestamp()
+        epics.end_beam(event)
+        missing = [k for k, (value, stamp) in epics.cache.items() if not stamp]
+        if missing:
+            failures.append(f"No updates from {', '.join(missing)}")
+        elapsed = event.stop_stamp - event.start_stamp
+        if event.beam_time_sum < 0.9*elapsed or event.beam_time_sum > elapsed + 0.01:
+            failures.append(f"Beam integrated over {event.beam_time_sum:.2f}s of {elapsed:.2f}s event")
+        average = event.beam_current_sum/event.beam_time_sum if event.beam_time_sum else 0
+        if abs(average - beam) > 0.05*beam:
+            failures.append(f"Average beam current {average:.2f}, IOC serving {beam}")
+        print(f"Beam {average:.2f} over {event.beam_time_sum:.2f}s of {elapsed:.2f}s, clock offset {min(epics.clock_offsets):.2f}s")
+
+        for i, att in enumerate(owner.epics_writes.values()):
+            event.__dict__[att] = i + 0.5
+        epics.write_event(event)
+        time.sleep(2)
+        epics.close()
+        names = list(owner.epics_writes.keys())
+        values = caget_many(names, timeout=1)
+        wrong = [k for k, v, i in zip(names, values, range(len(names))) if v is None or abs(v - (i + 0.5)) > 1e-6]
+        if wrong:
+            failures.append(f"Wrong values read back from {', '.join(wrong)}")
+    finally:
+        ioc.terminate()
+        ioc.wait()
+    return failures
+
+
+def main():
+    config_file = 'pynmr_config.yaml'
+    duration, skew = 10, 3600
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:d:k:")
+    except getopt.GetoptError:
+        print('Usage: python -m app.epics_check [-c <config_file>] [-d <duration_s>] [-k <skew_s>]')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print('Usage: python -m app.epics_check [-c <config_file>] [-d <duration_s>] [-k <skew_s>]')
+            sys.exit()
+        elif opt == '-c':
+            config_file = arg
+        elif opt == '-d':
+            duration = float(arg)
+        elif opt == '-k':
+            skew = float(arg)
+    failures = check(config_file, duration, skew)
+    print('\n'.join(failures) if failures else 'EPICS check passed.')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
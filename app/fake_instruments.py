@@ -0,0 +1,145 @@
+'''PyNMR, stand-in instruments answering on the TCP ports of a config file on this machine, so the instrument
+sessions and the tabs using them can be tried without the hall hardware. One server per port answers any of the
+line based commands PyNMR sends: settings are stored and read back by their query, per Prologix GPIB address and
+per supply channel, and the counter, power meter and RF switch reads get made up replies. Run from the top
+directory:
+    python -m app.fake_instruments -c pynmr_config.yaml
+then start PyNMR with a config that has the instrument ips set to 127.0.0.1. Ports below 1024 need root, or change
+them in both configs.
+'''
+import sys
+import math
+import time
+import random
+import getopt
+import threading
+import socketserver
+import yaml
+
+CHANNEL_SETTINGS = ['VOLT', 'CURR']        # settings kept per supply channel selected by INST:NSEL
+
+
+class FakeInstrument(socketserver.ThreadingTCPServer):
+    '''Server for one port, with the settings of all instruments behind it
+
+    Arguments:
+        port: TCP port to listen on
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.lock = threading.Lock()
+        self.settings = {}          # setting values keyed on (GPIB address, channel or None, command)
+        self.addr = None            # GPIB address selected by ++addr
+        self.channel = 1            # supply channel selected by INST:NSEL
+        self.connects = 0           # connections accepted, for checking reuse
+        self.commands = []          # all command lines received
+
+    def answer(self, line):
+        '''Carry out command line, which may be several SCPI commands joined by semicolons
+
+        Returns:
+            Reply bytes, or None if commands have no reply
+        '''
+        with self.lock:
+            self.commands.append(line)
+            replies = [reply for command in line.strip().split(';') if (reply := self.command(command.strip().lstrip(':'))) is not None]
+        if replies:
+            end = '\r' if replies[-1].endswith('\r') else '\n'
+            return (';'.join(reply.rstrip('\r\n') for reply in replies) + end).encode('ascii')
+        return None
+
+    def command(self, command):
+        '''Carry out single command
+
+        Returns:
+            Reply string, or None if command has no reply
+        '''
+        name, _, arg = command.partition(' ')
+        name, arg = name.upper(), arg.strip()
+        if name == '++ADDR':
+            self.addr = int(arg)
+        elif name.startswith('++'):
+            pass
+        elif name == 'INST:NSEL':
+            self.channel = int(arg)
+        elif name == '*IDN?':
+            return 'PyNMR,fake instrument,0,1\n'
+        elif name == '*OPC?':                               # settings take effect at once
+            return '1\n'
+        elif name == 'OU' and arg.upper() == 'DE':         # EIP counter displayed frequency, in Hz
+            return f"{int(136.6e9 + random.gauss(0, 1e5))}\r"
+        elif name == 'READ?':                               # ELVA-1 power meter
+            return f"{random.uniform(0.01, 0.02):.4f} W\n"
+        elif name.startswith('SET') and '=' in name:        # Minicircuits RF switch
+            return '1\n'
+        elif name.endswith('?'):
+            return f"{self.settings.get(self.key(name[:-1]), 0)}\n"
+        else:
+            if arg.upper() in ['ON', 'OFF']:                # states read back as 1 or 0
+                arg = '1' if arg.upper() == 'ON' else '0'
+            elif name == 'POW' and arg.upper().endswith('MV'):      # R&S reads back power in dBm
+                arg = f"{10*math.log10((float(arg[:-2])/1000)**2/50/0.001):.2f}"
+            self.settings[self.key(name)] = arg
+        return None
+
+    def key(self, name):
+        '''Settings key of command header, by channel only for the supply's per channel settings'''
+        return (self.addr, self.channel if name in CHANNEL_SETTINGS else None, name)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    '''Answer command lines on one connection until it closes'''
+    def handle(self):
+        with self.server.lock:
+            self.server.connects += 1
+        for line in self.rfile:
+            reply = self.server.answer(line.decode('ascii'))
+            if reply is not None:
+                self.wfile.write(reply)
+
+
+def instrument_ports(settings):
+    '''TCP ports of instruments enabled or used in config settings'''
+    return sorted({settings['RS_settings']['port'], settings['uWave_settings']['counter']['port'],
+                   settings['uWave_settings']['power_meter']['port'], settings['shim_settings']['port'],
+                   settings['rf_switch']['port'], settings['fm_settings']['port']})
+
+
+def main():
+    config_file = 'pynmr_config.yaml'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:")
+    except getopt.GetoptError:
+        print('Usage: python -m app.fake_instruments [-c <config_file>]')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print('Usage: python -m app.fake_instruments [-c <config_file>]')
+            sys.exit()
+        elif opt == '-c':
+            config_file = arg
+    with open(config_file) as f:
+        config_dict = yaml.load(f, Loader=yaml.FullLoader)
+    servers = []
+    for port in instrument_ports(config_dict['settings']):
+        try:
+            server = FakeInstrument(port)
+        except OSError as e:
+            print(f"Couldn't serve port {port}: {e}")
+            continue
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    print(f"Serving fake instruments on ports {', '.join(str(s.server_address[1]) for s in servers)}.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
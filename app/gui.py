@@ -9,25 +9,20 @@ import yaml
 import pytz
 import logging
 import json
+import importlib
 from PyQt5.QtWidgets import QMainWindow, QErrorMessage, QTabWidget, QLabel, QWidget, QDialog, QDialogButtonBox, QVBoxLayout
 from PyQt5.QtGui import QIntValidator, QDoubleValidator, QValidator
 from PyQt5.QtCore import QThread, pyqtSignal, Qt
 from logging.handlers import TimedRotatingFileHandler
 
-from app.classes import Config, Scan, RunningScan, Event, Baseline, HistPoint, History
+from app.classes import Config, Scan, RunningScan, Event, Baseline, HistPoint, History, StageTimings
+from app.trace import tracer
+from app.publisher import Publisher
+from app.render import RenderScheduler
 from app.epics import EPICS
+from app import instruments, labjacks
 from app.gui_run_tab import RunTab
-from app.gui_base_tab import BaseTab
-from app.gui_tune_tab import TuneTab
-from app.gui_te_tab import TETab
-from app.gui_superte_tab import SuperTab
 from app.gui_anal_tab import AnalTab
-from app.gui_expl_tab import ExplTab
-from app.gui_shim_tab import ShimTab
-from app.gui_fm_tab import FMTab
-from app.gui_compare_tab import CompareTab
-from app.gui_temp_tab import TempTab
-from app.gui_mag_tab import MagTab
 from app.daq import DAQConnection, UDP, TCP, RS_Connection, NI_Connection
 #from app.magnet_control import MagnetControl
 
@@ -71,6 +66,10 @@ class MainWindow(QMainWindow):
         self.label_changed('None')
         
         self.config = Config(channel_dict, self.settings)           # current configuration
+        self.timings = StageTimings()       # rolling record of time taken closing events
+        tracer.configure(self.settings['trace'])
+        self.publisher = Publisher(self.settings['publish'])      # stream of chunks and events to other programs
+        self.renderer = RenderScheduler(self.settings['render'])  # coalesces plot repaints as chunks come in
         self.event = Event(self)      # open empty event
         self.previous_event = self.event      # there is no previous event
         self.baseline = Baseline(self.config, {})     # open empty baseline
@@ -92,40 +91,80 @@ class MainWindow(QMainWindow):
         self.tab_widget = QTabWidget(self)
         self.setCentralWidget(self.tab_widget)
 
-        # Make tabs
+        # Make tabs. Run and Analysis are needed to take events, Shims and Chassis Temp read hardware into events,
+        # so they are built now. The rest are built when first shown, so their modules are only imported then.
+        self.lazy_tabs = {}     # dict of (attribute, module, class name) keyed on placeholder widgets of tabs not yet built
         self.run_tab = RunTab(self)
         self.tab_widget.addTab(self.run_tab, "Run")
-        self.tune_tab = TuneTab(self)
-        self.tab_widget.addTab(self.tune_tab, "Tune")
-        self.base_tab = BaseTab(self)
-        self.tab_widget.addTab(self.base_tab, "Baseline")
-        #self.mag_tab = MagTab(self)
-        #self.tab_widget.addTab(self.mag_tab, "Magnet")
-        self.te_tab = TETab(self)
-        self.tab_widget.addTab(self.te_tab, "TE")
-        #self.super_tab = SuperTab(self)
-        #self.tab_widget.addTab(self.super_tab, "Super TE")
+        self.add_lazy_tab('tune_tab', 'app.gui_tune_tab', 'TuneTab', "Tune")
+        self.add_lazy_tab('base_tab', 'app.gui_base_tab', 'BaseTab', "Baseline")
+        #self.add_lazy_tab('mag_tab', 'app.gui_mag_tab', 'MagTab', "Magnet")
+        self.add_lazy_tab('te_tab', 'app.gui_te_tab', 'TETab', "TE")
+        #self.add_lazy_tab('super_tab', 'app.gui_superte_tab', 'SuperTab', "Super TE")
         self.anal_tab = AnalTab(self)
         self.tab_widget.addTab(self.anal_tab, "Analysis")
         if self.config.settings['shim_settings']['enable']:
+            from app.gui_shim_tab import ShimTab
             self.shim_tab = ShimTab(self)
             self.tab_widget.addTab(self.shim_tab, "Shims")
         if self.config.settings['fm_settings']['enable']:
-            self.fm_tab = FMTab(self)
-            self.tab_widget.addTab(self.fm_tab, "FM")
+            self.add_lazy_tab('fm_tab', 'app.gui_fm_tab', 'FMTab', "FM")
         if self.config.settings['compare_tab']['enable']:
-            self.compare_tab = CompareTab(self)
-            self.tab_widget.addTab(self.compare_tab, "Compare")
+            self.add_lazy_tab('compare_tab', 'app.gui_compare_tab', 'CompareTab', "Compare")
         if self.config.settings['temp_settings']['enable']:
+            from app.gui_temp_tab import TempTab
             self.temp_tab = TempTab(self)
             self.tab_widget.addTab(self.temp_tab, "Chassis Temp")
         if self.config.settings['explorer']['enable']:
-            self.expl_tab = ExplTab(self)
-            self.tab_widget.addTab(self.expl_tab, "Event Explorer")         
+            self.add_lazy_tab('expl_tab', 'app.gui_expl_tab', 'ExplTab', "Event Explorer")
+        if self.config.settings['daemon']['attach']:
+            self.add_lazy_tab('daemon_tab', 'app.gui_daemon_tab', 'DaemonTab', "Daemon")
+        self.tab_widget.currentChanged.connect(self.build_tab)
         
         self.set_cc(self.restore_dict['cc'])   
         self.connect_daq()
         
+    def add_lazy_tab(self, attr, module, name, title):
+        '''Add placeholder for tab to be built on first showing
+
+        Args:
+            attr: Attribute name the tab will have on this window
+            module: Module containing tab class, imported when built
+            name: Tab class name
+            title: Tab title
+        '''
+        placeholder = QWidget()
+        self.lazy_tabs[placeholder] = (attr, module, name)
+        self.tab_widget.addTab(placeholder, title)
+
+    def build_tab(self, index):
+        '''Tab shown: if it is a placeholder, import and build the tab it stands for and swap it in'''
+        placeholder = self.tab_widget.widget(index)
+        if placeholder not in self.lazy_tabs:
+            return
+        attr, module, name = self.lazy_tabs.pop(placeholder)
+        start = time.perf_counter()
+        tab = getattr(importlib.import_module(module), name)(self)
+        setattr(self, attr, tab)
+        self.tab_widget.blockSignals(True)
+        title = self.tab_widget.tabText(index)
+        self.tab_widget.removeTab(index)
+        self.tab_widget.insertTab(index, tab, title)
+        self.tab_widget.setCurrentIndex(index)
+        self.tab_widget.blockSignals(False)
+        placeholder.deleteLater()
+        running = self.run_tab.run_button.isChecked()
+        if attr == 'tune_tab':      # set buttons as run_toggle would, with run button enabled only if the DAQ connected
+            tab.run_button.setEnabled(self.run_tab.run_button.isEnabled() and not running)
+            tab.auto_button.setEnabled(self.run_tab.run_button.isEnabled() and not running)
+            for widget in [tab.phase_spin, tab.phase_slider, tab.diode_spin, tab.diode_slider]:
+                widget.setEnabled(not running)
+        elif attr == 'compare_tab':
+            tab.run_button.setEnabled(not running)
+        if hasattr(tab, 'update_event_plots'):
+            tab.update_event_plots()
+        logging.info(f"Built {title} tab in {time.perf_counter() - start:.2f}s.")
+
     def load_settings(self):
         '''Load settings from YAML config file'''
 
@@ -203,24 +242,33 @@ class MainWindow(QMainWindow):
     def epics_update(self, event):
         '''Writes current event data to EPICS and reads status variables from EPICS.
         '''        
-        self.epics.write_event(event)
-        self.epics.read_all()
-        event.epics = self.epics.read_pvs     # Put recently read EPICS variables in event
+        self.epics.end_beam(event)
+        self.epics.write_event(event)       # queued, written by EPICS write thread
+        event.epics = self.epics.snapshot()     # Put most recent EPICS values in event
     
     def end_finished(self):
         '''Analysis thread has returned. Finish up closing event, closing the event instance and calling updates for each tab. Updates plots, prints to file, makes new eventfile if lines are more than 500.'''
-                
-        self.previous_event.print_event(self.eventfile)
+        event = self.previous_event
+        
+        with self.timings.stage('print_event', event):   # timings after this stage aren't in the eventfile record
+            self.previous_event.print_event(self.eventfile)
         self.eventfile_lines += 1
         if self.eventfile_lines > 500:            # open new eventfile once the current one has a number of entries
             self.new_eventfile()
-        self.history.add_hist(HistPoint(self.previous_event), self.hist_file)
-
-        self.run_tab.update_event_plots()
-        self.te_tab.update_event_plots()
-        self.anal_tab.update_event_plots() 
-        if self.config.settings['compare_tab']['enable']:
-            self.compare_tab.update_event_plots()      
+        with self.timings.stage('add_hist', event):
+            self.history.add_hist(HistPoint(self.previous_event), self.hist_file)
+        self.publisher.event(event)
+
+        with self.timings.stage('run_plots', event):
+            self.run_tab.update_event_plots()
+        if hasattr(self, 'te_tab'):
+            with self.timings.stage('te_plots', event):
+                self.te_tab.update_event_plots()
+        with self.timings.stage('anal_plots', event):
+            self.anal_tab.update_event_plots() 
+        if hasattr(self, 'compare_tab'):
+            with self.timings.stage('compare_plots', event):
+                self.compare_tab.update_event_plots()      
         
         now = datetime.datetime.now(tz=datetime.timezone.utc)
         elapsed = now.timestamp() - self.start_end.timestamp() 
@@ -230,9 +278,12 @@ class MainWindow(QMainWindow):
         logging.info(mes)
         
         if self.config.settings["ss_dir"]:
-            screenshot = self.run_tab.grab()
-            now = datetime.datetime.now(tz=datetime.timezone.utc)
-            screenshot.save(f'{self.config.settings["ss_dir"]}/{now.strftime("%Y-%m-%d_%H-%M-%S")}.png')
+            with self.timings.stage('screenshot', event):
+                screenshot = self.run_tab.grab()
+                now = datetime.datetime.now(tz=datetime.timezone.utc)
+                screenshot.save(f'{self.config.settings["ss_dir"]}/{now.strftime("%Y-%m-%d_%H-%M-%S")}.png')
+        self.anal_tab.update_timings()
+        tracer.dump()
           
 
     def new_base(self, basedict):
@@ -267,14 +318,14 @@ class MainWindow(QMainWindow):
         name = self.channels[i]
         self.config = Config(self.config_dict['channels'][name], self.settings)           # new configuration
         self.event = Event(self)      # open empty event
-        self.rs = RS_Connection(self.config)   # send new settings to R&S
+        self.rs.configure(self.config)   # send new settings to R&S, on its thread
         logging.info(f"Changed channel to {self.config.channel['name']}.")
 
     def init_connects(self):
         '''Initialize connections to required instruments, EPICS server
         '''      
         self.epics = EPICS(self)  # open EPICS
-        self.rs = RS_Connection(self.config)            # open connection to Rohde and Schwarz, set stuff        
+        self.rs = RS_Connection(self.config)            # start thread sending settings to Rohde and Schwarz        
 
     def connect_daq(self):
         '''Try test connect to DAQ devices, turn on run buttons if successful'''
@@ -284,7 +335,9 @@ class MainWindow(QMainWindow):
             logging.info(self.daq.message)
 
             self.run_tab.run_button.setEnabled(True)                   # turn on buttons
-            self.tune_tab.run_button.setEnabled(True)
+            if hasattr(self, 'tune_tab'):
+                self.tune_tab.run_button.setEnabled(True)
+                self.tune_tab.auto_button.setEnabled(True)
             #self.run_tab.connect_button.setEnabled(False)
             #self.run_tab.connect_button.setText('Connected: '+self.daq.name)
 
@@ -297,7 +350,9 @@ class MainWindow(QMainWindow):
         '''DAQ has been disconnected, reset buttons'''
 
         self.run_tab.run_button.setEnabled(False)                   # turn on buttons
-        self.tune_tab.run_button.setEnabled(False)
+        if hasattr(self, 'tune_tab'):
+            self.tune_tab.run_button.setEnabled(False)
+            self.tune_tab.auto_button.setEnabled(False)
         self.run_tab.connect_button.setEnabled(True)
         self.run_tab.connect_button.setText('Connect')
 
@@ -305,23 +360,27 @@ class MainWindow(QMainWindow):
     def run_toggle(self):
         '''Disable or enable buttons on other tabs when one tab is running'''
         if self.run_tab.run_button.isChecked():
-            self.tune_tab.run_button.setEnabled(False)
-            self.tune_tab.phase_spin.setEnabled(False)
-            self.tune_tab.phase_slider.setEnabled(False)
-            self.tune_tab.diode_spin.setEnabled(False)
-            self.tune_tab.diode_slider.setEnabled(False)
-            if self.config.settings['compare_tab']['enable']:
+            if hasattr(self, 'tune_tab'):
+                self.tune_tab.run_button.setEnabled(False)
+                self.tune_tab.auto_button.setEnabled(False)
+                self.tune_tab.phase_spin.setEnabled(False)
+                self.tune_tab.phase_slider.setEnabled(False)
+                self.tune_tab.diode_spin.setEnabled(False)
+                self.tune_tab.diode_slider.setEnabled(False)
+            if hasattr(self, 'compare_tab'):
                 if not self.compare_tab.compare_on:
                     self.compare_tab.run_button.setEnabled(False)
         else:
-            self.tune_tab.run_button.setEnabled(True)
-            self.tune_tab.phase_spin.setEnabled(True)
-            self.tune_tab.phase_slider.setEnabled(True)
-            self.tune_tab.diode_spin.setEnabled(True)
-            self.tune_tab.diode_slider.setEnabled(True)
-            if self.config.settings['compare_tab']['enable']:
+            if hasattr(self, 'tune_tab'):
+                self.tune_tab.run_button.setEnabled(True)
+                self.tune_tab.auto_button.setEnabled(True)
+                self.tune_tab.phase_spin.setEnabled(True)
+                self.tune_tab.phase_slider.setEnabled(True)
+                self.tune_tab.diode_spin.setEnabled(True)
+                self.tune_tab.diode_slider.setEnabled(True)
+            if hasattr(self, 'compare_tab'):
                 self.compare_tab.run_button.setEnabled(True)
-        if self.tune_tab.run_button.isChecked():
+        if hasattr(self, 'tune_tab') and (self.tune_tab.run_button.isChecked() or self.tune_tab.auto_button.isChecked()):
             self.run_tab.run_button.setEnabled(False)
         else:
             self.run_tab.run_button.setEnabled(True)
@@ -369,17 +428,28 @@ class MainWindow(QMainWindow):
         '''Things to do on close of window ("events" here are not related to nmr data events)
         '''
         self.hist_file.close()    
+        tracer.dump()
         if self.run_tab.run_button.isChecked():
             self.dlg = ExitDialog()
             if self.dlg.exec():
-                self.epics.monitor_running = False
+                self.epics.close()
+                self.publisher.close()
+                self.rs.close()
+                instruments.close_all()
+                labjacks.close_all()
+                self.anal_tab.close_pools()
                 self.close_eventfile()
                 self.save_session()
                 event.accept()
             else: 
                 event.ignore()  
         else:
-            self.epics.monitor_running = False
+            self.epics.close()
+            self.publisher.close()
+            self.rs.close()
+            instruments.close_all()
+            labjacks.close_all()
+            self.anal_tab.close_pools()
             self.close_eventfile()
             self.save_session()
             event.accept()
@@ -1,12 +1,11 @@
 '''PyNMR, J.Maxwell 2020
 '''
 import numpy as np
-from scipy import optimize
-from PyQt5.QtWidgets import QWidget, QLabel, QGroupBox, QHBoxLayout, QVBoxLayout, QGridLayout, QLineEdit, QSpacerItem, QSizePolicy, QComboBox, QPushButton, QProgressBar, QStackedWidget, QDoubleSpinBox
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtWidgets import QWidget, QLabel, QGroupBox, QHBoxLayout, QVBoxLayout, QGridLayout, QLineEdit, QSpacerItem, QSizePolicy, QComboBox, QPushButton, QProgressBar, QStackedWidget, QDoubleSpinBox, QTableWidget, QTableWidgetItem, QHeaderView
 import pyqtgraph as pg
-from lmfit import Model
 
-from app.deuteron_fits import DFits
+from app.analysis import range_mask, estimate, gaussian, gaussian_jac, sum_gaussians, sum_gaussians_jac, polyfit_wings, sum_all, sum_range, peak_height, deuteron_pol, DeuteronFitter
 
 class AnalTab(QWidget):
     '''Creates analysis tab. '''
@@ -31,6 +30,13 @@ class AnalTab(QWidget):
         self.base_chosen = None
         self.sub_chosen = None
         self.res_chosen = None
+        self.res_index = 0
+        
+        self.res_multi = self.event.config.settings['analysis']['res_multi']
+        if self.res_multi['enable']:            # pool to run several results methods for each event
+            self.res_pool = ThreadPoolExecutor(max_workers=self.res_multi['workers'])
+        else:
+            self.res_pool = None
         
         
         self.main = QHBoxLayout()            # main layout
@@ -67,6 +73,15 @@ class AnalTab(QWidget):
         self.res_box.layout().addWidget(self.res_combo)
         self.res_stack = QStackedWidget()    
         self.res_box.layout().addWidget(self.res_stack)
+        
+        # Diagnostics Box
+        self.diag_box = QGroupBox('Diagnostics: Stage Timing (ms)')
+        self.diag_box.setLayout(QVBoxLayout())
+        self.left.addWidget(self.diag_box)
+        self.diag_table = QTableWidget(0, 4)
+        self.diag_table.setHorizontalHeaderLabels(['Last', 'p50', 'p95', 'Max'])
+        self.diag_table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.diag_box.layout().addWidget(self.diag_table)
 
         # Right Side
         self.right = QVBoxLayout() 
@@ -120,8 +135,8 @@ class AnalTab(QWidget):
         self.base_opts = []
         self.base_opts.append(StandardBase(self))   
         self.base_opts.append(PolyFitBase(self))  
-        # self.base_opts.append(CircuitBase(self))   Not ready for prime time
         self.base_opts.append(NoBase(self))        
+        self.base_opts.append(CircuitBase(self))
         for o in self.base_opts:
             self.base_combo.addItem(o.name)
             self.base_stack.addWidget(o)
@@ -170,12 +185,67 @@ class AnalTab(QWidget):
         self.run_analysis()
         
     def change_res(self, i):
-        '''Set res_chosen to desired subtraction class instance
+        '''Set res_chosen to desired subtraction class instance. If the result was already stored for this event, show it instead of running analysis.
         '''
-        self.res_chosen = self.res_opts[i].result
+        self.res_index = i
+        self.res_chosen = self.multi_result if self.res_pool else self.res_opts[i].result
         self.res_opts[i].switch_here()
         self.res_stack.setCurrentIndex(i)
-        self.run_analysis()
+        if self.res_opts[i].name in self.parent.previous_event.res_curves:
+            self.show_stored(self.res_opts[i].name)
+        else:
+            self.run_analysis()
+            
+    def multi_result(self, event):
+        '''Run chosen results method along with those configured in res_multi on the worker pool, storing area and pol from each in the event.
+        A method that fails is stored with NaN area and pol and its error, and if it is the chosen one, its result is NaN too.
+        Each method's message is stored with its results, and only shown for the chosen method, by update_event_plots on the GUI thread.
+        
+        Arguments:
+            event: Event instance with fit subtracted sweep
+            
+        Returns:
+            result curve, area and polarization from chosen method
+        '''
+        indices = set(self.res_multi['methods']) | {self.res_index}
+        futures = {self.res_opts[i].name : self.res_pool.submit(self.res_opts[i].result, event) for i in sorted(indices) if i < len(self.res_opts)}
+        results, res_curves = {}, {}
+        for name, future in futures.items():
+            try:
+                curve, area, pol = future.result()
+                res_curves[name] = curve
+                results[name] = {'area' : float(area), 'pol' : float(pol), 'message' : self.res_opt(name).text}
+            except Exception as e:
+                print(f'Exception in results method {name}: {e}')
+                res_curves[name] = np.full(len(event.fitsub), np.nan)
+                results[name] = {'area' : np.nan, 'pol' : np.nan, 'error' : str(e), 'message' : f'Failed: {e}'}
+        event.results, event.res_curves = results, res_curves
+        chosen = self.res_opts[self.res_index].name
+        return res_curves[chosen], results[chosen]['area'], results[chosen]['pol']
+        
+    def res_opt(self, name):
+        '''Results method instance with name'''
+        return next(o for o in self.res_opts if o.name == name)
+
+    def show_message(self):
+        '''Show message of chosen results method for the analyzed event, stored with its results if run with others'''
+        opt = self.res_opts[self.res_index]
+        stored = self.parent.previous_event.results.get(opt.name, {})
+        opt.message.setText(stored.get('message', opt.text))
+
+    def close_pools(self):
+        '''Shut down deuteron fit worker processes, on exit'''
+        for opt in self.res_opts:
+            if getattr(opt, 'fitter', None):
+                opt.fitter.close()
+
+    def show_stored(self, name):
+        '''Show result already stored in the event for the named results method, without running analysis'''
+        event = self.parent.previous_event
+        event.rescurve = event.res_curves[name]
+        event.area, event.pol = event.results[name]['area'], event.results[name]['pol']
+        self.parent.run_tab.update_event_plots()
+        self.update_event_plots()
             
     def run_analysis(self):
         '''Run event signal analysis and call for new plots if base and sub methods are chosen'''
@@ -199,6 +269,16 @@ class AnalTab(QWidget):
         
         self.unc_plot.setData(self.event.scan.freq_list, self.event.fitsub)
         self.res_plot.setData(self.event.scan.freq_list, self.event.rescurve)
+        self.show_message()
+        
+    def update_timings(self):
+        '''Update diagnostics table with rolling statistics of time taken by each stage of closing events'''
+        stats = self.parent.timings.stats()
+        self.diag_table.setRowCount(len(stats))
+        self.diag_table.setVerticalHeaderLabels(list(stats.keys()))
+        for i, stat in enumerate(stats.values()):
+            for j, key in enumerate(['last', 'p50', 'p95', 'max']):
+                self.diag_table.setItem(i, j, QTableWidgetItem(f"{stat[key]*1000:.1f}"))
         
 class StandardBase(QWidget):
     '''Layout and method for standard baseline subtract based on selected baseline from baseline tab.  Base type.
@@ -281,15 +361,7 @@ class PolyFitBase(QWidget):
     
     def change_poly(self, i):
         '''Choose polynomial order method'''
-        if i==0:
-            self.poly = self.poly2
-            self.pi = [0.01, 0.8, 0.01]
-        elif i==1:
-            self.poly = self.poly3
-            self.pi = [0.01, 0.8, 0.01, 0.001]
-        elif i==2:
-            self.poly = self.poly4
-            self.pi = [0.01, 0.8, 0.01, 0.001, 0.00001]
+        self.order = [2, 3, 4][i]
         self.parent.run_analysis()
     
     def change_wings(self):
@@ -316,38 +388,18 @@ class PolyFitBase(QWidget):
             polyfit used, baseline subtracted sweep 
         '''
         sweep = event.scan.phase
-        freqs = event.scan.freq_list
-        bounds = [x*len(sweep) for x in self.wings]
-        data = [z for x,z in enumerate(zip(freqs, sweep)) if (bounds[0]<x<bounds[1] or bounds[2]<x<bounds[3])]
-        X = np.array([x for x,y in data])
-        Y = np.array([y for x,y in data])
-        pf, pcov = optimize.curve_fit(self.poly, X, Y, p0 = self.pi)
-        pstd = np.sqrt(np.diag(pcov))
-        fit = self.poly(freqs, *pf)
-        sub = sweep - fit
-        
-        residuals = Y - self.poly(X, *pf)
-        ss_res = np.sum(residuals**2)
-        ss_tot = np.sum((Y - np.mean(Y))**2)
-        r_squared = 1 - (ss_res / ss_tot)        
-        
+        fit, pf, pstd, r_squared = polyfit_wings(event.scan.freq_list, sweep, self.wings, self.order)
         text_list = [f"{f:.2e} ± {s:.2e}" for f, s in zip(pf, pstd)]
         self.message.setText(f"Fit coefficients: \t \t \t R-squared: {r_squared:.2f}\n"+"\n".join(text_list))
-        return fit, sub
-        
-    def poly2(self, x, *p): return p[0] + p[1]*x + p[2]*np.power(x,2)   
-        
-    def poly3(self, x, *p): return p[0] + p[1]*x + p[2]*np.power(x,2) + p[3]*np.power(x,3) 
-        
-    def poly4(self, x, *p): return p[0] + p[1]*x + p[2]*np.power(x,2) + p[3]*np.power(x,3) + p[4]*np.power(x,4)
+        return fit, sweep - fit
         
 
    
 class CircuitBase(QWidget):
     '''Layout for circuit model fit to the background wings, including methods to produce fits.  Base type.
     
-    NOT IMPLEMENTED. Fits not quite converging, slow.
-    
+    The Q-curve is evaluated as complex arrays over the whole sweep and fit by bounded least squares with an
+    analytic Jacobian. See benchmarks/bench_circuit_base.py for timing.
     '''
     
     def __init__(self, parent):
@@ -355,6 +407,14 @@ class CircuitBase(QWidget):
         self.parent = parent
         self.name = "Circuit Model Fit"
         self.wings = self.parent.event.config.settings['analysis']['wings']
+        
+        # fit parameters in order: cap (pF), phase (deg), coil_l (nH), offset, scale
+        coil_l = 30
+        cent_freq = self.parent.event.config.channel['cent_freq']
+        cap = 1/(np.power(2*np.pi*cent_freq*1e6, 2)*coil_l*1e-9)*1e12   # resonant at center frequency
+        self.lower = np.array([1.0, -180, 1.0, -10, 4.99])
+        self.upper = np.array([max(60.0, 2*cap), 180, 120, 10, 5.001])
+        self.pi = np.clip([cap, -140, coil_l, 0.19, 5], self.lower, self.upper)
                         
         self.space = QVBoxLayout()
         self.setLayout(self.space)        
@@ -379,8 +439,8 @@ class CircuitBase(QWidget):
     
     def switch_here(self):
         '''Things to do when this stack is chosen'''
-        self.parent.base_region1.setBrush(pg.mkBrush(0, 0, 180, 0))
-        self.parent.base_region2.setBrush(pg.mkBrush(0, 0, 180, 0))
+        self.parent.base_region1.setBrush(pg.mkBrush(0, 0, 180, 20))
+        self.parent.base_region2.setBrush(pg.mkBrush(0, 0, 180, 20))
             
     def change_wings(self):
         '''Choose fit frequency bounds'''
@@ -406,38 +466,40 @@ class CircuitBase(QWidget):
             fit used, baseline subtracted sweep 
         '''
         sweep = event.scan.phase
-        bounds = [x*len(sweep) for x in self.wings]
-        data = [(x,y) for x,y in enumerate(sweep) if (bounds[0]<x<bounds[1] or bounds[2]<x<bounds[3])]
-        f = np.array([x for x,y in data])
-        Y = np.array([y for x,y in data])        
-            
-        mod = Model(self.real_curve)
-        params = mod.make_params()
-        params.add('cap', value=18.62, min=1.0, max=60.0)
-        params.add('phase', value=-140, min=-180, max=180)
-        params.add('coil_l', value=30, min=1.0, max=120)
-        params.add('offset', value=0.19, min=-10, max=10)
-        params.add('scale', value=5, min=4.99, max=5.001)
-                
-        result = mod.fit(Y, params, f=f)
-        #print(result.best_values)      
-        fit = self.real_curve(range(len(event.scan.phase)), **result.best_values)
+        freqs = event.scan.freq_list
+        x = np.arange(len(sweep))
+        bounds = [w*len(sweep) for w in self.wings]
+        mask = ((bounds[0]<x) & (x<bounds[1])) | ((bounds[2]<x) & (x<bounds[3]))
+        f = freqs[mask]
+        Y = sweep[mask]
+        
+        # cap and coil_l are nearly degenerate over a narrow sweep, so stop on cost rather than parameter steps
+        from scipy import optimize
+        res = optimize.least_squares(lambda p: self.real_curve(f, *p) - Y, self.pi, jac=lambda p: self.real_jac(f, *p),
+                                     bounds=(self.lower, self.upper), x_scale='jac', ftol=1e-6, max_nfev=100)
+        fit = self.real_curve(freqs, *res.x)
         sub = sweep - fit
-        #text_list = [f"{f:.2e} ± {s:.2e}" for f, s in zip(pf, pstd)]
-        #self.message.setText("Fit coefficients:\n"+"\n".join(text_list))
+        
+        ss_res = np.sum(res.fun**2)
+        ss_tot = np.sum((Y - np.mean(Y))**2)
+        r_squared = 1 - (ss_res / ss_tot)
+        names = ['Capacitance (pF)', 'Phase (deg)', 'Coil L (nH)', 'Offset', 'Scale']
+        text_list = [f"{n}: {v:.3e}" for n, v in zip(names, res.x)]
+        self.message.setText(f"Fit parameters: \t \t \t R-squared: {r_squared:.2f}\n"+"\n".join(text_list))
         return fit, sub
 
-    def full_curve(self, f, cap, phase, coil_l):
+    def full_curve(self, f, cap, phase, coil_l, derivs=False):
         '''
         Returns full complex voltage out of Q-curve.  
         
         Arguments:
-            f: frequency f in MHz
+            f: frequency f in MHz, float or Numpy array
             cap: tuning capacitance in pF
             phase: phase in degrees
             coil_l: coil inductance in nanoHenries
+            derivs: if True, also return derivatives of v_out with respect to cap, phase and coil_l
         '''
-        w = 2*np.pi*f*1e6         # angular frequency 
+        w = 2*np.pi*np.asarray(f)*1e6         # angular frequency 
         c = cap*1e-12             # Cap in F
         u = 0.6                   # Input RF voltage
         r_cc = 681                # Constant current resistor
@@ -448,27 +510,37 @@ class CircuitBase(QWidget):
         r_amp = 50                # Impedance of detector
         r = 10                    # Damping resistor
 
-        zc = 1/np.complex(0,w*c)                     # impedance of cap
-        zc_stray = 1/np.complex(0,w*c_stray)         # impedance of stray cap
-        zl_pure  = np.complex(r_coil,w*l_coil)       # impedance of coil only
+        zc = 1/(1j*w*c)                              # impedance of cap
+        zc_stray = 1/(1j*w*c_stray)                  # impedance of stray cap
+        zl_pure  = r_coil + 1j*w*l_coil              # impedance of coil only
         zl = zl_pure*zc_stray/(zl_pure+zc_stray)     # impedance of coil and stray capacitance
         z_leg = r + zc + zl                          # impedance of the damping resistor, cap, coil
         z_tot = r_amp/(1+r_amp/z_leg)                # total impedance of coil, trans line and detector (voltage divider)
 
         phi = phase*np.pi/180                        # phase bet. constant current and output voltage
-        v_out = i*z_tot*np.exp(np.complex(0,phi))
-        return (v_out)
+        v_out = i*z_tot*np.exp(1j*phi)
+        if not derivs:
+            return v_out
+        
+        dv_dleg = i*np.exp(1j*phi)*np.power(r_amp/(z_leg+r_amp), 2)     # chain rule through the voltage divider
+        dv_dcap = dv_dleg*(-zc/c)*1e-12
+        dv_dphase = 1j*v_out*np.pi/180
+        dv_dcoil = dv_dleg*np.power(zc_stray/(zl_pure+zc_stray), 2)*1j*w*1e-9
+        return v_out, dv_dcap, dv_dphase, dv_dcoil
         
     def mag_curve(self, f, cap, phase, coil_l, offset=0, scale=1):
-        ''' Passed list of frequency points, calls full_curve at each point to get magnitude of Q-curve'''
-        v_out = [np.absolute(self.full_curve(k, cap, phase, coil_l)) for k in f]
-        return ([vout*scale+offset for vout in v_out])
+        ''' Passed array of frequency points, returns magnitude of Q-curve'''
+        return np.absolute(self.full_curve(f, cap, phase, coil_l))*scale + offset
         
     def real_curve(self, f, cap, phase, coil_l, offset=0, scale=1):
-        ''' Passed list of frequency points, calls full_curve at each point to get real portion of Q-curve'''
-        v_out = [-np.real(self.full_curve(k, cap, phase, coil_l)) for k in f]
-        return ([vout*scale+offset for vout in v_out])
-
+        ''' Passed array of frequency points, returns real portion of Q-curve'''
+        return -np.real(self.full_curve(f, cap, phase, coil_l))*scale + offset
+        
+    def real_jac(self, f, cap, phase, coil_l, offset=0, scale=1):
+        ''' Jacobian of real_curve with respect to (cap, phase, coil_l, offset, scale), one row per frequency point'''
+        v_out, dv_dcap, dv_dphase, dv_dcoil = self.full_curve(f, cap, phase, coil_l, derivs=True)
+        return np.column_stack((-np.real(dv_dcap)*scale, -np.real(dv_dphase)*scale, -np.real(dv_dcoil)*scale,
+                                np.ones(len(v_out)), -np.real(v_out)))
 
 
 class NoBase(QWidget):
@@ -542,21 +614,7 @@ class PolyFitSub(QWidget):
         self.space.layout().addWidget(self.message)
     def change_poly(self, i):
         '''Choose polynomial order method'''
-        if i==0:
-            self.poly = self.poly2
-            self.pi = [0.01, 0.8, 0.01]
-        elif i==1:
-            self.poly = self.poly3
-            self.pi = [0.01, 0.8, 0.01, 0.001]
-        elif i==2:
-            self.poly = self.poly4
-            self.pi = [0.01, 0.8, 0.01, 0.001, 0.00001]
-        elif i==3:
-            self.poly = self.poly6
-            self.pi = [0.01, 0.8, 0.01, 0.001, 0.00001, 0.00001, 0.00001]
-        elif i==4:
-            self.poly = self.poly8
-            self.pi = [0.01, 0.8, 0.01, 0.001, 0.00001, 0.00001, 0.00001, 0.00001, 0.00001]
+        self.order = [2, 3, 4, 6, 8][i]
         self.parent.run_analysis()        
     
     def switch_here(self):
@@ -590,39 +648,10 @@ class PolyFitSub(QWidget):
         '''
         
         sweep = event.basesub
-        freqs = event.scan.freq_list
-        bounds = [x*len(sweep) for x in self.wings]
-        data = [z for x,z in enumerate(zip(freqs, sweep)) if (bounds[0]<x<bounds[1] or bounds[2]<x<bounds[3])]
-        X = np.array([x for x,y in data])
-        Y = np.array([y for x,y in data])
-        pf, pcov = optimize.curve_fit(self.poly, X, Y, p0 = self.pi)    
-        try:
-            pstd = np.sqrt(np.diag(pcov))
-        except:
-            pass
-        fit = self.poly(freqs, *pf)
-        sub = sweep - fit
-        
-        area = sub.sum()
-        
-        residuals = Y - self.poly(X, *pf)
-        ss_res = np.sum(residuals**2)
-        ss_tot = np.sum((Y - np.mean(Y))**2)
-        r_squared = 1 - (ss_res / ss_tot)    
-        
+        fit, pf, pstd, r_squared = polyfit_wings(event.scan.freq_list, sweep, self.wings, self.order)
         text_list = [f"{f:.2e} ± {s:.2e}" for f, s in zip(pf, pstd)]
         self.message.setText(f"Fit coefficients: \t \t \t R-squared: {r_squared:.2f}\n"+"\n".join(text_list))
-        return fit, sub
-        
-    def poly2(self, x, *p): return p[0] + p[1]*x + p[2]*np.power(x,2)   
-        
-    def poly3(self, x, *p): return p[0] + p[1]*x + p[2]*np.power(x,2) + p[3]*np.power(x,3) 
-        
-    def poly4(self, x, *p): return p[0] + p[1]*x + p[2]*np.power(x,2) + p[3]*np.power(x,3) + p[4]*np.power(x,4)
-    
-    def poly6(self, x, *p): return p[0] + p[1]*x + p[2]*np.power(x,2) + p[3]*np.power(x,3) + p[4]*np.power(x,4)+ p[5]*np.power(x,5)+ p[6]*np.power(x,6)
-    
-    def poly8(self, x, *p): return p[0] + p[1]*x + p[2]*np.power(x,2) + p[3]*np.power(x,3) + p[4]*np.power(x,4)+ p[5]*np.power(x,5)+ p[6]*np.power(x,6)+ p[7]*np.power(x,7)+ p[8]*np.power(x,8)
+        return fit, sweep - fit
         
 
 
@@ -668,6 +697,7 @@ class SumAllRes(QWidget):
         self.poly_label = QLabel("Sum Full Range")
         self.space.addWidget(self.poly_label)
         self.message = QLabel()
+        self.text = ''     # message from last result, shown on the GUI thread
         self.space.layout().addWidget(self.message)
     
     def switch_here(self):
@@ -677,13 +707,9 @@ class SumAllRes(QWidget):
     def result(self, event):        
         '''Only performs sum
         '''
-        sweep = event.fitsub
-        fitcurve = np.zeros(len(sweep))
-        sub = sweep - fitcurve
-        area = sub.sum()
+        data, area = sum_all(event)
         pol = area*event.cc
-        self.message.setText(f"Area: {area}")
-        data = [0 for x in event.config.freq_list]
+        self.text = f"Area: {area}"
         return data, area, pol
         
 
@@ -714,6 +740,7 @@ class SumRangeRes(QWidget):
             self.grid2.addWidget(self.bounds_sb[i], 0, i+1)
         self.change_wings()    
         self.message = QLabel()
+        self.text = ''     # message from last result, shown on the GUI thread
         self.space.layout().addWidget(self.message)
          
     def switch_here(self):
@@ -731,25 +758,22 @@ class SumRangeRes(QWidget):
         
         bounds = [w*(max-min)+min for w in self.wings]  
         self.parent.res_region.setRegion(bounds)
+        self.mask = range_mask(len(self.parent.parent.event.scan.freq_list), self.wings)
         self.parent.run_analysis()   
-     
+        
     def result(self, event):
-        '''Perform standard polyfit baseline subtraction
+        '''Sum fit subtracted signal within range
         
         Arguments:
-            event: Event instance with sweeps to subtract
+            event: Event instance with sweeps to sum
             
         Returns:
-            polyfit used, baseline subtracted sweep 
+            signal within range, area and polarization
         '''
     
-        sweep = event.fitsub
-        bounds = [x*len(sweep) for x in self.wings]
-        data = [(x,y) if bounds[0]<x<bounds[1] else (x,0) for x,y in enumerate(sweep)]
-        Y = np.array([y for x,y in data])
-        area = Y.sum()
+        Y, area = sum_range(event, self.wings, self.mask)
         pol = area*event.cc
-        self.message.setText(f"Area: {area}")
+        self.text = f"Area: {area}"
         return Y, area, pol
         
 class PeakHeightRes(QWidget):
@@ -765,6 +789,7 @@ class PeakHeightRes(QWidget):
         self.poly_label = QLabel("When using this method, the peak height replaces\nthe area throughout the application.")
         self.space.addWidget(self.poly_label)
         self.message = QLabel()
+        self.text = ''     # message from last result, shown on the GUI thread
         self.space.layout().addWidget(self.message)
     
     def switch_here(self):
@@ -774,14 +799,11 @@ class PeakHeightRes(QWidget):
     def result(self, event):        
         '''Find peak height
         '''
-        sweep = event.fitsub
-        max = np.max(sweep)
-        min = np.min(sweep)        
-        area = max if abs(max)>abs(min) else min   # Using peak height represent area
+        area = peak_height(event.fitsub)   # Using peak height represent area
         data = [area for x in event.config.freq_list]
         
         pol = area*event.cc
-        self.message.setText(f"Peak height: {area}")
+        self.text = f"Peak height: {area}"
         return data, area, pol
                 
         
@@ -799,6 +821,7 @@ class FitPeakRes(QWidget):
         self.poly_label = QLabel("Fit Peak")
         self.space.addWidget(self.poly_label)
         self.message = QLabel()
+        self.text = ''     # message from last result, shown on the GUI thread
         self.space.layout().addWidget(self.message)
         
         self.grid2 = QGridLayout()
@@ -829,8 +852,9 @@ class FitPeakRes(QWidget):
         
         bounds = [w*(max-min)+min for w in self.wings]  
         self.parent.res_region.setRegion(bounds)
+        self.mask = range_mask(len(self.parent.parent.event.scan.freq_list), self.wings)
         self.parent.run_analysis()  
-    
+        
     def result(self, event):        
         '''Perform Gaussian fit and sum.
         
@@ -841,19 +865,18 @@ class FitPeakRes(QWidget):
             area and polarization from sum under gaussian
         '''
         
-        self.pi = [-0.1, self.parent.config.channel['cent_freq'], self.parent.config.channel['mod_freq']*1E-3/10]        
-        
         sweep = event.fitsub
         freqs = event.scan.freq_list
-        bounds = [x*len(sweep) for x in self.wings]
-        data = [z for x,z in enumerate(zip(freqs, sweep)) if bounds[0]<x<bounds[1]]
-        X = np.array([x for x,y in data])
-        Y = np.array([y for x,y in data])
-        pf, pcov = optimize.curve_fit(self.gaussian, X, Y, p0 = self.pi)
+        mask = self.mask if len(self.mask)==len(sweep) else range_mask(len(sweep), self.wings)
+        X = freqs[mask]
+        Y = sweep[mask]
+        self.pi = estimate(X, Y, event.config.channel['cent_freq'], event.config.channel['mod_freq'])
+        from scipy import optimize
+        pf, pcov = optimize.curve_fit(gaussian, X, Y, p0 = self.pi, jac = gaussian_jac)
         pstd = np.sqrt(np.diag(pcov))
-        fit = self.gaussian(freqs, *pf)               
+        fit = gaussian(freqs, *pf)               
               
-        residuals = Y - self.gaussian(X, *pf)
+        residuals = Y - gaussian(X, *pf)
         ss_res = np.sum(residuals**2)
         ss_tot = np.sum((Y - np.mean(Y))**2)
         r_squared = 1 - (ss_res / ss_tot)                  
@@ -861,12 +884,9 @@ class FitPeakRes(QWidget):
         area = fit.sum()
         pol = area*event.cc
         text_list = [f"{f:.2e} ± {s:.2e}" for f, s in zip(pf, pstd)]
-        self.message.setText(f"Fit coefficients: \t \t \t R-squared: {r_squared:.2f}\n"+"\n".join(text_list)+"\n"+f"Area: {area}")
+        self.text = f"Fit coefficients: \t \t \t R-squared: {r_squared:.2f}\n"+"\n".join(text_list)+"\n"+f"Area: {area}"
         return fit, area, pol 
     
-    def gaussian(self, x, *p): return p[0]*np.exp(-np.power((x-p[1]),2)/(2*np.power(p[2],2)))
-    def gaussian(self, x, *p): return p[0]*np.exp(-np.power((x-p[1]),2)/(2*np.power(p[2],2)))
-    
     def lorentzian(self, x, *p): return p[1] / np.pi / ((x-p[0])**2 + p[1]**2)
     
 class FitPeakRes2(QWidget):
@@ -883,6 +903,7 @@ class FitPeakRes2(QWidget):
         self.poly_label = QLabel("Fit Peak")
         self.space.addWidget(self.poly_label)
         self.message = QLabel()
+        self.text = ''     # message from last result, shown on the GUI thread
         self.space.layout().addWidget(self.message)
         
         self.grid2 = QGridLayout()
@@ -913,8 +934,9 @@ class FitPeakRes2(QWidget):
         
         bounds = [w*(max-min)+min for w in self.wings]  
         self.parent.res_region.setRegion(bounds)
+        self.mask = range_mask(len(self.parent.parent.event.scan.freq_list), self.wings)
         self.parent.run_analysis()  
-    
+        
     def result(self, event):        
         '''Perform fit to sum of two gaussians, intergrate
         
@@ -925,19 +947,19 @@ class FitPeakRes2(QWidget):
             area and polarization from sum under gaussian
         '''
         
-        self.pi = [-0.1, self.parent.config.channel['cent_freq'], self.parent.config.channel['mod_freq']*1E-3/10, -0.01, self.parent.config.channel['cent_freq'], self.parent.config.channel['mod_freq']*1E-3/10]
-        
         sweep = event.fitsub
         freqs = event.scan.freq_list
-        bounds = [x*len(sweep) for x in self.wings]
-        data = [z for x,z in enumerate(zip(freqs, sweep)) if bounds[0]<x<bounds[1]]
-        X = np.array([x for x,y in data])
-        Y = np.array([y for x,y in data])
-        pf, pcov = optimize.curve_fit(self.sum_gaussians, X, Y, p0 = self.pi)
+        mask = self.mask if len(self.mask)==len(sweep) else range_mask(len(sweep), self.wings)
+        X = freqs[mask]
+        Y = sweep[mask]
+        amp, cent, width = estimate(X, Y, event.config.channel['cent_freq'], event.config.channel['mod_freq'])
+        self.pi = [amp, cent, width, amp/10, cent, 2*width]    # second, smaller and broader peak under the first
+        from scipy import optimize
+        pf, pcov = optimize.curve_fit(sum_gaussians, X, Y, p0 = self.pi, jac = sum_gaussians_jac)
         pstd = np.sqrt(np.diag(pcov))
-        fit = self.sum_gaussians(freqs, *pf)                
+        fit = sum_gaussians(freqs, *pf)                
               
-        residuals = Y - self.sum_gaussians(X, *pf)
+        residuals = Y - sum_gaussians(X, *pf)
         ss_res = np.sum(residuals**2)
         ss_tot = np.sum((Y - np.mean(Y))**2)
         r_squared = 1 - (ss_res / ss_tot)                  
@@ -945,13 +967,10 @@ class FitPeakRes2(QWidget):
         area = fit.sum()
         pol = area*event.cc
         text_list = [f"{f:.2e} ± {s:.2e}" for f, s in zip(pf, pstd)]
-        self.message.setText(f"Fit coefficients: \t \t \t R-squared: {r_squared:.2f}\n"+"\n".join(text_list)+"\n"+f"Area: {area}")
+        self.text = f"Fit coefficients: \t \t \t R-squared: {r_squared:.2f}\n"+"\n".join(text_list)+"\n"+f"Area: {area}"
         return fit, area, pol 
         
-    def sum_gaussians(self, x, *p): return p[0]*np.exp(-np.power((x-p[1]),2)/(2*np.power(p[2],2))) + p[3]*np.exp(-np.power((x-p[4]),2)/(2*np.power(p[5],2)))
-    
-    
-    
+
  
 class FitDeuteron(QWidget):
     '''Layout and methods for Dulya fits from deuteron_fits.py
@@ -962,8 +981,7 @@ class FitDeuteron(QWidget):
         self.parent = parent
         
         d_fit_params = self.parent.event.config.settings['analysis']['d_fit_params'] 
-        
-        
+        self.fitter = DeuteronFitter(self.parent.event.config.settings['analysis'])
         
         self.space = QVBoxLayout()
         self.setLayout(self.space)
@@ -973,6 +991,7 @@ class FitDeuteron(QWidget):
         self.init_label = QLabel("Deutron Lineshape Fit")
         self.grid.addWidget(self.init_label, 0, 0)
         self.message = QLabel()
+        self.text = ''     # message from last result, shown on the GUI thread
         self.space.layout().addWidget(self.message)
         
         self.grid = QGridLayout()
@@ -986,12 +1005,17 @@ class FitDeuteron(QWidget):
             self.grid.addWidget(self.param_label[i], i+1, 0)
             self.param_edit.append(QLineEdit())
             self.param_edit[i].setText(str(d_fit_params[key]))
+            self.param_edit[i].editingFinished.connect(self.read_params)
             self.grid.addWidget(self.param_edit[i], i+1, 1)    
     
+        self.params = dict(d_fit_params)
+        
+    def read_params(self):
+        '''Take initial parameters from line edits, on the GUI thread so fits running on workers don't touch widgets'''
         try:
-            self.params
-        except AttributeError:    
-            self.params = self.parent.event.config.settings['analysis']['d_fit_params']
+            self.params = {l.text(): float(e.text()) for l, e in zip(self.param_label, self.param_edit)}
+        except ValueError as e:
+            print('Invalid deuteron fit parameter: '+str(e))
         
             
     def switch_here(self):
@@ -1011,30 +1035,27 @@ class FitDeuteron(QWidget):
         sweep = event.fitsub
         freqs = event.scan.freq_list
         
-        labels = [e.text() for e in self.param_label]
-        values = [float(e.text()) for e in self.param_edit]
-        
-        self.params = dict(zip(labels, values))
-        print(self.params)
-        
-        res = DFits(freqs, sweep, self.params)
+        params = dict(self.params)
+        print(params)
         
-        r = res.result.params['r'].value        
-        fit = res.result.best_fit
-        if res.result.success:      # if successful, set these params for next time
-            self.params = res.result.params.valuesdict()
+        res = self.fitter.fit(freqs, sweep, params)
+        if res is None:
+            self.text = f"Deuteron fits timed out after {self.fitter.pool_settings['timeout']}s."
+            return np.full(len(sweep), np.nan), np.nan, np.nan      # no result, not zero polarization
+        values, stderr, fit = res['params'], res['stderr'], res['best_fit']
         
-        pol = (r*r-1)/(r*r + r +1)
+        r = values['r']
+        pol = deuteron_pol(r)
         area = fit.sum()
         cc = pol/area
         text = '\n'
         i=0
-        for name, param in res.result.params.items():
+        for name, value in values.items():
             i+=1
-            text = text + f'{name} {param.value:.3e}+-{param.stderr:.3e} '
+            text = text + f'{name} {value:.3e}+-{stderr[name]:.3e} '
             if i == 4:  
                 text = text + "\n"
-        self.message.setText(f"Polarization: {pol*100:.2f}%, Area:  {area:.2f}, CC:  {cc:.2f}\n {text}")
+        self.text = f"Polarization: {pol*100:.2f}%, Area:  {area:.2f}, CC:  {cc:.2f}\n {text}"
         return fit, r, pol 
     
    
@@ -0,0 +1,131 @@
+'''PyNMR, J.Maxwell 2020
+'''
+import json
+import numpy as np
+from PyQt5.QtWidgets import QWidget, QLabel, QGroupBox, QHBoxLayout, QVBoxLayout, QGridLayout, QLineEdit, QPushButton
+from PyQt5.QtNetwork import QTcpSocket, QAbstractSocket
+import pyqtgraph as pg
+
+
+class DaemonTab(QWidget):
+    '''Creates tab to attach to a running headless daemon as a client: send it commands and show each event it finishes'''
+    def __init__(self, parent):
+        super(QWidget, self).__init__(parent)
+        self.__dict__.update(parent.__dict__)
+
+        self.parent = parent
+        self.port = self.parent.config.settings['daemon']['port']
+        self.pols = []          # list of (stamp, pol) from events received
+
+        self.fin_pen = pg.mkPen(color=(0, 180, 0), width=1.5)
+        self.res_pen = pg.mkPen(color=(180, 0, 0), width=1.5)
+        self.pol_pen = pg.mkPen(color=(250, 0, 0), width=1.5)
+
+        self.main = QHBoxLayout()
+        self.setLayout(self.main)
+
+        # Left Side
+        self.left = QVBoxLayout()
+        self.main.addLayout(self.left)
+
+        self.con_box = QGroupBox('Daemon Controls')
+        self.con_box.setLayout(QGridLayout())
+        self.left.addWidget(self.con_box)
+        self.connect_button = QPushButton('Attach')
+        self.connect_button.clicked.connect(self.attach)
+        self.con_box.layout().addWidget(self.connect_button, 0, 0, 1, 3)
+        self.start_button = QPushButton('Start')
+        self.start_button.clicked.connect(lambda: self.command('start'))
+        self.con_box.layout().addWidget(self.start_button, 1, 0)
+        self.stop_button = QPushButton('Finish')
+        self.stop_button.clicked.connect(lambda: self.command('stop'))
+        self.con_box.layout().addWidget(self.stop_button, 1, 1)
+        self.abort_button = QPushButton('Abort')
+        self.abort_button.clicked.connect(lambda: self.command('abort'))
+        self.con_box.layout().addWidget(self.abort_button, 1, 2)
+        self.label_edit = QLineEdit('None')
+        self.con_box.layout().addWidget(self.label_edit, 2, 0, 1, 2)
+        self.label_button = QPushButton('Set Label')
+        self.label_button.clicked.connect(lambda: self.command(f'label {self.label_edit.text()}'))
+        self.con_box.layout().addWidget(self.label_button, 2, 2)
+        self.status_button = QPushButton('Status')
+        self.status_button.clicked.connect(lambda: self.command('status'))
+        self.con_box.layout().addWidget(self.status_button, 3, 0, 1, 3)
+
+        self.stat_box = QGroupBox('Daemon Status')
+        self.stat_box.setLayout(QVBoxLayout())
+        self.left.addWidget(self.stat_box)
+        self.status_label = QLabel('Not attached.')
+        self.status_label.setWordWrap(True)
+        self.stat_box.layout().addWidget(self.status_label)
+        self.event_label = QLabel()
+        self.event_label.setWordWrap(True)
+        self.stat_box.layout().addWidget(self.event_label)
+        self.left.addStretch()
+
+        # Right Side
+        self.right = QVBoxLayout()
+        self.main.addLayout(self.right)
+        self.event_wid = pg.PlotWidget(title='Last Daemon Event')
+        self.event_wid.showGrid(True, True)
+        self.event_wid.addLegend(offset=(0.5, 0))
+        self.fin_plot = self.event_wid.plot([], [], pen=self.fin_pen, name='Fit Subtracted')
+        self.res_plot = self.event_wid.plot([], [], pen=self.res_pen, name='Result')
+        self.right.addWidget(self.event_wid)
+        self.time_axis = pg.DateAxisItem(orientation='bottom')
+        self.pol_wid = pg.PlotWidget(title='Daemon Polarization', axisItems={'bottom': self.time_axis})
+        self.pol_wid.showGrid(True, True)
+        self.pol_plot = self.pol_wid.plot([], [], pen=self.pol_pen, symbolBrush=(174, 88, 0), symbolPen='w', symbol='o', symbolSize=5)
+        self.right.addWidget(self.pol_wid)
+
+        self.socket = QTcpSocket(self)
+        self.socket.connected.connect(self.attached)
+        self.socket.disconnected.connect(lambda: self.status_label.setText('Daemon disconnected.'))
+        self.socket.errorOccurred.connect(lambda error: self.status_label.setText(f'Daemon connection error: {self.socket.errorString()}'))
+        self.socket.readyRead.connect(self.read)
+
+    def attach(self):
+        '''Connect to daemon on local port'''
+        if self.socket.state() == QAbstractSocket.UnconnectedState:
+            self.status_label.setText(f'Attaching to daemon on port {self.port}...')
+            self.socket.connectToHost('127.0.0.1', self.port)
+
+    def attached(self):
+        '''Connected: subscribe to events and ask status'''
+        self.status_label.setText(f'Attached to daemon on port {self.port}.')
+        self.command('subscribe')
+        self.command('status')
+
+    def command(self, line):
+        '''Send command line to daemon'''
+        if self.socket.state() == QAbstractSocket.ConnectedState:
+            self.socket.write((line + '\n').encode())
+        else:
+            self.status_label.setText('Not attached.')
+
+    def read(self):
+        '''Read replies and events from daemon'''
+        while self.socket.canReadLine():
+            message = json.loads(bytes(self.socket.readLine()).decode())
+            if 'event' in message:
+                self.update_event(message['event'])
+            elif not message['ok']:
+                self.status_label.setText(f"Daemon {message['reply']} failed: {message['error']}")
+            elif message['reply'] == 'status':
+                last = message['last']
+                text = f"Running: {message['running']}, sweeps in current event: {message['sweeps']}, label: {message['label']}"
+                if last:
+                    text += f"\nLast event {last['stop_time'][:19]} UTC, pol {last['pol']:.2%}"
+                self.status_label.setText(text)
+            else:
+                self.status_label.setText(f"Daemon {message['reply']} done.")
+
+    def update_event(self, event):
+        '''Show event summary from daemon'''
+        freqs = np.array(event['freq_list'])
+        self.fin_plot.setData(freqs, np.array(event['fitsub']))
+        self.res_plot.setData(freqs, np.array(event['rescurve']))
+        self.event_label.setText(f"Event {event['stop_time'][:19]} UTC, {event['sweeps']} sweeps, {event['label']}\n"
+                                 f"Pol: {event['pol']:.2%}, Area: {event['area']:.6f}\n{event['message']}")
+        self.pols.append((event['stop_stamp'], event['pol']*100))
+        self.pol_plot.setData(np.array(self.pols))
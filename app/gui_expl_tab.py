@@ -9,7 +9,6 @@ import pprint as pp
 from scipy import optimize
 from PyQt5.QtWidgets import QWidget, QLabel, QGroupBox, QHBoxLayout, QVBoxLayout, QGridLayout, QLineEdit, QSpacerItem, QSizePolicy, QComboBox, QPushButton, QProgressBar, QStackedWidget, QDoubleSpinBox, QDateTimeEdit, QListWidget
 import pyqtgraph as pg
-from lmfit import Model
 
 class ExplTab(QWidget):
     '''Creates analysis tab. '''
@@ -88,7 +87,7 @@ class ExplTab(QWidget):
         self.current_time = datetime.datetime.strptime('Jan 1 2000  12:00AM', '%b %d %Y %I:%M%p')
         self.included = []
         for file in self.all_files:      
-            name = file.replace(self.config_dict['settings']['event_dir']+'\\','')
+            name = os.path.basename(file)
             if 'current' in name:
                 name = name.replace('current_', '').replace('.txt','')
                 thistime = datetime.datetime.strptime(name,"%Y-%m-%d_%H-%M-%S")
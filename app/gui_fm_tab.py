@@ -12,7 +12,8 @@ from PyQt5.QtGui import QIntValidator, QDoubleValidator, QValidator
 import pyqtgraph as pg
 from PyQt5.QtCore import QThread, pyqtSignal,Qt
 from RsInstrument import * 
-import telnetlib
+
+from app import instruments
  
 
 class FMTab(QWidget): 
@@ -129,33 +130,29 @@ class FMGenerator():
     '''    
     
     def __init__(self, config):    
-        '''Open connection to GPIB, send commands for all settings. Close.  
+        '''Settings for shared session to GPIB controller, which connects on first use  
         '''
         self.host = config.settings['fm_settings']['ip']
         self.port = config.settings['fm_settings']['port']   
-        self.timeout = config.settings['fm_settings']['timeout']              # Telnet timeout in secs
+        self.timeout = config.settings['fm_settings']['timeout']              # timeout in secs
         self.addr = config.settings['fm_settings']['addr']
         self.config = config
+        self.session = instruments.session(self.host, self.port, self.timeout)
 
  
     def set(self, freq, amp, off):
         '''Write settings to generator, and read them back'''
         try:
-            self.tn = telnetlib.Telnet(self.host, port=self.port, timeout=self.timeout)
-
-            # Write all required settings            
-            self.tn.write(bytes(f"++addr {self.addr}\n", 'ascii'))
-            self.tn.write(bytes(f"FREQ {freq}\n", 'ascii'))
-            self.tn.write(bytes(f"FREQ?\n", 'ascii'))
-            freq_out = self.tn.read_some().decode('ascii') 
-            
-            self.tn.write(bytes(f"VOLT {amp}\n", 'ascii'))
-            self.tn.write(bytes(f"VOLT?\n", 'ascii'))
-            amp_out = self.tn.read_some().decode('ascii')   
-                      
-            self.tn.write(bytes(f"VOLT:OFFS {off}\n", 'ascii'))
-            self.tn.write(bytes(f"VOLT:OFFS?\n", 'ascii'))
-            off_out = self.tn.read_some().decode('ascii')     
+            with self.session.lock:
+                # Write all required settings            
+                self.session.write(f"FREQ {freq}", addr=self.addr)
+                freq_out = self.session.query("FREQ?", addr=self.addr)
+                
+                self.session.write(f"VOLT {amp}", addr=self.addr)
+                amp_out = self.session.query("VOLT?", addr=self.addr)
+                          
+                self.session.write(f"VOLT:OFFS {off}", addr=self.addr)
+                off_out = self.session.query("VOLT:OFFS?", addr=self.addr)
                      
             print(f"Successfully sent settings to GPIB on {self.host}")
             return freq_out, amp_out, off_out
@@ -168,15 +165,10 @@ class FMGenerator():
     def read(self):
         '''Read settings from generator'''   
         try:
-            self.tn = telnetlib.Telnet(self.host, port=self.port, timeout=self.timeout)
-
-            # Write all required settings            
-            self.tn.write(bytes(f"FREQ?\n", 'ascii'))
-            freq_out = self.tn.read_some().decode('ascii') 
-            self.tn.write(bytes(f"VOLT?\n", 'ascii'))
-            amp_out = self.tn.read_some().decode('ascii')        
-            self.tn.write(bytes(f"VOLT:OFFS?\n", 'ascii'))
-            off_out = self.tn.read_some().decode('ascii')    
+            with self.session.lock:
+                freq_out = self.session.query("FREQ?", addr=self.addr)
+                amp_out = self.session.query("VOLT?", addr=self.addr)
+                off_out = self.session.query("VOLT:OFFS?", addr=self.addr)
                      
             print(f"Successfully sent settings to GPIB on {self.host}")
             return freq_out, amp_out, off_out
@@ -188,10 +180,8 @@ class FMGenerator():
     
         
     def close(self):           
-        try:
-            tn.close()
-        except Exception as e:
-            pass
+        '''Nothing to close, the session is shared and closed on exit by instruments.close_all'''
+        pass
             #print(f"GPIB connection failed on {self.host}: {e}")
             
     def __del__(self):
@@ -5,7 +5,6 @@ import re
 import json
 from dateutil.parser import parse
 from PyQt5.QtWidgets import QWidget, QLabel, QGroupBox, QHBoxLayout, QVBoxLayout, QGridLayout, QLineEdit, QSpacerItem, QSizePolicy, QComboBox, QPushButton, QTableView, QAbstractItemView, QAbstractScrollArea, QFileDialog
-from PyQt5.QtCore import QThread, pyqtSignal,Qt
 from PyQt5.QtGui import QIntValidator, QDoubleValidator, QValidator, QStandardItemModel, QStandardItem
 import pyqtgraph as pg
  
@@ -128,26 +127,20 @@ class MagnetBox(QGroupBox):
         self.set('low_lim',self.low_lim.text())
         
     def set(self, channel, value):
-        '''Sends command and reads status, starts thread to monitor values if needed'''
+        '''Queues command and status read, polls status until sweep pauses'''
         if self.mc.s.is_open:
-            self.mc.write_port(self.mc.commands[channel]+str(value))        
-            time.sleep(0.05)
-            self.mc.read_all() 
-            self.update_status()
+            self.mc.write_port(self.mc.commands[channel]+str(value))
+            self.mc.read_all(wait=False)            # after command, status_now updates display
+            self.mc.poll(True)
             self.status_bar.showMessage('Set magnet:'+self.mc.commands[channel]+str(value))
-        if 'pause' not in self.mc.status['sweep']['value']:
-            #if not self.mag_thread.isRunning() 
-            print('start thread')
-            self.mag_thread = UpdateMag(self.mc)            
-            self.mag_thread.stat_now.connect(lambda: self.update_status())
-            self.mag_thread.start()
-            
+
     def open_connection(self):
         '''Open connection to serial port, turn on controls if it works'''
         if self.port_connect.isChecked():
             self.mc.set_port(self.port_opts[self.port_comb.currentIndex()])        
             try: 
                 self.mc.open_port()
+                self.mc.worker.status_now.connect(self.update_status)
                 self.update_status()
             except:
                 self.status_bar.showMessage('Error connecting to serial port: '+str(self.port_comb.currentText()))
@@ -188,9 +181,8 @@ class MagnetBox(QGroupBox):
                     # self.sw_label.setText('Heater Status: On')
                 # else:
                     # self.sw_label.setText('Heater Status: Off')
-        if 'pause' in self.mc.status['sweep']['value']: 
-            try: self.mag_thread.terminate()
-            except: pass
+        if 'pause' in self.mc.status['sweep']['value']:
+            self.mc.poll(False)
     def sw_tog(self):
         '''Toggle switchheater'''
         sender = self.sender()
@@ -198,20 +190,3 @@ class MagnetBox(QGroupBox):
             sender.setText('Turn Heater Off')
         else:    
             sender.setText('Turn Heater On')
-  
-  
-class UpdateMag(QThread):
-    '''Thread to update the magnet status'''
-    stat_now = pyqtSignal()
-    def __init__(self, mc):
-        '''Make new thread instance for monitoring magnet status'''
-        QThread.__init__(self)
-        self.mc = mc
-    def __del__(self):
-        self.wait()
-    def run(self):
-        while True:
-            print('Ran mag update')
-            self.mc.read_all()
-            self.stat_now.emit() 
-            self.msleep(1000)               
\ No newline at end of file
@@ -13,6 +13,7 @@ import numpy as np
 from app.classes import *
 from app.daq import *
 from app.microwaves import *
+from app.trace import tracer
    
 class RunTab(QWidget):
     '''Creates run tab. Starts threads for run and to update plots'''
@@ -322,17 +323,20 @@ class RunTab(QWidget):
 
     def add_sweeps(self,new_sigs):
         '''Add the tuple of sweeps to event'''
-        self.parent.event.update_event(new_sigs)
-        self.update_run_plot()
+        with tracer.span('add_sweeps', 'run', chunk=new_sigs[0]):
+            tracer.flow('chunk', id(new_sigs), start=False)
+            self.parent.event.update_event(new_sigs)
+            self.parent.renderer.request('run_plot', self.update_run_plot, [self.raw_wid])
 
     def update_run_plot(self):
         '''Update the running plot'''
-        self.raw_plot.setData(self.parent.event.scan.freq_list, self.parent.event.scan.phase)
-        progress = 100*self.parent.event.scan.num/self.parent.event.config.controls['sweeps'].value
-        progress = 100*self.parent.event.scan.num/self.parent.event.config.controls['sweeps'].value
-        self.progress_bar.setValue(int(progress))
-        if self.parent.config.settings['compare_tab']['enable']:
-            self.parent.compare_tab.progress_bar.setValue(int(progress))
+        with tracer.span('update_run_plot', 'plot'):
+            self.raw_plot.setData(self.parent.event.scan.freq_list, self.parent.event.scan.phase)
+            progress = 100*self.parent.event.scan.num/self.parent.event.config.controls['sweeps'].value
+            progress = 100*self.parent.event.scan.num/self.parent.event.config.controls['sweeps'].value
+            self.progress_bar.setValue(int(progress))
+            if hasattr(self.parent, 'compare_tab'):
+                self.parent.compare_tab.progress_bar.setValue(int(progress))
     
     # def abort_run(self):
         # '''Quit now'''
@@ -362,11 +366,11 @@ class RunTab(QWidget):
             self.run_button.setChecked(False)
             self.update_run_plot()
             self.parent.run_toggle()
-            if self.config.settings['compare_tab']['enable']:  # if doing compare_tab   
+            if hasattr(self.parent, 'compare_tab'):  # if doing compare_tab   
                 self.parent.compare_tab.mode_done()
         else:                                    # done, continue running
             self.parent.status_bar.showMessage(f'Finished event at  at {now:%H:%M:%S} UTC. Event took {self.parent.event.elapsed}s. Running sweeps...')
-            if self.config.settings['compare_tab']['enable']:  # if doing compare_tab   
+            if hasattr(self.parent, 'compare_tab'):  # if doing compare_tab   
                 self.parent.compare_tab.mode_switch()
             self.start_thread()        
     
@@ -509,28 +513,24 @@ class RunTab(QWidget):
             self.uwave_dur_edit.setEnabled(False)
     
     def freq_reply(self, reply):
-        '''Got replay from micro thread, display it'''
-        freq = reply[0]
-        pot = reply[1]
-        temp = reply[2]
-        power = reply[3]
-        try:    # Hate this but it works for now 8/8/2022
-            if 'Error' in freq:
+        '''Got timestamped reading from micro thread, display it and add it to the event'''
+        kind, value, stamp = reply
+        if kind == 'freq':
+            if isinstance(value, str):
                 self.uwave_freq_label.setText("Freq: Read Error")
-                freq = np.nan
-        except TypeError:    
-            freq = freq/1e9
-            self.uwave_freq_label.setText(f"Freq: {freq:.4f} GHz")
-        try:
-            if 'Error' in power:
+                value = np.nan
+            else:
+                value = value/1e9
+                self.uwave_freq_label.setText(f"Freq: {value:.4f} GHz")
+        else:
+            if isinstance(value, str):
                 self.uwave_power_label.setText("Power: Read Error")
-                power = np.nan
-        except TypeError:    
-            if power < 0.01:
-                power = 0.0
-            self.uwave_power_label.setText(f"Power: {power} mW")
-        #self.uwave_freq_label.setText(f"{pot, temp}")
-        self.parent.event.set_uwave(freq, power)
+                value = np.nan
+            else:
+                if value < 0.01:
+                    value = 0.0
+                self.uwave_power_label.setText(f"Power: {value} mW")
+        self.parent.event.add_uwave(kind, value, stamp)
         
     def up_micro(self):
         '''Up pressed'''
@@ -545,7 +545,7 @@ class RunTab(QWidget):
         self.utune.change_freq('off')        
         
     def update_status(self):
-        '''Update gui with status from EPICS values, toggle color. Do beam current sum.'''  
+        '''Update gui with status from EPICS values, toggle color.'''  
         
         for key in self.parent.epics.read_list:
             try:
@@ -555,11 +555,6 @@ class RunTab(QWidget):
                     self.stat_values[key].setText(f'{self.parent.epics.read_pvs[key]:.3e}')
             except TypeError:                
                 pass
-        try:        
-            beam_var = self.parent.config.settings['epics_settings']['beam_current']        
-            self.parent.event.sum_beam_current(self.parent.epics.read_pvs[beam_var])
-        except KeyError:
-            pass
             
             
             #if self.epics_beat: 
@@ -622,17 +617,21 @@ class RunThread(QThread):
                 self.parent.abort_now = False
                 break
             #start_time = time.time()    
-            new_sigs = self.daq.get_chunk()
+            with tracer.span('get_chunk', 'run'):
+                new_sigs = self.daq.get_chunk()
             #print(new_sigs)
             chunk_num, num_in_chunk, pchunk, dchunk = new_sigs
             #print(f"get_chunk took {time.time() - start_time }s")
             if num_in_chunk > 0:
-                self.reply.emit(new_sigs)
+                with tracer.span('emit_chunk', 'run', chunk=chunk_num):
+                    tracer.flow('chunk', id(new_sigs))
+                    self.reply.emit(new_sigs)
                 rec_chunks += 1
                 if 'NIDAQ' in self.config.settings['daq_type']:
                     self.rec_sweeps = num_in_chunk
                 else:
                     self.rec_sweeps += num_in_chunk
+                self.parent.publisher.chunk(new_sigs, self.config.freq_list, self.rec_sweeps, self.sweep_num)
             if not chunk_num + 1 == rec_chunks and not chunk_num == 0:
                 print(f"Lost chunk. Expecting {rec_chunks}, got {chunk_num + 1}. Aborting run.") 
                 self.daq.abort()
@@ -3,18 +3,67 @@
 import datetime
 import re
 import json
-import time
+import threading
 import numpy as np
-from scipy.optimize import minimize
+from scipy.optimize import lsq_linear
 from dateutil.parser import parse
 from PyQt5.QtWidgets import QWidget, QLabel, QGroupBox, QHBoxLayout, QVBoxLayout, QGridLayout, QLineEdit, QSpacerItem, QSizePolicy, QComboBox, QPushButton, QTableView, QAbstractItemView, QAbstractScrollArea, QFileDialog, QStackedWidget
 from PyQt5.QtGui import QIntValidator, QDoubleValidator, QValidator
 import pyqtgraph as pg
 from PyQt5.QtCore import QThread, pyqtSignal,Qt
 from RsInstrument import * 
-import telnetlib
+
+from app import instruments
  
 
+COIL_LEFT = np.array([-2.4424,-1.0393,0.0644,2.1887])/39.37      # left edges of shim coils, inch to meter
+COIL_RIGHT = np.array([-2.1887,-0.0644,1.0393,2.4424])/39.37     # right edges of shim coils, inch to meter
+COIL_RADII = np.array([0.0335, 0.0338])                          # inner and outer layer radii, meter
+COIL_TURNS = np.array([[35,134,134,35],[34,134,134,34]])         # turns of each coil, inner and outer layer
+MU = 12.57e-7       # permeability of free space
+
+
+def shim_response(z_axis):
+    '''Field from 1 A in each shim coil, summed over both layers. The field is linear in the currents, so the field
+    from any currents is this matrix times the currents.
+    
+    Args:
+        z_axis: Positions along axis in mm
+        
+    Returns:
+        Array of fields in T, positions by 4 coils
+    '''
+    z = np.asarray(z_axis)[:, None, None]/1000      # mm to meter, axes of position, layer, coil
+    r = COIL_RADII[None, :, None]
+    n = COIL_TURNS/(COIL_RIGHT - COIL_LEFT)         # turns per length
+    b = (z - COIL_LEFT)/np.sqrt((z - COIL_LEFT)**2 + r**2)
+    c = (z - COIL_RIGHT)/np.sqrt((z - COIL_RIGHT)**2 + r**2)
+    return (MU*n/2*(b - c)).sum(axis=1)
+    
+
+def solve_currents(response, background, goals, limit=10):
+    '''Shim currents bringing background plus shim field closest to goals, within limit. Minimizes the sum of
+    squared differences over goal, as a linear least squares weighted by 1/goal, unweighted if any goal is zero.
+    
+    Args:
+        response: Field from 1 A in each coil, from shim_response
+        background: Background field in T at each position
+        goals: Goal field in T at each position
+        limit: Largest current magnitude in A
+        
+    Returns:
+        Array of 4 currents in A
+    '''
+    goals = np.asarray(goals, dtype=float)
+    weights = np.sqrt(1/np.abs(goals)) if np.all(goals != 0) else np.ones(len(goals))
+    A = response*weights[:, None]
+    b = (goals - background)*weights
+    x = np.linalg.lstsq(A, b, rcond=None)[0]
+    if np.all(np.abs(x) <= limit):         # unbounded solution is in bounds, so it is the bounded one too
+        return x
+    return lsq_linear(A, b, bounds=(-limit, limit), method='bvls').x
+    
+
 class ShimTab(QWidget): 
     '''Creates shim control tab'''   
     def __init__(self, parent):
@@ -26,19 +75,20 @@ class ShimTab(QWidget):
         self.goal_pen = pg.mkPen(color=(0, 200, 0), width=1.5)
         self.back_pen = pg.mkPen(color=(200, 0, 0), width=1.5)
         
+        self.read_back = [0]*4
+        self.shim_state = 0
         try:
             shims = ShimControl(self.parent.config)
-            self.read_back = shims.read_currents()
-            self.shim_state = shims.read_outstat()
+            self.read_back, self.shim_state = shims.read_all()
             self.parent.shimA = self.read_back[0]
             self.parent.shimB = self.read_back[1]
             self.parent.shimC = self.read_back[2]
             self.parent.shimD = self.read_back[3]
-            shims.close_socket()
         except Exception as e:
             print("Error connecting to R&S current supply.", e)    
         
         self.z_axis = np.arange(-30,31)        
+        self.response = shim_response(self.z_axis)      # field from 1 A in each coil at each z
         self.frost = np.array([4.9995, 4.999595, 4.99969, 4.9997575, 4.999825, 4.9998675,
                       4.99991, 4.9999425, 4.999975, 4.9999975, 5.00002, 5.000035,
                       5.00005, 5.000055, 5.00006, 5.00006, 5.00006, 5.0000575,
@@ -157,6 +207,7 @@ class ShimTab(QWidget):
     # Turning off shim monitor thread for now
         # try:
             # self.shim_thread = ShimThread(self, self.parent.config)
+            # self.shim_thread.reply.connect(self.shim_reply)
             # self.shim_thread.start()
         # except Exception as e: 
             # print('Exception starting shim monitor thread, lost connection: '+str(e)) 
@@ -168,51 +219,49 @@ class ShimTab(QWidget):
         self.shim_op_stack.setCurrentIndex(i)
         
     def set_clicked(self):
-        '''
+        '''Send currents to supply and show readback
         ''' 
         try:         
             shims = ShimControl(self.parent.config)
             list = [float(self.cur_edit[k].text()) for k in self.shim_currents.keys()]
-            shims.set_currents(list)
-            self.read_back = shims.read_currents()
+            self.read_back = shims.set_currents(list)
             self.fill_readback()
-            shims.close_socket()
         except Exception as e:
             print("Error connecting to R&S current supply.", e)    
         return 
         
     def read_clicked(self):
-        '''
+        '''Read currents and output state from supply and show them
         ''' 
         try:         
             shims = ShimControl(self.parent.config)
-            self.read_back = shims.read_currents()
-            self.fill_readback()
-            out = shims.read_outstat() 
-            shims.close_socket()
-            
-            if '1' in out:
-                self.turn_button.setChecked(True)
-                self.parent.shimA = self.read_back[0]
-                self.parent.shimB = self.read_back[1]
-                self.parent.shimC = self.read_back[2]
-                self.parent.shimD = self.read_back[3]
-            else:
-                self.turn_button.setChecked(False)
-                self.parent.shimA = 0
-                self.parent.shimB = 0
-                self.parent.shimC = 0
-                self.parent.shimD = 0
-            if self.turn_button.isChecked():
-                self.turn_button.setText('Turn OFF')
-            else:
-                self.turn_button.setText('Turn ON')
-            
-            
+            self.shim_reply(shims.read_all())
         except Exception as e:
             print("Error connecting to R&S current supply.", e)    
         return
         
+    def shim_reply(self, reply):
+        '''Show readback of currents and output state, from read or monitor thread, and keep currents for events
+        '''
+        self.read_back, out = reply
+        self.fill_readback()
+        if '1' in out:
+            self.turn_button.setChecked(True)
+            self.parent.shimA = self.read_back[0]
+            self.parent.shimB = self.read_back[1]
+            self.parent.shimC = self.read_back[2]
+            self.parent.shimD = self.read_back[3]
+        else:
+            self.turn_button.setChecked(False)
+            self.parent.shimA = 0
+            self.parent.shimB = 0
+            self.parent.shimC = 0
+            self.parent.shimD = 0
+        if self.turn_button.isChecked():
+            self.turn_button.setText('Turn OFF')
+        else:
+            self.turn_button.setText('Turn ON')
+        
     def turn_clicked(self):
         '''Button clicked, send new state to shim controller, check to be sure button is right
         '''    
@@ -220,7 +269,6 @@ class ShimTab(QWidget):
             shims = ShimControl(self.parent.config)
             state_to_set = '1' if self.turn_button.isChecked() else '0'     
             out = shims.set_outstat(state_to_set)             
-            shims.close_socket()
         except Exception as e:
             print("Error connecting to R&S current supply.", e)       
             
@@ -237,7 +285,7 @@ class ShimTab(QWidget):
         '''
         '''          
         for i, k in enumerate(self.shim_currents.keys()):            
-            self.read_edit[k].setText(self.read_back[i]) 
+            self.read_edit[k].setText(f"{self.read_back[i]}") 
 
         
     def update_plots(self):
@@ -255,11 +303,13 @@ class ShimTab(QWidget):
         
 
     def calc_currents(self, background, goals):
-        self.result = minimize(self.chi, np.array([1,1,1,1]), args=(background,goals), method='Nelder-Mead', bounds=((-10,10),(-10,10),(-10,10),(-10,10)))
+        '''Solve for currents bringing background closest to goals, within +/-10 A
+        '''
+        x = solve_currents(self.response, background, goals)
            
-        just_shims = self.coil_from_shims(self.result.x)
+        just_shims = self.coil_from_shims(x)
         shimmed = just_shims + background        
-        return just_shims, shimmed, self.result.x
+        return just_shims, shimmed, x
         
         
 
@@ -269,35 +319,9 @@ class ShimTab(QWidget):
         return tiltField
 
     def coil_from_shims(self, currents):
-        z1 = np.array([-2.4424,-1.0393,0.0644,2.1887]) #left
-        z2 = np.array([-2.1887,-0.0644,1.0393,2.4424]) #right    
-        z1=z1/39.37 # inch to meter
-        z2=z2/39.37 # inch to meter
-        w=z2-z1
-        Z = np.arange(-30,31)
-        Z = Z/1000 # mm to meter
-        R = np.array([0.0335, 0.0338]) # inner and out layer radii
-        windings=([np.array([35,134,134,35])/w,np.array([34,134,134,34])/w])
-        n=windings
-        #n=21500/2 # turns per length(one layer)
-        mu=12.57e-7 # permeability of free space
-        field=np.zeros(len(Z))
-        for j in [0,1]: # field at Z from coil (of size z1 -> z2)
-            for i in range(len(Z)):
-                a = mu*n[j]*currents/2
-                b = ( Z[i]-z1 )/( np.sqrt((Z[i]-z1)**2 + R[j]**2) )
-                c = ( Z[i]-z2 )/( np.sqrt((Z[i]-z2)**2 + R[j]**2) )
-                bz = a*(b-c)
-                field[i]=field[i]+np.sum(np.sum(bz))
-        return field
+        '''Field in T along z from shim currents'''
+        return self.response @ np.asarray(currents, dtype=float)
 
-    def chi(self, currents, background, goal):
-        shimField = self.coil_from_shims(currents) + background
-        diff = shimField-goal
-        chi = (diff**2)/goal
-        chiSUM = np.sum(chi)
-        return chiSUM
-    
     def divider(self):
         div = QLabel ('')
         div.setStyleSheet ("QLabel {background-color: #eeeeee; padding: 0; margin: 0; border-bottom: 0 solid #eeeeee; border-top: 1 solid #eeeeee;}")
@@ -470,55 +494,58 @@ class ShimControl():
     '''
         
     def __init__(self, config):    
-        '''Open connection to Rsinstrument  
+        '''Settings for session to R&S, shared and kept open between uses  
         '''
         self.host = config.settings['shim_settings']['ip']
         self.timeout = config.settings['shim_settings']['timeout']
         self.port = config.settings['shim_settings']['port']  
         self.config = config 
-        
-        try:
-            self.tn = telnetlib.Telnet(self.host, port=self.port, timeout=self.timeout)
-            print("Connected to R&S shim supply on", self.host)
-        except Exception as e:
-            print("Error connecting to R&S current supply.", e)
+        self.session = instruments.session(self.host, self.port, self.timeout)
         
         
     def set_currents(self, list):
-        '''Set currents on R&S from list passed
+        '''Set currents on R&S from list passed, all channels in one message. Waits for the supply to finish with *OPC?
+        and reads back the currents, in the same round trip.
+        
+        Returns:
+            List of currents read back in A
         '''
+        commands = []
         for i, c in enumerate(list):
-            try:
-                #print("Set shim channel", i+1, "to", {list[i]})
-                self.tn.write(bytes(f"INST:NSEL {i+1}\n", 'ascii'))
-                #volt = list[i] * self.config.settings['shim_settings']['line_resistance'] + 0.5
-                # Set voltage based on current and setting of line resistance, plus 0.5 V
-                volt = 2
-                self.tn.write(bytes(f"VOLT {volt}\n", 'ascii'))
-                self.tn.write(bytes(f"CURR {list[i]}\n", 'ascii'))
-                time.sleep(0.1)
-            except Exception as e:
-                print("Error setting currents on R&S current supply.", e) 
+            #volt = list[i] * self.config.settings['shim_settings']['line_resistance'] + 0.5
+            # Set voltage based on current and setting of line resistance, plus 0.5 V
+            volt = 2
+            commands += [f"INST:NSEL {i+1}", f"VOLT {volt}", f"CURR {c}"]
+        commands.append("*OPC?")
+        commands += self.read_commands(len(list))
+        replies = self.session.query(instruments.compound(commands)).strip().split(';')
+        return [float(r) for r in replies[1:]]
+        
+    def read_commands(self, channels):
+        '''Queries of the current of each channel'''
+        return [c for i in range(channels) for c in (f"INST:NSEL {i+1}", "CURR?")]
             
     def read_currents(self):
-        '''Read currents on R&S from list passed
+        '''Read currents on R&S, all channels in one round trip
+        
+        Returns:
+            List of currents in A
         '''
-        reads = [0]*4
-        for i in range(0,4):        
-            try:
-                self.tn.write(bytes(f"INST:NSEL {i+1}\n", 'ascii'))
-                self.tn.write(bytes(f"CURR? \n", 'ascii'))
-                reads[i] = self.tn.read_some().decode('ascii')     
-                time.sleep(0.1)   
-            except Exception as e:
-                print("Error reading currents on R&S current supply.", e)         
-        return reads
+        return self.read_all()[0]
+        
+    def read_all(self, channels=4):
+        '''Read currents on R&S and output state, all in one round trip
+        
+        Returns:
+            List of currents in A, output state reply
+        '''
+        replies = self.session.query(instruments.compound(self.read_commands(channels) + ["OUTP:GEN?"])).strip().split(';')
+        return [float(r) for r in replies[:channels]], replies[channels]
     
     def read_outstat(self):
         
         try:
-            self.tn.write(bytes(f"OUTP:GEN? \n", 'ascii'))
-            out =  self.tn.read_some().decode('ascii') 
+            out = self.session.query("OUTP:GEN? ")
             return out
         except Exception as e:
             print("Error reading status on R&S current supply.", e) 
@@ -528,43 +555,39 @@ class ShimControl():
     def set_outstat(self, state):
         '''Takes state as 0 or 1, returns
         '''
-        self.tn.write(bytes(f"OUTP:GEN {state} \n", 'ascii'))
-        self.tn.write(bytes(f"OUTP:GEN? \n", 'ascii'))
-        return self.tn.read_some().decode('ascii') 
-        
-        
-    def close_socket(self):
-        self.tn.close()    
+        with self.session.lock:
+            self.session.write(f"OUTP:GEN {state} ")
+            return self.session.query("OUTP:GEN? ")
         
         
 
 class ShimThread(QThread):
-    '''Thread class for shim monitoring
+    '''Thread class for shim monitoring. Reads supply every monitor_time minutes and sends the readback to the tab,
+    which shows it.
     Args:
         config: Config object of settings
     '''
+    reply = pyqtSignal(tuple)       # reply signal, tuple of list of currents and output state reply
     finished = pyqtSignal()       # finished signal
     def __init__(self, parent, config):
         QThread.__init__(self)
         self.config = config
         self.parent = parent 
+        self.stop = threading.Event()       # set to end monitoring
             
                 
     def __del__(self):
+        self.stop.set()
         self.wait()
         
     def run(self):
         '''Main shim read loop
         '''    
-            
-        while True:   
+        shims = ShimControl(self.config)
+        while not self.stop.wait(self.config.settings['shim_settings']['monitor_time']*60):   
             try:
-                time.sleep(self.config.settings['shim_settings']['monitor_time']*60)
-                self.parent.read_clicked()
+                self.reply.emit(shims.read_all())
             except Exception as e:
                 print('Exception in shim monitor thread: '+str(e))          
           
         self.finished.emit()
-        
-        
-        
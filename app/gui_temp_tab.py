@@ -1,10 +1,10 @@
 '''PyNMR, J.Maxwell 2021
 '''
 import datetime, time
-import telnetlib
 from PyQt5.QtCore import QThread, pyqtSignal, Qt
-from labjack import ljm
 from PyQt5.QtWidgets import QWidget, QLabel, QGroupBox, QHBoxLayout, QVBoxLayout, QGridLayout, QLineEdit, QSpacerItem, QSizePolicy, QComboBox, QPushButton, QTableView, QAbstractItemView, QAbstractScrollArea, QFileDialog, QStackedWidget
+
+from app import labjacks
  
 
 class TempTab(QWidget): 
@@ -77,31 +77,23 @@ class TempTab(QWidget):
       
            
 class LabJack():      
-    '''Access LabJack device to read temp from probe 
+    '''Access LabJack device to read temp from probe, through the shared device 
     '''
     
     def __init__(self, config):
-        '''Open connection to LabJack
+        '''Get shared LabJack, which opens on first use
         '''  
-        ip = config.settings['temp_settings']['ip']
-        try:
-            self.lj = ljm.openS("T4", "TCP", ip) 
-        except Exception as e:
-            print(f"Connection to LabJack failed on {ip}: {e}")
+        self.lj = labjacks.device(config.settings['temp_settings']['ip'])
                
     
     def read_temp(self):
-        '''Read temperature and potentiometer position from LabJack. Returns array of ADC values.
+        '''Read temperature from LabJack, in K.
         '''
         aNames = ["AIN0",]
-        temps = ljm.eReadNames(self.lj, len(aNames), aNames)
+        temps = self.lj.read(aNames)
         temp = temps[0]*55.56 - 17.78 + 273.15
         return temp
         
-    # def __del__(self):
-        # '''Close on delete'''
-        # ljm.close(self.lj) 
-        
         
 class TempThread(QThread):
     '''Thread class for chassis temperature monitor
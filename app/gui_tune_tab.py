@@ -9,6 +9,7 @@ import pyqtgraph as pg
  
 from app.classes import RunningScan
 from app.daq import DAQConnection
+from app.tune import TuneOptimizer
 
   
 class TuneTab(QWidget):
@@ -37,6 +38,10 @@ class TuneTab(QWidget):
         self.tune_box.layout().addWidget(self.run_button)
         self.run_button.clicked.connect(self.run_pushed)
         self.run_button.setEnabled(False)
+        self.auto_button = QPushButton('Auto Tune', checkable=True)
+        self.tune_box.layout().addWidget(self.auto_button)
+        self.auto_button.clicked.connect(self.auto_pushed)
+        self.auto_button.setEnabled(False)
         self.progress_bar = QProgressBar()                                 # Progress bar
         self.progress_bar = QProgressBar()                                  # Progress bar
         self.progress_bar.setTextVisible(False)
@@ -161,6 +166,7 @@ class TuneTab(QWidget):
             self.run_button.setText('Stop')
             self.start_thread()
             self.parent.run_toggle()
+            self.auto_button.setEnabled(False)
                    
         else:
             self.abort_run()
@@ -177,10 +183,35 @@ class TuneTab(QWidget):
         self.tune_thread.finished.connect(self.finished)
         self.tune_thread.start()
     
+    def auto_pushed(self):
+        '''Start automatic tune, or stop it keeping the best settings found so far'''
+        if self.auto_button.isChecked():
+            self.status_bar.showMessage(f"Automatic tune running, for up to {self.parent.config.settings['auto_tune']['time_budget']} s...")
+            self.auto_button.setText('Stop Tune')
+            self.running_scan = RunningScan(self.parent.config, int(self.avg_value.text()))
+            self.running = True
+            self.tune_thread = AutoTuneThread(self, self.parent.config)
+            self.tune_thread.reply.connect(self.add_sweeps)
+            self.tune_thread.tuned.connect(self.tuned)
+            self.tune_thread.finished.connect(self.finished)
+            self.tune_thread.start()
+            self.parent.run_toggle()
+            self.run_button.setEnabled(False)
+        else:
+            self.abort_run()
+
+    def tuned(self, best):
+        '''Show DAC settings automatic tune found, already sent by its thread'''
+        if 2 in best:
+            self.diode_spin.setValue(best[2]*100)
+        if 1 in best:
+            self.phase_spin.setValue(best[1]*100)
+        print('Automatic tune set DACs:', best)
+
     def add_sweeps(self,new_sigs):
         '''Add the tuple of sweeps to event'''
         self.running_scan.running_avg(new_sigs)
-        self.update_run_plot()
+        self.parent.renderer.request('tune_plot', self.update_run_plot, [self.diode_wid, self.phase_wid])
         if self.progress<100:
             self.progress+=10
         else:
@@ -193,6 +224,11 @@ class TuneTab(QWidget):
         self.progress_bar.setValue(self.progress)  
         self.status_bar.showMessage('Ready.')
         self.update_run_plot()
+        if self.auto_button.text() != 'Auto Tune':          # automatic tune done or stopped
+            self.running = False
+            self.auto_button.setChecked(False)
+            self.auto_button.setText('Auto Tune')
+            self.parent.run_toggle()
         
     def abort_run(self):
         '''Quit now'''
@@ -201,7 +237,7 @@ class TuneTab(QWidget):
     def change_avg(self,to_avg):
         '''Set the number to average'''
         if to_avg > 0:
-            self.running_scan.to_avg = int(to_avg)
+            self.running_scan.resize(int(to_avg))
         
     def update_run_plot(self):
         '''Update the running plots'''
@@ -253,8 +289,24 @@ class TuneThread(QThread):
             self.reply.emit(new_sigs)
             del self.daq
         self.finished.emit()
-        
 
 
+class AutoTuneThread(QThread):
+    '''Thread running automatic tune over one tune mode DAQ connection, see TuneOptimizer'''
+    reply = pyqtSignal(tuple)       # each chunk taken
+    tuned = pyqtSignal(dict)        # best DAC values keyed on channel
 
+    def __init__(self, parent, config):
+        QThread.__init__(self)
+        self.config = config
+        self.parent = parent
 
+    def run(self):
+        '''Run optimizer until done, out of time or tune tab stops running'''
+        try:
+            daq = DAQConnection(self.config, self.config.settings['fpga_settings']['timeout_tune'], True)
+            optimizer = TuneOptimizer(daq, self.config, self.reply.emit, lambda: not self.parent.running)
+            self.tuned.emit(optimizer.run())
+            del daq
+        except Exception as e:
+            print('Exception in auto tune thread: '+str(e))
@@ -0,0 +1,176 @@
+'''PyNMR, J.Maxwell 2020
+'''
+import time
+import socket
+import threading
+
+KEEPALIVE_IDLE = 30         # seconds idle before TCP keepalive probes, where the OS allows setting it
+
+sessions = {}               # dict of open Sessions keyed on (host, port)
+sessions_lock = threading.Lock()
+
+
+def session(host, port, timeout=2):
+    '''Shared session to instrument at host and port, opened on first use
+
+    Arguments:
+        host: IP address or hostname
+        port: TCP port
+        timeout: Seconds to wait on connect and replies, from the first caller
+    '''
+    with sessions_lock:
+        if (host, port) not in sessions:
+            sessions[(host, port)] = Session(host, port, timeout)
+        return sessions[(host, port)]
+
+
+def compound(commands):
+    '''Join SCPI commands into one message. Each header but common commands like *OPC? gets a leading colon, so it
+    is taken from the root of the command tree rather than after the previous one.
+
+    Arguments:
+        commands: List of command strings
+    '''
+    return ';'.join(c if c.startswith('*') else f':{c}' for c in commands)
+
+
+def close_all():
+    '''Close all sessions, on exit'''
+    with sessions_lock:
+        for s in sessions.values():
+            s.close()
+
+
+class Session():
+    '''Persistent connection to a line based instrument or Prologix GPIB controller, shared by everything talking to
+    that host and port. Connects on first use, reconnects and retries once if the connection has dropped, and
+    sends Prologix ++addr only when the GPIB address changes. Hold lock to keep a sequence of commands together,
+    ie selecting a channel then reading it.
+
+    Arguments:
+        host: IP address or hostname
+        port: TCP port
+        timeout: Seconds to wait on connect and replies
+
+    Attributes:
+        lock: Reentrant lock held for each command, and by callers for sequences
+        addr: GPIB address last sent with ++addr, None if not sent on this connection
+        connects: Number of connections made, for checking reuse
+    '''
+    def __init__(self, host, port, timeout=2):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.sock = None
+        self.addr = None
+        self.connects = 0
+
+    def connect(self):
+        '''Open connection with keepalive'''
+        self.close()
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+        self.connects += 1
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                try:
+                    self.sock.close()
+                except OSError:
+                    pass
+            self.sock = None
+            self.addr = None        # a new connection starts without the address selected
+
+    def send(self, data):
+        '''Send bytes, connecting if needed'''
+        if self.sock is None:
+            self.connect()
+        try:
+            self.sock.settimeout(self.timeout)
+            self.sock.sendall(data)
+        except OSError:
+            self.close()
+            raise
+
+    def drain(self):
+        '''Discard anything left unread, like a late reply to a query that timed out'''
+        if self.sock is None:
+            return
+        self.sock.setblocking(False)
+        try:
+            while self.sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.close()
+
+    def write(self, command, addr=None):
+        '''Send command line, first selecting GPIB address if given and changed. If the connection has dropped,
+        reconnects and sends once more, selecting the address again on the new connection.
+
+        Arguments:
+            command: Command string, without line ending
+            addr: GPIB address for Prologix controller, or None for plain instruments
+        '''
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if addr is not None and addr != self.addr:
+                        self.send(f"++addr {addr}\n".encode('ascii'))
+                        self.addr = addr
+                    self.send(f"{command}\n".encode('ascii'))
+                    return
+                except OSError:
+                    if attempt:
+                        raise
+
+    def query(self, command, addr=None, end=b'\n', timeout=None):
+        '''Send command and read reply up to end byte string. If the connection drops while waiting, reconnects
+        and asks once more.
+
+        Arguments:
+            command: Command string, without line ending
+            addr: GPIB address for Prologix controller, or None for plain instruments
+            end: End of reply
+            timeout: Seconds to wait for reply, if not the session timeout
+
+        Returns:
+            Reply string
+        '''
+        with self.lock:
+            for attempt in range(2):
+                self.drain()
+                self.write(command, addr)
+                try:
+                    return self.read_reply(command, end, timeout)
+                except ConnectionError:
+                    if attempt:
+                        raise
+
+    def read_reply(self, command, end, timeout):
+        '''Read reply to command up to end byte string, closing the connection if it fails'''
+        with self.lock:
+            deadline = time.monotonic() + (timeout or self.timeout)
+            reply = b''
+            while not reply.endswith(end):
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise TimeoutError(f"No reply to {command} from {self.host}:{self.port}")
+                try:
+                    self.sock.settimeout(left)
+                    data = self.sock.recv(4096)
+                except socket.timeout:
+                    raise TimeoutError(f"No reply to {command} from {self.host}:{self.port}")
+                except OSError:
+                    self.close()
+                    raise
+                if not data:
+                    self.close()
+                    raise ConnectionError(f"{self.host}:{self.port} closed connection")
+                reply += data
+            return reply.decode('ascii')
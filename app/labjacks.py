@@ -0,0 +1,141 @@
+'''PyNMR, J.Maxwell 2020
+'''
+import time
+import random
+import threading
+
+devices = {}                # dict of open Devices keyed on ip
+devices_lock = threading.Lock()
+
+
+def device(ip):
+    '''Shared LabJack at ip, opened on first use. An ip of 'mock' gives a stand-in device for trying things without one.
+
+    Arguments:
+        ip: IP address of LabJack T4, or 'mock'
+    '''
+    with devices_lock:
+        if ip not in devices:
+            devices[ip] = Device(ip, MockLJM() if ip == 'mock' else None)
+        return devices[ip]
+
+
+def close_all():
+    '''Close all devices, on exit'''
+    with devices_lock:
+        for d in devices.values():
+            d.close()
+
+
+class Device():
+    '''Single handle to a LabJack, shared by everything using it, like the microwave tuner and chassis temperature
+    monitor. Reads and writes are serialized by a lock, with all registers of a call read or written in one
+    eReadNames or eWriteNames. The handle is opened on first use and reopened on the next call after an error. The
+    last value and time of each register read or written is kept, so callers happy with a recent value needn't
+    go to the device.
+
+    Arguments:
+        ip: IP address of LabJack T4
+        ljm: LabJack ljm module, or a stand-in with the same calls. The driver is loaded on first open if None.
+
+    Attributes:
+        cache: Dict of (value, timestamp) keyed on register name
+        opens: Number of times handle has been opened, for checking reuse
+    '''
+    def __init__(self, ip, ljm=None):
+        self.ip = ip
+        self.ljm = ljm
+        self.lock = threading.RLock()
+        self.handle = None
+        self.cache = {}
+        self.opens = 0
+
+    def open(self):
+        '''Open handle, loading driver if needed'''
+        if self.ljm is None:
+            from labjack import ljm        # loads LabJack driver library, so only when a LabJack is used
+            self.ljm = ljm
+        self.handle = self.ljm.openS("T4", "TCP", self.ip)
+        self.opens += 1
+
+    def close(self):
+        with self.lock:
+            if self.handle is not None:
+                try:
+                    self.ljm.close(self.handle)
+                except Exception:
+                    pass
+            self.handle = None
+
+    def read(self, names, max_age=0):
+        '''Read registers, or return cached values if all were read within max_age
+
+        Arguments:
+            names: List of register names, like ["AIN4", "AIN5"]
+            max_age: Seconds old cached values can be to use them instead of reading
+
+        Returns:
+            List of values
+        '''
+        with self.lock:
+            now = time.time()
+            if max_age and all(n in self.cache and now - self.cache[n][1] <= max_age for n in names):
+                return [self.cache[n][0] for n in names]
+            if self.handle is None:
+                self.open()
+            try:
+                values = list(self.ljm.eReadNames(self.handle, len(names), names))
+            except Exception:
+                self.close()
+                raise
+            now = time.time()
+            self.cache.update({n: (v, now) for n, v in zip(names, values)})
+            return values
+
+    def write(self, names, values):
+        '''Write registers
+
+        Arguments:
+            names: List of register names, like ["DAC0", "DAC1"]
+            values: List of values to write
+        '''
+        with self.lock:
+            if self.handle is None:
+                self.open()
+            try:
+                self.ljm.eWriteNames(self.handle, len(names), names, values)
+            except Exception:
+                self.close()
+                raise
+            now = time.time()
+            self.cache.update({n: (v, now) for n, v in zip(names, values)})
+
+    def cached(self, name):
+        '''Last value of register and time it was read or written, or (None, 0) if never
+
+        Returns:
+            Tuple of value and timestamp
+        '''
+        return self.cache.get(name, (None, 0))
+
+
+class MockLJM():
+    '''Stand-in for the ljm module with the calls Device makes. Analog inputs read a little noise around set
+    levels, chosen so the chassis temperature reads near room temperature, and written registers read back.
+    '''
+    def __init__(self):
+        self.registers = {'AIN0': 0.86, 'AIN4': 1.5, 'AIN5': 2.5}
+        self.handles = 0
+
+    def openS(self, device_type, connection_type, identifier):
+        self.handles += 1
+        return self.handles
+
+    def close(self, handle):
+        pass
+
+    def eReadNames(self, handle, num_frames, names):
+        return [self.registers.get(n, 0) + (random.gauss(0, 0.002) if n.startswith('AIN') else 0) for n in names]
+
+    def eWriteNames(self, handle, num_frames, names, values):
+        self.registers.update(zip(names, values))
@@ -1,15 +1,24 @@
 import serial
 from serial.tools.list_ports import comports
 import time
+import itertools
+import threading
+from collections import deque
+from PyQt5.QtCore import QThread, pyqtSignal
 
 
 class MagnetControl():
-    '''Talks to Magnet PS via serial, contains magnet state attributes'''
-    
-    def __init__(self):
-    
+    '''Talks to Magnet PS via serial, contains magnet state attributes. All serial traffic goes through a
+    MagnetWorker thread, the only user of the port, so the display and status polling never interleave commands.
+
+    Arguments:
+        poll_time: Seconds between status reads while polling
+    '''
+
+    def __init__(self, poll_time=0.5):
+
         self.status = {}  # all magnet parameters, their query strings and description
-        
+
         self.status.update({ 'current' :    { 'value' : '0', 'query' : "IMAG?",     'text' : 'Magnet Current (A)'}})
         self.status.update({ 'ps_current' : { 'value' : '0', 'query' : "IOUT?",     'text' : 'Power Supply Current (A)'}})
         self.status.update({ 'v_mag' :      { 'value' : '0', 'query' : "VMAG?",     'text' : 'Voltage (V)'}})
@@ -20,7 +29,7 @@ class MagnetControl():
        # self.status.update({ 'id' :         { 'value' : '0', 'query' : "*IDN?",     'text' : 'Device ID'}})
 
 
-        self.commands = {       # command strings 
+        self.commands = {       # command strings
             'low_lim' : "LLIM ",
             'up_lim' : "ULIM ",
             'ps_on' : "PSHTR ON",
@@ -31,9 +40,11 @@ class MagnetControl():
             'sw_zero' : "SWEEP ZERO",
             'complete' : "OPC?"
             }
-        self.fast_mode = ''    
+        self.fast_mode = ''
+        self.poll_time = poll_time
         self.s = serial.Serial()
-    
+        self.worker = None
+
     def fast(self, bool):
         '''Select fast for sweep mode'''
         if bool:
@@ -43,69 +54,285 @@ class MagnetControl():
 
     def toggle(self):
         '''Toggle switch heater'''
-        if '0' in self.status['switch']:
+        if '0' in self.status['switch']['value']:
             self.write_port(self.commands['ps_on'])
         else:
             self.write_port(self.commands['ps_off'])
-            
-        self.read_all()    
-            
-     
+
+        self.read_all()
+
+
     def get_ports(self):
-        '''Return available serial ports. Port is tuple: (port, desc, hwid)'''
-        return sorted(comports())
-        
+        '''Return available serial ports, then 'fake' for a FakeMagnet. Port is tuple: (port, desc, hwid)'''
+        return sorted(comports()) + [('fake', 'Simulated magnet supply', '')]
+
     def set_port(self, port):
+        '''Set port name, or 'fake' for a FakeMagnet'''
         self.port = port
-    
-    def close_port (self):
-        '''Close serial connection'''
-        self.s.close()
-        
+
     def open_port (self):
-        '''Open serial connection'''
+        '''Open serial connection and start worker'''
         #port = "/dev/ttyUSB1"
-        self.s=serial.Serial(self.port, baudrate=9600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=0.1) 
-   
+        if self.port == 'fake':
+            self.s = FakeMagnet()
+        else:
+            self.s=serial.Serial(self.port, baudrate=9600, bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE, timeout=0.5)
+
         if self.s.is_open:
+            self.worker = MagnetWorker(self)
+            self.worker.start()
             self.read_all()
             self.write_port('REMOTE')
-        
+
     def close_port(self):
+        '''Return supply to local control, stop worker once it has sent everything, and close serial connection'''
         if self.s.is_open:
             self.write_port('LOCAL')
+            self.worker.close()
             self.s.close()
-        
-    def write_port(self, string):
-        '''Write to serial'''
-        self.s.flushInput()
-        self.s.flushOutput()
-        self.s.write((string+"\n").encode())
-
-    def read_port(self):
-        '''Read from serial port until encounter space'''
-        message = ""
-        while True:
-            message1 = self.s.readline().decode("utf-8") 
-            message2 = self.s.readline().decode("utf-8")    
-            return message2
-                  
-    def read_all(self):
-        '''Read all magnet parameters and write to instance state attribute'''
+
+    def write_port(self, string, timeout=1):
+        '''Queue command for worker
+
+        Returns:
+            Request, to wait on if needed
+        '''
+        return self.worker.submit(string, False, timeout)
+
+    def query(self, string, timeout=1):
+        '''Send query and wait for reply
+
+        Returns:
+            Reply string
+        '''
+        return self.worker.submit(string, True, timeout).wait()
+
+    def read_all(self, wait=True):
+        '''Read all magnet parameters and write to instance state attribute. Joins any status read already waiting.
+
+        Arguments:
+            wait: Wait for the read, otherwise the worker's status_now signal tells when it is done
+
+        Returns:
+            Request
+        '''
+        request = self.worker.read_status()
+        if wait:
+            request.wait()
+        return request
+
+    def poll(self, on):
+        '''Turn status polling every poll_time on or off'''
+        self.worker.set_polling(on)
+
+    def status_query(self):
+        '''Joined query of all status parameters, and their keys in reply order'''
         keys = sorted(self.status.keys())
-        command_string = ';'.join([self.status[x]['query'] for x in keys])
-        self.write_port(command_string)         
-        time.sleep(0.1)
-        replies = self.read_port().split(';')
-        for key, value in zip(keys,replies):
-            self.status[key]['value'] = value 
-      
-        self.s.flushInput()
-        self.s.flushOutput()  
-        
+        return ';'.join([self.status[x]['query'] for x in keys]), keys
+
+    def set_status(self, reply):
+        '''Fill status values from reply to status query'''
+        command, keys = self.status_query()
+        for key, value in zip(keys, reply.split(';')):
+            self.status[key]['value'] = value
+
+
+class Request():
+    '''Command queued for the magnet worker, and its reply once done
+
+    Arguments:
+        id: Request number
+        command: Command string, without line ending
+        query: Whether a reply line follows the echo
+        timeout: Seconds to wait for each line from supply
+    '''
+    def __init__(self, id, command, query, timeout):
+        self.id = id
+        self.command = command
+        self.query = query
+        self.timeout = timeout
+        self.done = threading.Event()
+        self.reply = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        '''Wait for request to be done, by default for as long as the worker could take over it
+
+        Returns:
+            Reply string, or None for commands
+        '''
+        if not self.done.wait(timeout if timeout is not None else 2*self.timeout + 1):
+            raise TimeoutError(f"No reply to {self.command}")
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+
+class MagnetWorker(QThread):
+    '''Thread owning the magnet supply serial port. Sends queued requests in order, one at a time, reading the echo
+    and any reply of each before the next. Status reads requested while one is still waiting are joined to it,
+    so polling and the display asking at once make one read. While polling, status is read every poll_time.
+
+    Arguments:
+        mc: MagnetControl with open port and status to fill
+    '''
+    max_backoff = 16                    # longest wait after failed status reads, in poll times
+    status_now = pyqtSignal()           # status values updated
+    reply = pyqtSignal(int, str)        # request id and reply, for each request done
+    def __init__(self, mc):
+        QThread.__init__(self)
+        self.mc = mc
+        self.queue = deque()
+        self.ready = threading.Condition()      # guards queue, wakes worker
+        self.ids = itertools.count(1)
+        self.status_request = None              # waiting status read, to join
+        self.polling = False
+        self.running = True
+
+    def submit(self, command, query=False, timeout=1):
+        '''Queue request
+
+        Returns:
+            Request
+        '''
+        with self.ready:
+            request = Request(next(self.ids), command, query, timeout)
+            self.queue.append(request)
+            self.status_request = None              # later status reads must follow this
+            self.ready.notify()
+            return request
+
+    def read_status(self):
+        '''Queue status read, or join the one waiting
+
+        Returns:
+            Request
+        '''
+        with self.ready:
+            if self.status_request is None:
+                self.status_request = self.submit(self.mc.status_query()[0], True)
+            return self.status_request
+
+    def set_polling(self, on):
+        with self.ready:
+            self.polling = on
+            self.ready.notify()
+
+    def close(self):
+        '''Stop after sending everything queued'''
+        with self.ready:
+            self.running = False
+            self.ready.notify()
+        self.wait()
+
+    def run(self):
+        '''Main request loop'''
+        next_poll = time.monotonic()
+        failures = 0                    # status reads failed in a row, doubling the wait before the next
+        while True:
+            with self.ready:
+                while self.running and not self.queue:
+                    if self.polling and time.monotonic() >= next_poll:
+                        self.read_status()
+                    elif self.polling:
+                        self.ready.wait(next_poll - time.monotonic())
+                    else:
+                        self.ready.wait()
+                if not self.queue:
+                    break
+                request = self.queue.popleft()
+                if request is self.status_request:
+                    self.status_request = None
+            self.send(request)
+            if request.query and request.command == self.mc.status_query()[0]:
+                if request.error is None:
+                    self.mc.set_status(request.reply)
+                    failures = 0
+                    self.status_now.emit()
+                else:
+                    failures += 1
+                next_poll = time.monotonic() + self.mc.poll_time*min(2**failures, self.max_backoff)
+            request.done.set()
+            self.reply.emit(request.id, request.reply or '')
+
+    def send(self, request):
+        '''Write request and read its echo, and reply if a query'''
+        s = self.mc.s
+        try:
+            s.timeout = request.timeout
+            s.reset_input_buffer()
+            s.write((request.command+"\n").encode())
+            lines = [s.readline() for i in range(2 if request.query else 1)]
+            if not lines[-1].endswith(b'\n'):
+                raise TimeoutError(f"No reply to {request.command}")
+            if request.query:
+                request.reply = lines[-1].decode("utf-8").strip()
+        except Exception as e:
+            request.error = e
+            print(f"Magnet supply request {request.command} failed: {e}")
+
+
+class FakeMagnet():
+    '''Stand-in for the magnet supply serial port, with the calls MagnetWorker makes. Echoes each command, answers
+    the status queries, and sweeps the current toward the limits at a fixed rate, faster in fast mode.
+
+    Arguments:
+        rate: Sweep rate in A/s
+    '''
+    def __init__(self, rate=0.5):
+        self.rate = rate
+        self.is_open = True
+        self.timeout = 0.5
+        self.lines = deque()
+        self.current = 0.
+        self.limits = {'ULIM': 0., 'LLIM': 0.}
+        self.sweep = 'pause'
+        self.fast = False
+        self.heater = '0'
+        self.last = time.monotonic()
+        self.writes = 0
+
+    def step(self):
+        '''Move current toward sweep target since last step'''
+        now = time.monotonic()
+        target = {'sweep up': self.limits['ULIM'], 'sweep down': self.limits['LLIM'], 'sweep zero': 0.}.get(self.sweep)
+        if target is not None:
+            move = self.rate*(10 if self.fast else 1)*(now - self.last)
+            self.current = min(self.current + move, target) if target > self.current else max(self.current - move, target)
+        self.last = now
+
+    def write(self, data):
+        self.writes += 1
+        self.step()
+        command = data.decode().strip()
+        self.lines.append(command + '\r\n')
+        replies = [self.answer(c.strip()) for c in command.split(';')]
+        replies = [r for r in replies if r is not None]
+        if replies:
+            self.lines.append(';'.join(replies) + '\r\n')
 
-        
-                
+    def answer(self, command):
+        '''Carry out one command, returning reply for queries'''
+        name, _, arg = command.partition(' ')
+        values = {'IMAG?': f"{self.current:.4f}A", 'IOUT?': f"{self.current:.4f}A", 'VMAG?': '0.000V', 'ULIM?': f"{self.limits['ULIM']:.4f}A",
+                  'LLIM?': f"{self.limits['LLIM']:.4f}A", 'SWEEP?': self.sweep + (' fast' if self.fast else ''), 'PSHTR?': self.heater,
+                  'OPC?': '1', '*IDN?': 'FakeMagnet'}
+        if name in values:
+            return values[name]
+        if name in self.limits:
+            self.limits[name] = float(arg)
+        elif name == 'SWEEP':
+            self.sweep = 'pause' if 'PAUSE' in arg else 'sweep ' + arg.split()[0].lower()
+            self.fast = 'FAST' in arg
+        elif name == 'PSHTR':
+            self.heater = '1' if arg == 'ON' else '0'
+        return None
 
+    def readline(self):
+        return self.lines.popleft().encode() if self.lines else b''
 
+    def reset_input_buffer(self):
+        self.lines.clear()
 
+    def close(self):
+        self.is_open = False
@@ -1,17 +1,20 @@
 '''PyNMR, J.Maxwell 2021
 '''
-import telnetlib, time
-from labjack import ljm
+import time
+import asyncio
 import requests
 from PyQt5.QtCore import QThread, pyqtSignal, Qt
 
+from app import instruments, labjacks
+
   
 class MicrowaveThread(QThread):
-    '''Thread class for microwave loop
+    '''Thread class for microwave loop. Counter and power meter are each polled on their own schedule, concurrently,
+    so a slow reply from one doesn't hold up the other. Each reading is sent with the time it was taken.
     Args:
         config: Config object of settings
     '''
-    reply = pyqtSignal(tuple)       # reply signal
+    reply = pyqtSignal(tuple)       # reply signal, tuple of kind ('freq' or 'power'), reading and timestamp
     finished = pyqtSignal()       # finished signal
     def __init__(self, parent, config):
         QThread.__init__(self)
@@ -31,41 +34,42 @@ class MicrowaveThread(QThread):
             time.sleep(self.config.settings['uWave_settings']['monitor_time'])
         except Exception as e:
             print('Exception starting counter thread, lost connection: '+str(e))
+            self.finished.emit()
+            return
       
+        asyncio.run(self.poll())
+          
+        self.finished.emit()
+        del self.count
+        
+    async def poll(self):
+        '''Poll counter and power meter concurrently until disabled'''
+        await asyncio.gather(self.poll_one('freq', self.count.read_freq, 'Counter'),
+                             self.poll_one('power', self.pow_meter.read_power, 'Power meter'))
+                             
+    async def poll_one(self, kind, read, name):
+        '''Read instrument every monitor_time, counted from the start of each read, and send each reading
+        
+        Args:
+            kind: Kind of reading sent, 'freq' or 'power'
+            read: Blocking read method of instrument, run in a worker thread
+            name: Instrument name for messages
+        '''
+        interval = self.config.settings['uWave_settings']['monitor_time']
+        next_time = time.monotonic()
         while self.parent.enable_button.isChecked():       
             try:        
-                freq = self.count.read_freq()
-            except Exception as e:
-                print(f"Counter read failed: {e}")  
-                freq = "Read Error"
-                #self.parent.enable_button.toggle()
-                #self.parent.enable_pushed()
-                #break
-                
-            try:        
-                power = self.pow_meter.read_power()
+                value = await asyncio.to_thread(read)
             except Exception as e:
-                print(f"Power meter read failed: {e}")  
-                power = "Read Error"
-                #self.parent.enable_button.toggle()
-                #self.parent.enable_pushed()
-                #break
-                
-            pot, temp = 0, 0
-            # Disabling Readback of uwave pot and temp for now 5/26/22     
-            #try: 
-            #    pot, temp = self.parent.utune.read_back()
-            #except Exception as e:                
-            #    print('Exception reading LabJack: '+str(e))
-                
+                print(f"{name} read failed: {e}")  
+                value = "Read Error"
+            
             try:
-                self.reply.emit((freq, pot, temp, power))
+                self.reply.emit((kind, value, time.time()))
             except Exception as e:                
                 print("Couldn't send microwave reply: "+str(e))
-            time.sleep(self.config.settings['uWave_settings']['monitor_time'])
-          
-        self.finished.emit()
-        del self.count
+            next_time = max(next_time + interval, time.monotonic())
+            await asyncio.sleep(next_time - time.monotonic())
 
 
 
@@ -77,28 +81,24 @@ class Counter():
     '''    
     
     def __init__(self, config):    
-        '''Open connection to GPIB, send commands for all settings. Close.  
+        '''Send commands for all settings over shared session to GPIB controller, which stays open  
         '''
         self.host = config.settings['uWave_settings']['counter']['ip']
         self.port = config.settings['uWave_settings']['counter']['port']   
-        self.timeout = config.settings['uWave_settings']['counter']['timeout']              # Telnet timeout in secs
+        self.timeout = config.settings['uWave_settings']['counter']['timeout']              # timeout in secs
+        self.addr = config.settings['uWave_settings']['counter']['addr']
+        self.session = instruments.session(self.host, self.port, self.timeout)
 
  
         try:
-            self.tn = telnetlib.Telnet(self.host, port=self.port, timeout=self.timeout)
-            
-            # Write all required settings
-            #self.tn.write(bytes(f"FE 1\n", 'ascii'))  # Fetch setup 1
-            
-            self.tn.write(bytes(f"++addr {config.settings['uWave_settings']['counter']['addr']}\n", 'ascii'))
-            self.tn.write(bytes(f"BA {config.settings['uWave_settings']['counter']['band']}\n", 'ascii'))
-            self.tn.write(bytes(f"SU {config.settings['uWave_settings']['counter']['subband']}\n", 'ascii'))
-            self.tn.write(bytes(f"CE {config.settings['uWave_settings']['counter']['cent_freq']} GHz\n", 'ascii'))
-            self.tn.write(bytes(f"SA {config.settings['uWave_settings']['counter']['rate']} ms\n", 'ascii'))
-            
-            
-            #self.tn.write(bytes(f"OU DE\n", 'ascii'))  # Read displayed data
-            #freq = self.tn.read_some().decode('ascii')        
+            with self.session.lock:
+                # Write all required settings
+                #self.session.write("FE 1", addr=self.addr)  # Fetch setup 1
+                
+                self.session.write(f"BA {config.settings['uWave_settings']['counter']['band']}", addr=self.addr)
+                self.session.write(f"SU {config.settings['uWave_settings']['counter']['subband']}", addr=self.addr)
+                self.session.write(f"CE {config.settings['uWave_settings']['counter']['cent_freq']} GHz", addr=self.addr)
+                self.session.write(f"SA {config.settings['uWave_settings']['counter']['rate']} ms", addr=self.addr)
                      
             print(f"Successfully sent settings to counter on {self.host}")
             
@@ -107,23 +107,16 @@ class Counter():
     
     def read_freq(self):
         '''Read frequency from open connection'''        
-        #try:
-        self.tn.write(bytes(f"OU DE\n", 'ascii'))  # Read displayed data
-        freq = self.tn.read_until(b'\r', timeout=self.timeout).decode('ascii')  
-        #print(int(freq.strip()))
+        freq = self.session.query("OU DE", addr=self.addr, end=b'\r')  # Read displayed data
         try:
             ret = int(freq.strip())
         except ValueError:
             ret = 'Read Error'
         return ret  
-        #except exception as e:
-        #   print(f"GPIB connection failed on {self.host}: {e}")  
         
     def close(self):           
-        try:
-            tn.close()
-        except Exception as e:
-            print(f"GPIB connection failed on {self.host}: {e}")
+        '''Nothing to close, the session is shared and closed on exit by instruments.close_all'''
+        pass
 
  
 class PowMeter():
@@ -140,16 +133,14 @@ class PowMeter():
         self.port = config.settings['uWave_settings']['power_meter']['port']   
         self.timeout = config.settings['uWave_settings']['power_meter']['timeout']              # Telnet
         self.freq = config.settings['uWave_settings']['power_meter']['freq']  # center freq setting, GHz
+        self.session = instruments.session(self.host, self.port, self.timeout)
 
  
         try:
-            self.tn = telnetlib.Telnet(self.host, port=self.port, timeout=self.timeout)
-            
-            # Write all required settings
-            self.tn.write(bytes(f"sens:freq {self.freq}\n", 'ascii'))  # Write freq   
-            self.tn.write(bytes(f"unit:pow w\n", 'ascii'))  # Write unit      
-                     
-            #print(f"Successfully sent settings to GPIB on {self.host}")
+            with self.session.lock:
+                # Write all required settings
+                self.session.write(f"sens:freq {self.freq}")  # Write freq   
+                self.session.write("unit:pow w")  # Write unit      
             
         except Exception as e:
             print(f"Connection to serial port failed on {self.host}: {e}")
@@ -157,10 +148,10 @@ class PowMeter():
     def read_power(self):
         '''Read power from open connection'''          
         try:
-            self.tn.write(bytes(f"read?\n", 'ascii'))  # Read power
-            power = self.tn.read_some().decode('ascii')              
+            power = self.session.query("read?")  # Read power
         except Exception as e:
             print(f"Connection to serial port failed on {self.host}: {e}")
+            raise
               
         if 'U' in power:     # turn into float of mW 
             p = power.strip().split()
@@ -173,10 +164,8 @@ class PowMeter():
         return power
         
     def close(self):           
-        try:
-            tn.close()
-        except Exception as e:
-            print(f"Network to serial connection failed on {self.host}: {e}")
+        '''Nothing to close, the session is shared and closed on exit by instruments.close_all'''
+        pass
 
 
 class NetRelay():
@@ -245,17 +234,13 @@ class NetRelay():
            
            
 class LabJack():      
-    '''Access LabJack device to change microwave frequency, readback temp, pot      
+    '''Access LabJack device to change microwave frequency, readback temp, pot, through the shared device      
     '''
     
     def __init__(self, config):
-        '''Open connection to LabJack
+        '''Get shared LabJack, which opens on first use
         '''  
-        ip = config.settings['uWave_settings']['lj-ip']
-        try:
-            self.lj = ljm.openS("T4", "TCP", ip) 
-        except Exception as e:
-            print(f"Connection to LabJack failed on {ip}: {e}")
+        self.lj = labjacks.device(config.settings['uWave_settings']['lj-ip'])
         
     def change_freq(self, direction):
         '''Write to LabJack to change microwave frequency up or down 
@@ -264,7 +249,7 @@ class LabJack():
         aNames = ["DAC0","DAC1"]
                
         aValues = [0, 0]
-        ljm.eWriteNames(self.lj, len(aNames), aNames, aValues)
+        self.lj.write(aNames, aValues)
         time.sleep(0.128)
             
         if "up" in direction:
@@ -274,17 +259,11 @@ class LabJack():
         else:    
             aValues = [0, 0]
         
-        ljm.eWriteNames(self.lj, len(aNames), aNames, aValues)
+        self.lj.write(aNames, aValues)
         
     
     def read_back(self):
         '''Read temperature and potentiometer position from LabJack. Returns array of ADC values.
         '''
         aNames = ["AIN4","AIN5"]
-        return ljm.eReadNames(self.lj, len(aNames), aNames)
-        
-    # def __del__(self):
-        # '''Close on delete'''
-        # ljm.close(self.lj) 
-            
-    
+        return self.lj.read(aNames)
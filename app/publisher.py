@@ -0,0 +1,202 @@
+'''PyNMR, J.Maxwell 2020
+'''
+import json
+import time
+import struct
+import socket
+import datetime
+import threading
+from collections import deque
+import numpy as np
+
+HEADER = struct.Struct('<4sBBIdI')      # magic, version, frame type, sequence number, unix time, payload length
+CHUNK = struct.Struct('<HHIII')         # chunk number, sweeps in chunk, sweeps so far, sweeps in event, points
+MAGIC = b'PNMR'
+VERSION = 1
+CHUNK_FRAME = 1
+EVENT_FRAME = 2
+SEND_TIMEOUT = 10      # seconds a subscriber can stop reading before it is dropped
+
+
+class Publisher():
+    '''Publishes each chunk during acquisition and each closed event to any number of subscribers on a local
+    TCP port, so other programs can follow live data without reading files or the display. Publishing never
+    blocks: each subscriber has its own queue and sending thread, and a subscriber too slow to keep up loses
+    its oldest frames, which shows as gaps in the sequence numbers. One that stops reading altogether is
+    dropped after SEND_TIMEOUT. Does nothing unless enabled.
+
+    Frames are a header of HEADER (little endian: 4 byte magic b'PNMR', version byte, frame type byte, uint32
+    sequence number, float64 unix time, uint32 payload length) followed by the payload.
+        Chunk frame (type 1): CHUNK (uint16 chunk number, uint16 sweeps in chunk, uint32 sweeps so far,
+            uint32 sweeps in event, uint32 points n), then float64 arrays of n frequencies in MHz, n phase
+            and n diode points, the chunk's average sweep.
+        Event frame (type 2): UTF-8 JSON dict of the event's scalars, EPICS reads and results.
+
+    Arguments:
+        settings: Dict of publish settings from config file, keys enable, port and queue
+    '''
+    def __init__(self, settings):
+        self.enable = settings['enable']
+        self.queue = settings['queue']      # frames held for each subscriber before dropping oldest
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.seq = 0
+        if not self.enable:
+            return
+        try:
+            self.server = socket.create_server(('127.0.0.1', settings['port']))
+            threading.Thread(target=self.accept, name='PublisherAccept', daemon=True).start()
+            print(f"Publishing chunks and events on port {settings['port']}.")
+        except OSError as e:
+            print(f"Publisher couldn't listen on port {settings['port']}: {e}")
+            self.enable = False
+
+    def accept(self):
+        '''Accept subscribers until closed'''
+        while True:
+            try:
+                conn, addr = self.server.accept()
+            except OSError:
+                return
+            conn.settimeout(SEND_TIMEOUT)
+            sub = Subscription(conn, self.queue)
+            with self.lock:
+                self.subscribers.append(sub)
+            threading.Thread(target=self.send_loop, args=(sub,), name='PublisherSend', daemon=True).start()
+
+    def send_loop(self, sub):
+        '''Send queued frames to subscriber until it disconnects'''
+        try:
+            while True:
+                frame = sub.next()
+                if frame is None:
+                    break
+                sub.conn.sendall(frame)
+        except OSError:
+            pass
+        with self.lock:
+            if sub in self.subscribers:
+                self.subscribers.remove(sub)
+        sub.conn.close()
+
+    def publish(self, type, payload):
+        '''Frame payload and queue it for each subscriber'''
+        if not self.enable:
+            return
+        with self.lock:
+            self.seq += 1
+            frame = HEADER.pack(MAGIC, VERSION, type, self.seq & 0xFFFFFFFF, time.time(), len(payload)) + payload
+            for sub in self.subscribers:
+                sub.put(frame)
+
+    def chunk(self, new_sigs, freq_list, rec_sweeps, sweeps):
+        '''Publish chunk as run thread receives it
+
+        Args:
+            new_sigs: Chunk tuple of chunk number, sweeps in chunk, phase and diode arrays
+            freq_list: Frequency points of sweep
+            rec_sweeps: Sweeps received so far in event, including this chunk
+            sweeps: Sweeps to take in event
+        '''
+        if not (self.enable and self.subscribers):
+            return
+        chunk_num, num_in_chunk, phase, diode = new_sigs
+        points = np.concatenate((freq_list, phase, diode)).astype('<f8')
+        self.publish(CHUNK_FRAME, CHUNK.pack(chunk_num & 0xFFFF, num_in_chunk, rec_sweeps, sweeps, len(phase)) + points.tobytes())
+
+    def event(self, event):
+        '''Publish scalars of closed event'''
+        if not (self.enable and self.subscribers):
+            return
+        scalars = {'sweeps':event.scan.num, 'channel':event.config.channel['name'], 'epics':event.epics, 'results':event.results,
+                   'timings':event.timings}
+        for key, entry in event.__dict__.items():
+            if isinstance(entry, (bool, int, float, str)):
+                scalars[key] = entry
+            elif isinstance(entry, np.number):
+                scalars[key] = entry.item()
+            elif isinstance(entry, datetime.datetime):
+                scalars[key] = str(entry)
+        self.publish(EVENT_FRAME, json.dumps(scalars, default=str).encode())
+
+    def close(self):
+        '''Stop accepting and drop subscribers'''
+        if not self.enable:
+            return
+        self.enable = False
+        self.server.close()
+        with self.lock:
+            for sub in self.subscribers:
+                sub.put(None)
+
+
+class Subscription():
+    '''Subscriber connection with bounded queue of frames waiting to be sent
+
+    Arguments:
+        conn: Connected socket
+        size: Frames to hold before dropping oldest
+    '''
+    def __init__(self, conn, size):
+        self.conn = conn
+        self.frames = deque(maxlen=size)
+        self.ready = threading.Condition()
+        self.dropped = 0
+
+    def put(self, frame):
+        '''Queue frame, dropping oldest if full. None closes.'''
+        with self.ready:
+            if len(self.frames) == self.frames.maxlen:
+                self.dropped += 1
+            self.frames.append(frame)
+            self.ready.notify()
+
+    def next(self):
+        '''Wait for and return next frame'''
+        with self.ready:
+            while not self.frames:
+                self.ready.wait()
+            return self.frames.popleft()
+
+
+class Subscriber():
+    '''Blocking client reading frames from a Publisher, for monitors and scripts
+
+    Arguments:
+        port: Publisher TCP port
+        host: Publisher host, local by default
+        timeout: Seconds to wait for each frame, None to wait forever
+    '''
+    def __init__(self, port, host='127.0.0.1', timeout=None):
+        self.s = socket.create_connection((host, port))
+        self.s.settimeout(timeout)
+        self.file = self.s.makefile('rb')
+
+    def read(self):
+        '''Read next frame
+
+        Returns:
+            Dict of type ('chunk' or 'event'), seq and time, with chunk_num, num_in_chunk, rec_sweeps, sweeps,
+            freq_list, phase and diode for chunks, or the event scalars for events
+        '''
+        header = self.file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ConnectionError('Publisher closed connection')
+        magic, version, type, seq, stamp, length = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError('Not a PyNMR frame')
+        payload = self.file.read(length)
+        frame = {'seq':seq, 'time':stamp}
+        if type == CHUNK_FRAME:
+            chunk_num, num_in_chunk, rec_sweeps, sweeps, n = CHUNK.unpack_from(payload)
+            points = np.frombuffer(payload, dtype='<f8', offset=CHUNK.size).reshape(3, n)
+            frame.update({'type':'chunk', 'chunk_num':chunk_num, 'num_in_chunk':num_in_chunk, 'rec_sweeps':rec_sweeps,
+                          'sweeps':sweeps, 'freq_list':points[0], 'phase':points[1], 'diode':points[2]})
+        else:
+            frame.update(json.loads(payload))
+            frame['type'] = 'event'
+        return frame
+
+    def close(self):
+        self.file.close()
+        self.s.close()
@@ -0,0 +1,80 @@
+'''PyNMR, J.Maxwell 2020
+'''
+import numpy as np
+
+from app.analysis import polyfit_wings, sum_all, sum_range, deuteron_pol, DeuteronFitter
+
+
+class Recipe():
+    '''Analysis steps chosen from settings, without the analysis tab widgets, for the headless daemon.
+    Each step takes an event and returns as the matching analysis tab option's result method.
+
+    Arguments:
+        settings: Settings dict from config file, using the recipe of the daemon settings and the analysis settings
+
+    Attributes:
+        base: Baseline method, 'standard' or 'none'
+        sub: Fit subtraction method, 'polyfit' or 'none'
+        res: Results method, 'sum_all', 'sum_range' or 'deuteron'
+        message: Text describing last result
+        fitter: DeuteronFitter for the deuteron results method, or None
+    '''
+    def __init__(self, settings):
+        recipe = settings['daemon']['recipe']
+        self.wings = sorted(settings['analysis']['wings'])
+        self.range = sorted(settings['analysis']['sum_range'])
+        self.d_params = dict(settings['analysis']['d_fit_params'])
+        self.order = recipe['poly_order']
+        self.base = getattr(self, f"base_{recipe['base']}")
+        self.sub = getattr(self, f"sub_{recipe['sub']}")
+        self.res = getattr(self, f"res_{recipe['res']}")
+        self.message = ''
+        self.fitter = DeuteronFitter(settings['analysis']) if recipe['res'] == 'deuteron' else None
+
+    def base_standard(self, event):
+        '''Subtract baseline selected for event'''
+        return event.baseline, event.scan.phase - event.baseline
+
+    def base_none(self, event):
+        '''No baseline subtraction'''
+        return np.zeros(len(event.scan.phase)), event.scan.phase
+
+    def sub_polyfit(self, event):
+        '''Polynomial fit to wings of baseline subtracted sweep, returning fit and fit subtracted sweep'''
+        sweep = event.basesub
+        fit, pf, pstd, r_squared = polyfit_wings(event.scan.freq_list, sweep, self.wings, self.order)
+        return fit, sweep - fit
+
+    def sub_none(self, event):
+        '''No fit subtraction'''
+        return np.zeros(len(event.basesub)), event.basesub
+
+    def res_sum_all(self, event):
+        '''Sum of all points'''
+        data, area = sum_all(event)
+        self.message = f"Area: {area}"
+        return data, area, area*event.cc
+
+    def res_sum_range(self, event):
+        '''Sum of points within range'''
+        data, area = sum_range(event, self.range)
+        self.message = f"Area: {area}"
+        return data, area, area*event.cc
+
+    def res_deuteron(self, event):
+        '''Deuteron lineshape fit, returning fit, r asymmetry in place of area, and polarization'''
+        res = self.fitter.fit(event.scan.freq_list, event.fitsub, self.d_params)
+        if res is None:
+            self.message = f"Deuteron fits timed out after {self.fitter.pool_settings['timeout']}s."
+            return np.full(len(event.fitsub), np.nan), np.nan, np.nan      # no result, not zero polarization
+        if res['success']:      # start from these next time
+            self.d_params = res['params']
+        r = res['params']['r']
+        pol = deuteron_pol(r)
+        self.message = f"Polarization: {pol*100:.2f}%, r: {r:.4f}"
+        return res['best_fit'], r, pol
+
+    def close(self):
+        '''Shut down deuteron fit pool, on exit'''
+        if self.fitter:
+            self.fitter.close()
@@ -0,0 +1,79 @@
+'''PyNMR, J.Maxwell 2020
+'''
+import time
+from PyQt5.QtCore import QObject, QTimer
+
+from app.trace import tracer
+
+
+class RenderScheduler(QObject):
+    '''Coalesces plot repaints so data can arrive at any rate without redrawing more often than can be seen. Tabs
+    mark a plot dirty with its update function as data comes in; all dirty plots are repainted together at most fps
+    times a second, each once with its latest data, on the first request after the interval or by timer after the
+    last request. Plot widgets are painted right away rather than at Qt's next paint, so the time measured covers
+    both setting the data and painting it. When repaints take more than the load fraction of the GUI thread's time
+    the rate is lowered, down to min_fps, and raised again as they speed up.
+
+    Arguments:
+        settings: Dict of render settings from config file, keys fps, min_fps and load
+
+    Attributes:
+        interval: Current seconds between repaints
+        render_time: Smoothed seconds a repaint takes
+        renders: Number of repaints done
+        requests: Number of repaints asked for
+    '''
+    def __init__(self, settings):
+        super().__init__()
+        self.min_interval = 1/settings['fps']
+        self.max_interval = 1/settings['min_fps']
+        self.load = settings['load']
+        self.interval = self.min_interval
+        self.render_time = 0
+        self.last = 0
+        self.dirty = {}             # update functions and widgets of plots to repaint, keyed on name
+        self.renders = 0
+        self.requests = 0
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.render)
+
+    def request(self, name, update, widgets=()):
+        '''Mark plot dirty, to be repainted at the next frame
+
+        Arguments:
+            name: Name of plot, repeated requests for the same name are repainted once
+            update: Function setting plot from its latest data
+            widgets: Plot widgets update changes, painted after it
+        '''
+        self.requests += 1
+        self.dirty[name] = (update, widgets)
+        wait = self.last + self.interval - time.perf_counter()
+        if wait <= 0:           # repaint now, as a busy event loop can hold off timers while chunks keep coming
+            self.flush()
+        elif not self.timer.isActive():     # repaint latest data once no more come
+            self.timer.start(int(wait*1000) + 1)
+
+    def flush(self):
+        '''Repaint dirty plots now, like at the end of a run'''
+        self.timer.stop()
+        self.render()
+
+    def render(self):
+        '''Repaint dirty plots and adjust interval to keep within load'''
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, {}
+        start = time.perf_counter()
+        with tracer.span('render', 'plot', plots=len(dirty)):
+            for update, widgets in dirty.values():
+                try:
+                    update()
+                    for widget in widgets:          # paint now, the paint Qt had pending is then done
+                        widget.viewport().repaint()
+                except Exception as e:
+                    print('Exception updating plot: '+str(e))
+        self.last = time.perf_counter()
+        self.render_time = 0.8*self.render_time + 0.2*(self.last - start) if self.renders else self.last - start
+        self.interval = min(max(self.render_time/self.load, self.min_interval), self.max_interval)
+        self.renders += 1
@@ -1,23 +1,19 @@
-import telnetlib
+from app import instruments
 
 class RFSwitch():
     '''Handle connection to Minicircuits RF switch via serial over ethernet. 
     '''
     def __init__(self, host, port, timeout):        
-        '''Open connection to Minicircuits RF Switch
+        '''Open connection to Minicircuits RF Switch, over a session shared with anything else using it
         Arguments:
             host: IP address
             port: Port of device
-            timeout: Telnet timeout in secs
+            timeout: Timeout in secs
         '''
         self.host = host
         self.port = port
         self.timeout = timeout
-        
-        try:
-            self.tn = telnetlib.Telnet(self.host, port=self.port, timeout=self.timeout)                  
-        except Exception as e:
-            print(f"RF Switch connection failed on {self.host}: {e}")
+        self.session = instruments.session(self.host, self.port, self.timeout)
             
         self.set_switch('A', 0)  
         self.set_switch('B', 0)    
@@ -29,10 +25,8 @@ class RFSwitch():
             status: Com to 1 = 0, Com to 2 = 1        
         '''  
         try: 
-            self.tn.write(bytes(f"SET{switch}={status}\n",'ascii'))     
-            data = self.tn.read_until(b'\n', timeout = 2).decode('ascii')   # read until carriage return
+            data = self.session.query(f"SET{switch}={status}", timeout=2)   # read until carriage return
             return data
             
         except Exception as e:
             print(f"RF Switch set failed on {self.host}: {e}")
-        
\ No newline at end of file
@@ -0,0 +1,85 @@
+'''PyNMR, stand-in soft IOC serving the EPICS channels of a config file on this machine, so EPICS monitoring, beam
+current integration and event writes can be tried without the hall IOCs. Read channels wander around their
+starting values, and the beam current channel switches between beam on and off. Timestamps can be skewed from
+this machine's clock, as a hall IOC's may be. Needs caproto. Run from the top directory:
+    python -m app.soft_ioc -c pynmr_config.yaml [-u update_s] [-b beam_nA] [-s switch_s] [-k skew_s]
+then start PyNMR with EPICS_CA_ADDR_LIST=127.0.0.1 and EPICS_CA_AUTO_ADDR_LIST=NO in its environment, and
+epics_settings enable true.
+'''
+import sys
+import time
+import random
+import getopt
+import asyncio
+import yaml
+from caproto import ChannelDouble
+from caproto.asyncio.server import start_server
+
+
+class SoftIOC():
+    '''Channels of config file and the task that updates them
+
+    Arguments:
+        config_dict: Dict of config file
+        update_time: Seconds between updates of read channels
+        beam: Beam current when on
+        switch_time: Seconds between switching beam on and off, or 0 to leave it on
+        skew: Seconds added to timestamps
+    '''
+    def __init__(self, config_dict, update_time=0.5, beam=100, switch_time=60, skew=0):
+        self.update_time = update_time
+        self.beam = beam
+        self.switch_time = switch_time
+        self.skew = skew
+        self.beam_pv = config_dict['settings']['epics_settings']['beam_current']
+        self.reads = {name:ChannelDouble(value=random.uniform(1, 10), precision=4) for name in config_dict['epics_reads']}
+        self.writes = {name:ChannelDouble(value=0, precision=6) for name in config_dict['epics_writes']}
+        self.pvdb = {**self.reads, **self.writes}
+
+    async def update(self):
+        '''Wander read channels, switch beam current on and off'''
+        while True:
+            await asyncio.sleep(self.update_time)
+            now = time.time()
+            on = not self.switch_time or int(now//self.switch_time) % 2
+            for name, channel in self.reads.items():
+                if name == self.beam_pv:
+                    value = self.beam*(1 + random.gauss(0, 0.01)) if on else 0
+                else:
+                    value = channel.value*(1 + random.gauss(0, 0.001))
+                await channel.write(value, timestamp=now + self.skew)
+
+    async def run(self):
+        print(f"Serving {len(self.reads)} read and {len(self.writes)} write channels.")
+        await asyncio.gather(start_server(self.pvdb, interfaces=['127.0.0.1']), self.update())
+
+
+def main():
+    config_file = 'pynmr_config.yaml'
+    update_time, beam, switch_time, skew = 0.5, 100, 60, 0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:u:b:s:k:")
+    except getopt.GetoptError:
+        print('Usage: python -m app.soft_ioc [-c <config_file>] [-u <update_s>] [-b <beam_nA>] [-s <switch_s>] [-k <skew_s>]')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print('Usage: python -m app.soft_ioc [-c <config_file>] [-u <update_s>] [-b <beam_nA>] [-s <switch_s>] [-k <skew_s>]')
+            sys.exit()
+        elif opt == '-c':
+            config_file = arg
+        elif opt == '-u':
+            update_time = float(arg)
+        elif opt == '-b':
+            beam = float(arg)
+        elif opt == '-s':
+            switch_time = float(arg)
+        elif opt == '-k':
+            skew = float(arg)
+    with open(config_file) as f:
+        config_dict = yaml.load(f, Loader=yaml.FullLoader)
+    asyncio.run(SoftIOC(config_dict, update_time, beam, switch_time, skew).run())
+
+
+if __name__ == '__main__':
+    main()
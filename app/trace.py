@@ -0,0 +1,105 @@
+'''PyNMR, J.Maxwell 2020
+'''
+import os
+import time
+import json
+import threading
+from collections import deque
+from contextlib import contextmanager
+from PyQt5.QtCore import QThread
+
+
+class Tracer():
+    '''Records timestamped spans across threads, written out as Chrome trace-event JSON. Spans older
+    than the window are dropped. Does nothing until enabled by configure.
+    
+    Attributes:
+        enable: Record spans if true
+        window: Seconds of recent spans to keep
+        file: Filename to write trace to
+        events: Deque of trace-event dicts
+        threads: Dict of thread names keyed on trace thread id, for trace metadata
+    '''
+    def __init__(self):
+        self.enable = False
+        self.window = 60
+        self.file = 'trace.json'
+        self.events = deque()
+        self.threads = {}
+        self.local = threading.local()      # trace thread id, as OS thread ids are reused by new QThreads
+        self.thread_count = 0
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        
+    def configure(self, settings):
+        '''Set up from trace settings dict of config file, keys enable, window and file'''
+        self.enable = settings['enable']
+        self.window = settings['window']
+        self.file = settings['file']
+        
+    def now(self):
+        '''Current time in microseconds, as the trace format uses'''
+        return time.perf_counter_ns()/1000
+        
+    def add(self, event):
+        '''Add trace-event dict, tagging with process and thread, and drop those older than window'''
+        with self.lock:
+            if not hasattr(self.local, 'tid'):
+                self.thread_count += 1
+                self.local.tid = self.thread_count
+            if self.local.tid not in self.threads:
+                thread = QThread.currentThread()        # name Qt threads by class, ie RunThread
+                name = type(thread).__name__ if type(thread) is not QThread else threading.current_thread().name
+                self.threads[self.local.tid] = f'{name}-{self.local.tid}'
+            event.update({'pid':self.pid, 'tid':self.local.tid})
+            self.events.append(event)
+            while self.events and self.events[0]['ts'] < event['ts'] - self.window*1e6:
+                self.events.popleft()
+        
+    @contextmanager
+    def span(self, name, cat='pynmr', **args):
+        '''Record the enclosed block as a complete span
+        
+        Arguments:
+            name: Name of span
+            cat: Category string, for filtering in trace viewer
+            args: Extra values to show with the span
+        '''
+        if not self.enable:
+            yield
+            return
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add({'name':name, 'cat':cat, 'ph':'X', 'ts':start, 'dur':self.now() - start, 'args':args})
+            
+    def flow(self, name, id, start=True):
+        '''Mark one end of an arrow between threads, such as a signal emitted in one thread and received in another
+        
+        Arguments:
+            name: Name of flow, same at both ends
+            id: Int identifying this flow, same at both ends
+            start: True at the sending end, False at the receiving end
+        '''
+        if self.enable:
+            self.add({'name':name, 'cat':'flow', 'ph':'s' if start else 'f', 'bp':'e', 'id':id, 'ts':self.now()})
+            
+    def dump(self, filename=None):
+        '''Write recorded spans to file as Chrome trace-event JSON'''
+        if not self.enable:
+            return
+        with self.lock:
+            events = list(self.events)
+            tids = {e['tid'] for e in events}
+            self.threads = {k:v for k,v in self.threads.items() if k in tids}     # forget threads with no spans left
+            threads = dict(self.threads)
+        meta = [{'name':'thread_name', 'ph':'M', 'pid':self.pid, 'tid':tid, 'args':{'name':name}} for tid, name in threads.items()]
+        try:
+            with open(filename or self.file, 'w') as file:
+                json.dump({'traceEvents':meta + events, 'displayTimeUnit':'ms'}, file)
+        except Exception as e:
+            print('Failed to write trace:', e)
+            
+            
+tracer = Tracer()       # shared by all threads, configured by main window from settings
@@ -0,0 +1,151 @@
+'''PyNMR, J.Maxwell 2020
+'''
+import time
+import math
+import numpy as np
+
+GOLDEN = (math.sqrt(5) - 1)/2       # golden section ratio
+CHANNELS = {2: 'diode', 1: 'phase'}  # DAC channels in order tuned
+
+
+def tune_scores(phase, diode):
+    '''Figures of merit of averaged tune curves. Diode should show a deep dip centered in the sweep, phase should be flat.
+
+    Arguments:
+        phase: Array of phase curve points
+        diode: Array of diode curve points
+
+    Returns:
+        Dict of depth (of diode minimum below mean of its ends), symmetry (rms difference of diode from its mirror
+        image over its peak to peak, 0 for symmetric) and flatness (phase rms about its mean)
+    '''
+    diode = np.asarray(diode)
+    phase = np.asarray(phase)
+    ends = max(len(diode)//20, 1)
+    depth = (diode[:ends].mean() + diode[-ends:].mean())/2 - diode.min()
+    symmetry = np.sqrt(np.mean((diode - diode[::-1])**2))/(np.ptp(diode) or 1)
+    flatness = phase.std()
+    return {'depth': float(depth), 'symmetry': float(symmetry), 'flatness': float(flatness)}
+
+
+def tune_cost(dac_c, scores, max_depth=0, depth_weight=0):
+    '''Cost to minimize for DAC channel. For diode, symmetry less weighted depth as a fraction of the deepest dip
+    seen, as a curve with no dip is symmetric too. For phase, flatness.
+
+    Arguments:
+        dac_c: DAC channel
+        scores: Dict from tune_scores
+        max_depth: Deepest diode dip seen so far in the search
+        depth_weight: Weight of normalized depth against symmetry
+    '''
+    if CHANNELS[dac_c] != 'diode':
+        return scores['flatness']
+    return scores['symmetry'] - depth_weight*(scores['depth']/max_depth if max_depth > 0 else 0)
+
+
+class TuneOptimizer():
+    '''Finds diode then phase DAC settings automatically over one tune mode DAQ connection. For each channel, tries a
+    coarse grid over the full range, then golden section searches between the neighbours of the best grid point. Each
+    setting is scored from tune chunks averaged after one is discarded while the DAC settles, diode settings on both
+    the symmetry and depth of the dip, depth relative to the deepest seen in the search. Stops when each bracket
+    is narrower than the tolerance, or when the time budget runs out, leaving the best setting found.
+
+    Arguments:
+        daq: DAQConnection in tune mode, kept open for the whole search
+        config: Config object with settings
+        report: Function called with each chunk taken, for plotting, or None
+        abort: Function returning true to stop early, or None
+
+    Attributes:
+        best: Dict of best DAC value keyed on channel
+        history: List of (dac_c, dac_v, scores) of each setting tried
+    '''
+    def __init__(self, daq, config, report=None, abort=None):
+        self.daq = daq
+        self.config = config
+        self.settings = config.settings['auto_tune']
+        self.report = report
+        self.abort = abort
+        self.best = {}
+        self.history = []
+        self.deadline = 0
+
+    def out_of_time(self):
+        return time.monotonic() > self.deadline or (self.abort is not None and self.abort())
+
+    def chunk(self):
+        '''Take one tune chunk, waiting for all sweeps if DAQ returns partial chunks'''
+        self.daq.start_sweeps()
+        new_sigs = self.daq.get_chunk()
+        while new_sigs[1] < self.config.settings['tune_per_chunk']:   # for NIDAQ, we need to wait for all the sweeps
+            new_sigs = self.daq.get_chunk()
+        if self.report is not None:
+            self.report(new_sigs)
+        return new_sigs
+
+    def measure(self, dac_c, dac_v):
+        '''Set DAC, then average chunks and score them
+
+        Returns:
+            Dict of scores at this setting
+        '''
+        self.daq.set_dac(dac_v, dac_c)
+        self.chunk()                        # settling
+        chunks = [self.chunk() for i in range(self.settings['chunks'])]
+        num = sum(c[1] for c in chunks)
+        phase = sum(c[2]*c[1] for c in chunks)/num
+        diode = sum(c[3]*c[1] for c in chunks)/num
+        scores = tune_scores(phase, diode)
+        self.history.append((dac_c, dac_v, scores))
+        return scores
+
+    def search(self, dac_c):
+        '''Grid then golden section search of one DAC channel
+
+        Returns:
+            Best DAC value found
+        '''
+        tried = {}          # scores keyed on DAC value
+        def cost(v):
+            if v not in tried:
+                tried[v] = self.measure(dac_c, v)
+            max_depth = max(t['depth'] for t in tried.values())
+            return tune_cost(dac_c, tried[v], max_depth, self.settings['depth_weight'])
+
+        grid = np.linspace(0, 1, self.settings['grid'])
+        for v in grid:
+            if self.out_of_time():
+                break
+            cost(float(v))
+        if not tried:
+            return None
+        i = int(np.argmin([cost(float(v)) if float(v) in tried else np.inf for v in grid]))
+        lo, hi = float(grid[max(i-1, 0)]), float(grid[min(i+1, len(grid)-1)])
+        a, b = hi - GOLDEN*(hi - lo), lo + GOLDEN*(hi - lo)
+        while hi - lo > self.settings['tolerance'] and not self.out_of_time():
+            if cost(a) < cost(b):
+                hi, b = b, a
+                a = hi - GOLDEN*(hi - lo)
+            else:
+                lo, a = a, b
+                b = lo + GOLDEN*(hi - lo)
+        return min(tried, key=cost)
+
+    def run(self):
+        '''Tune each channel in turn, splitting what is left of the time budget between channels still to tune. Leaves
+        each DAC at its best value.
+
+        Returns:
+            Dict of best DAC value keyed on channel, missing channels not tried
+        '''
+        start = time.monotonic()
+        budget = self.settings['time_budget']
+        for n, dac_c in enumerate(CHANNELS):
+            left = budget - (time.monotonic() - start)
+            self.deadline = time.monotonic() + left/(len(CHANNELS) - n)
+            best = self.search(dac_c)
+            if best is None:
+                break
+            self.best[dac_c] = best
+            self.daq.set_dac(best, dac_c)
+        return self.best
@@ -0,0 +1,70 @@
+'''PyNMR, check of automatic tune against the Test DAQ. Its tune mode diode dip fades and moves off center as the
+diode DAC moves from TEST_TUNE, leaving the recorded diode curve, so a search scoring symmetry alone can settle on a
+detuned setting with no dip. Runs the optimizer, then checks the diode dip at the best setting found is at least
+half as deep as at TEST_TUNE. Run from the top directory:
+    python -m app.tune_check -c pynmr_config.yaml [-b time_budget_s]
+Exits with status 1 if the check fails.
+'''
+import sys
+import getopt
+import yaml
+
+from app.classes import Config
+from app.daq import DAQConnection, TEST_TUNE
+from app.tune import TuneOptimizer, tune_scores
+
+
+def check(config_file, time_budget=20):
+    '''Run optimizer on Test DAQ and compare dip at best diode setting to dip at TEST_TUNE
+
+    Returns:
+        List of failure messages, empty if passed
+    '''
+    with open(config_file) as f:
+        config_dict = yaml.load(f, Loader=yaml.FullLoader)
+    settings = dict(config_dict['settings'], daq_type='Test')
+    settings['auto_tune'] = dict(settings['auto_tune'], time_budget=time_budget)
+    config = Config(config_dict['channels'][settings['default_channel']], settings)
+    daq = DAQConnection(config, 1, True)
+    optimizer = TuneOptimizer(daq, config)
+    best = optimizer.run()
+    if 2 not in best:
+        return ['No diode DAC setting found']
+
+    def depth(dac_v):
+        daq.set_dac(dac_v, 2)
+        optimizer.chunk()                       # settling
+        c = optimizer.chunk()
+        return tune_scores(c[2], c[3])['depth']
+
+    found, target = depth(best[2]), depth(TEST_TUNE[2])
+    daq.set_dac(best[2], 2)
+    print(f"Diode DAC {best[2]:.3f} dip {found:.4f}, at {TEST_TUNE[2]} dip {target:.4f}, {len(optimizer.history)} settings tried")
+    if found < 0.5*target:
+        return [f"Diode DAC {best[2]:.3f} has dip {found:.4f}, under half the {target:.4f} at {TEST_TUNE[2]}"]
+    return []
+
+
+def main():
+    config_file = 'pynmr_config.yaml'
+    time_budget = 20
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:b:")
+    except getopt.GetoptError:
+        print('Usage: python -m app.tune_check [-c <config_file>] [-b <time_budget_s>]')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print('Usage: python -m app.tune_check [-c <config_file>] [-b <time_budget_s>]')
+            sys.exit()
+        elif opt == '-c':
+            config_file = arg
+        elif opt == '-b':
+            time_budget = float(arg)
+    failures = check(config_file, time_budget)
+    print('\n'.join(failures) if failures else 'Tune check passed.')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
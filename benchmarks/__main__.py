@@ -0,0 +1,40 @@
+'''PyNMR, benchmark suite. Run from the top directory:
+    python -m benchmarks -o results.json                  run all, save results
+    python -m benchmarks -k analysis -k DFits             run only benchmarks with names containing these
+    python -m benchmarks -c old.json -o new.json          run and compare to previous results
+    python -m benchmarks -c old.json new.json             compare two results files without running
+Exits with status 1 if any median is slower than the reference by more than the threshold.
+'''
+import sys
+import argparse
+
+from benchmarks import harness
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='PyNMR benchmarks')
+    parser.add_argument('results', nargs='?', help='results file to compare instead of running')
+    parser.add_argument('-k', dest='names', action='append', help='run only benchmarks with names containing this')
+    parser.add_argument('-o', '--output', help='write results JSON to this file')
+    parser.add_argument('-c', '--compare', help='reference results JSON to compare against')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2, help='fractional slowdown counted as regression (default 0.2)')
+    parser.add_argument('-r', '--rounds', type=int, default=5, help='timed rounds per benchmark (default 5)')
+    args = parser.parse_args()
+
+    if args.results:
+        new = harness.load(args.results)
+    else:
+        from benchmarks import bench_acquisition, bench_analysis, bench_circuit_base, bench_files, bench_shims, bench_startup     # register benchmarks
+        new = harness.run(args.names, args.rounds)
+        if args.output:
+            harness.save(new, args.output)
+    if args.compare:
+        lines, regressed = harness.compare(harness.load(args.compare), new, args.threshold)
+        print('\n'.join(lines))
+        if regressed:
+            print(f'{len(regressed)} regressions over {args.threshold:.0%}: {", ".join(regressed)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+'''PyNMR, benchmarks of receiving and averaging sweeps: TCP chunk decoding, Scan and RunningScan averaging
+'''
+from benchmarks.harness import bench
+from benchmarks import inputs
+from app.classes import Scan, RunningScan
+from app.daq import TCP
+
+
+class Socket():
+    '''Replays recorded packets in place of the FPGA socket'''
+    def __init__(self, packets):
+        self.packets = packets
+        self.i = 0
+
+    def recv(self, size):
+        packet = self.packets[self.i % len(self.packets)]
+        self.i += 1
+        return packet
+
+    def close(self):
+        pass
+
+
+@bench('acquisition.TCP.get_chunk', number=5)
+def get_chunk():
+    window = inputs.Window()
+    fpga = window.settings['fpga_settings']
+    tcp = TCP.__new__(TCP)              # decoding only, no connection
+    tcp.s = Socket(inputs.chunk_packets(window.settings['steps'], window.settings['num_per_chunk'], fpga['tcp_buffer']))
+    tcp.buffer_size = fpga['tcp_buffer']
+    tcp.freq_num = window.settings['steps']
+    tcp.phase_cal = fpga['phase_cal']
+    tcp.diode_cal = fpga['diode_cal']
+    tcp.adc_one, tcp.adc_two = 'phase', 'diode'
+    return tcp.get_chunk
+
+
+@bench('acquisition.Scan.avg_chunks', number=1)
+def avg_chunks():
+    window = inputs.Window()
+    new_sigs = inputs.chunks(100)
+    def run():
+        scan = Scan(window.config)
+        for sigs in new_sigs:
+            scan.avg_chunks(sigs)
+    return run
+
+
+@bench('acquisition.RunningScan.running_avg', number=1)
+def running_avg():
+    window = inputs.Window()
+    new_sigs = inputs.chunks(100, num_in_chunk=32)
+    def run():
+        scan = RunningScan(window.config, 640)
+        for sigs in new_sigs:
+            scan.running_avg(sigs)
+    return run
+
+
+@bench('acquisition.RunningScan.running_avg_stats', number=1)
+def running_avg_stats():
+    window = inputs.Window()
+    new_sigs = inputs.chunks(100, num_in_chunk=32)
+    def run():
+        scan = RunningScan(window.config, 640, stats=True)
+        for sigs in new_sigs:
+            scan.running_avg(sigs)
+    return run
@@ -0,0 +1,39 @@
+'''PyNMR, benchmarks of each analysis option's result method, and of Deuteron fits on their own
+'''
+from benchmarks.harness import bench
+from benchmarks import inputs
+from app.gui_anal_tab import AnalTab
+from app.deuteron_fits import DFits
+
+SLOW = ['FitDeuteron', 'CircuitBase', 'FitPeakRes', 'FitPeakRes2', 'PolyFitBase', 'PolyFitSub']     # fewer calls per round
+
+
+def analysis_tab():
+    '''Analysis tab around the recorded event'''
+    window = inputs.Window()
+    tab = AnalTab(window)       # built around the empty event, so no analysis thread starts
+    return tab, inputs.make_event(window)
+
+
+def register(step, i, cls):
+    '''Register benchmark of the result method of option i in the given step list of AnalTab'''
+    def setup():
+        tab, event = analysis_tab()
+        option = getattr(tab, f'{step}_opts')[i]
+        return lambda: option.result(event)
+    bench(f'analysis.{cls}', number=1 if cls in SLOW else 20)(setup)
+
+
+for step, classes in {'base':['StandardBase', 'PolyFitBase', 'NoBase', 'CircuitBase'],
+                      'sub':['PolyFitSub', 'NoFitSub'],
+                      'res':['SumAllRes', 'SumRangeRes', 'PeakHeightRes', 'FitPeakRes', 'FitPeakRes2', 'FitDeuteron']}.items():
+    for i, cls in enumerate(classes):
+        register(step, i, cls)
+
+
+@bench('analysis.DFits', number=1)
+def dfits():
+    window = inputs.Window()
+    event = inputs.make_event(window)
+    p = window.settings['analysis']['d_fit_params']
+    return lambda: DFits(event.scan.freq_list, event.fitsub, p)
@@ -0,0 +1,64 @@
+'''PyNMR, benchmarks of circuit model baseline fit on a synthetic Q-curve, and of the Q-curve it fits
+'''
+import os
+import numpy as np
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')     # CircuitBase is a QWidget, but the fit needs no display
+
+from benchmarks.harness import bench
+from app.gui_anal_tab import CircuitBase
+
+
+class FakeScan():
+    '''Just what CircuitBase.result needs from an Event'''
+    def __init__(self, freqs, phase):
+        self.freq_list = freqs
+        self.phase = phase
+
+
+class FakeEvent():
+    def __init__(self, freqs, phase):
+        self.scan = FakeScan(freqs, phase)
+
+
+class FakeLabel():
+    def setText(self, text): pass
+
+
+def make_base():
+    '''CircuitBase without the tab around it'''
+    base = CircuitBase.__new__(CircuitBase)
+    base.wings = [0.01, 0.30, 0.70, 0.99]
+    base.lower = np.array([1.0, -180, 1.0, -10, 4.99])
+    base.upper = np.array([60, 180, 120, 10, 5.001])
+    base.pi = np.array([18.62, -140, 30, 0.19, 5])
+    base.message = FakeLabel()
+    return base
+
+
+def make_event(base):
+    '''Event with Q-curve off from the initial parameters, plus noise'''
+    freqs = np.linspace(212.682, 213.082, 512)
+    rng = np.random.default_rng(0)
+    phase = base.real_curve(freqs, 18.4, -120, 30.5, 0.3, 5.0) + rng.normal(0, 1e-5, len(freqs))
+    return FakeEvent(freqs, phase)
+
+
+@bench('circuit_base.q_curve_per_point', number=20)
+def q_curve_per_point():
+    base = make_base()
+    freqs = make_event(base).scan.freq_list
+    return lambda: [-np.real(base.full_curve(f, 18.62, -140, 30)) for f in freqs]
+
+
+@bench('circuit_base.q_curve', number=200)
+def q_curve():
+    base = make_base()
+    freqs = make_event(base).scan.freq_list
+    return lambda: base.real_curve(freqs, 18.62, -140, 30)
+
+
+@bench('circuit_base.fit', number=20)
+def fit():
+    base = make_base()
+    event = make_event(base)
+    return lambda: base.result(event)
@@ -0,0 +1,81 @@
+'''PyNMR, benchmarks of writing and reading events and history: print_event, restore_history and to_plot,
+explorer tab loading and combiner averaging. Files are written to a temporary directory.
+'''
+import os
+import io
+import json
+import sys
+import atexit
+import shutil
+import tempfile
+import datetime
+import subprocess
+from types import SimpleNamespace
+
+from benchmarks.harness import bench
+from benchmarks import inputs
+from app.classes import History, HistPoint
+from app.gui import MainWindow
+from app.gui_expl_tab import ExplTab
+
+tmp = tempfile.mkdtemp(prefix='pynmr_bench_')
+atexit.register(shutil.rmtree, tmp, ignore_errors=True)
+STOP = datetime.datetime(2024, 1, 1, 12, 0, 0)      # last synthetic event
+
+
+@bench('files.Event.print_event', number=20)
+def print_event():
+    window = inputs.Window()
+    event = inputs.make_event(window)
+    def run():
+        event.print_event(io.StringIO())
+    return run
+
+
+@bench('files.restore_history', number=1)
+def restore_history():
+    dir = os.path.join(tmp, 'history')
+    os.makedirs(os.path.join(dir, 'app'), exist_ok=True)
+    with open(os.path.join(dir, 'app', 'bench_history.json'), 'w') as f:
+        f.write('\n'.join(inputs.history_lines(10000, STOP)) + '\n')
+    window = SimpleNamespace(config_dict={'settings':{'history_file':'bench_history'}})
+    def run():
+        cwd = os.getcwd()
+        os.chdir(dir)           # history file is opened relative to the app directory
+        try:
+            MainWindow.restore_history(window)
+        finally:
+            window.hist_file.close()
+            os.chdir(cwd)
+    return run
+
+
+@bench('files.History.to_plot', number=20)
+def to_plot():
+    history = History()
+    for line in inputs.history_lines(10000, STOP):
+        history.res_hist(HistPoint(json.loads(line)))
+    stop = STOP.replace(tzinfo=datetime.timezone.utc).timestamp()
+    return lambda: history.to_plot(stop - 3600*24, stop)
+
+
+@bench('files.ExplTab.range_changed', number=1)
+def range_changed():
+    dir = os.path.join(tmp, 'events')
+    os.makedirs(dir, exist_ok=True)
+    inputs.write_eventfiles(dir, 4, 100, STOP)
+    time = lambda dt: SimpleNamespace(dateTime=lambda: SimpleNamespace(toPyDateTime=lambda: dt))
+    var_list = SimpleNamespace(clear=lambda: None, addItems=lambda items: None)
+    tab = SimpleNamespace(start_dedit=time(STOP - datetime.timedelta(hours=12)), end_dedit=time(STOP + datetime.timedelta(hours=1)),
+                          config_dict={'settings':{'event_dir':dir}}, event_vars_included=['pol', 'cc', 'area'], var_list=var_list)
+    return lambda: ExplTab.range_changed(tab)
+
+
+@bench('files.combiner', number=1)
+def combiner():
+    dir = os.path.join(tmp, 'combine')
+    os.makedirs(dir, exist_ok=True)
+    inputs.write_eventfiles(dir, 4, 100, STOP)
+    begin, end = STOP - datetime.timedelta(hours=12), STOP + datetime.timedelta(hours=1)
+    command = [sys.executable, os.path.join(inputs.ROOT, 'combiner', 'combiner.py'), '-d', dir, '-b', str(begin), '-e', str(end)]
+    return lambda: subprocess.run(command, cwd=dir, check=True, capture_output=True)
@@ -0,0 +1,27 @@
+'''PyNMR, benchmarks of solving for shim currents against the CLAS12 background, for each goal the shim tab offers
+'''
+import numpy as np
+
+from benchmarks.harness import bench
+from app.gui_shim_tab import shim_response, solve_currents
+
+Z_AXIS = np.arange(-30,31)
+BACKGROUND = 0.1654*(1 - 4e-6*Z_AXIS**2)       # near the CLAS12 solenoid at 80 A, falling off from center
+
+
+def register(name, goals):
+    '''Register benchmark of solving for goals'''
+    def setup():
+        response = shim_response(Z_AXIS)
+        return lambda: solve_currents(response, BACKGROUND, goals)
+    bench(f'shims.{name}', number=200)(setup)
+
+
+register('Flatten', np.full(61, 0.1653))
+register('Tilt', Z_AXIS*5/(30*10000) + 0.166)
+register('Flatten_bounded', np.full(61, 0.2))       # needs more than the 10 A limit, so the bounded solver runs
+
+
+@bench('shims.response', number=200)
+def response():
+    return lambda: shim_response(Z_AXIS)
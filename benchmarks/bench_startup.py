@@ -0,0 +1,71 @@
+'''PyNMR, benchmarks of starting the display: importing the main window module and opening the main window in a
+fresh interpreter, as on a restart. Runs in a temporary working directory with copies of the session, history
+and baseline files, so nothing in the data directories is touched.
+'''
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+import subprocess
+import yaml
+
+from benchmarks.harness import bench
+from benchmarks import inputs
+
+CONFIG_FILE = 'pynmr_config.yaml'       # Test mode, so no DAQ is needed
+
+OPEN_WINDOW = '''
+import os
+from PyQt5.QtWidgets import QApplication
+from app.gui import MainWindow
+app = QApplication([])
+gui = MainWindow({config!r})
+gui.show()
+app.processEvents()
+os._exit(0)
+'''
+
+
+def workdir():
+    '''Temporary working directory with the files MainWindow opens relative to it
+
+    Returns:
+        Directory name
+    '''
+    dir = tempfile.mkdtemp(prefix='pynmr_bench_')
+    atexit.register(shutil.rmtree, dir, ignore_errors=True)
+    config = os.path.join(inputs.ROOT, CONFIG_FILE)
+    with open(config) as f:
+        settings = yaml.load(f, Loader=yaml.FullLoader)['settings']
+    for d in [settings['event_dir'], settings['log_dir'], 'app']:
+        os.makedirs(os.path.join(dir, d), exist_ok=True)
+    shutil.copy(config, dir)
+    for name in [f"{settings['session_file']}.yaml", f"{settings['history_file']}.json", os.path.basename(settings['test_signal'])]:
+        shutil.copy(os.path.join(inputs.ROOT, 'app', name), os.path.join(dir, 'app'))
+    shutil.copy(os.path.join(inputs.ROOT, settings['event_dir'], 'recent_baselines.txt'), os.path.join(dir, settings['event_dir']))
+    return dir
+
+
+def python(code, cwd):
+    '''Callable running code in a fresh interpreter, with the repository importable'''
+    env = dict(os.environ, PYTHONPATH=inputs.ROOT, QT_QPA_PLATFORM='offscreen')
+    def run():
+        subprocess.run([sys.executable, '-c', code], cwd=cwd, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return run
+
+
+@bench('startup.interpreter', number=1)
+def interpreter():
+    '''Bare interpreter start, to subtract from the others'''
+    return python('pass', inputs.ROOT)
+
+
+@bench('startup.import_gui', number=1)
+def import_gui():
+    return python('import app.gui', inputs.ROOT)
+
+
+@bench('startup.MainWindow', number=1)
+def main_window():
+    return python(OPEN_WINDOW.format(config=CONFIG_FILE), workdir())
@@ -0,0 +1,112 @@
+'''PyNMR, benchmark registry, timing and comparison of results between commits
+'''
+import sys
+import time
+import json
+import platform
+import datetime
+import subprocess
+import statistics
+import numpy as np
+
+BENCHES = {}        # dict of (setup function, number of calls per round) keyed on benchmark name
+
+
+def bench(name, number=10):
+    '''Register a benchmark. The decorated function does any untimed setup and returns the callable to time.
+
+    Arguments:
+        name: Benchmark name, dotted by area ie 'analysis.SumRangeRes'
+        number: Calls to make in each timed round
+    '''
+    def register(setup):
+        BENCHES[name] = (setup, number)
+        return setup
+    return register
+
+
+def measure(func, number, rounds):
+    '''Time func, returning list of mean seconds per call for each round'''
+    func()                  # warm up caches and lazy imports
+    times = []
+    for r in range(rounds):
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        times.append((time.perf_counter() - start)/number)
+    return times
+
+
+def run(names=None, rounds=5):
+    '''Run registered benchmarks
+
+    Arguments:
+        names: List of substrings, running only benchmarks containing one of them. All if None.
+        rounds: Timed rounds for each benchmark
+
+    Returns:
+        Dict of metadata and results keyed on benchmark name, each with median, min and max seconds per call
+    '''
+    results = {}
+    for name, (setup, number) in sorted(BENCHES.items()):
+        if names and not any(n in name for n in names):
+            continue
+        try:
+            times = measure(setup(), number, rounds)
+        except Exception as e:
+            print(f'{name:40} failed: {e}', file=sys.stderr)
+            continue
+        results[name] = {'median':statistics.median(times), 'min':min(times), 'max':max(times), 'number':number, 'rounds':rounds}
+        print(f'{name:40} {results[name]["median"]*1e3:10.3f} ms', file=sys.stderr)
+    return {'meta':metadata(), 'results':results}
+
+
+def metadata():
+    '''Commit and environment, so results files say what they measured'''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except Exception:
+        commit = ''
+    return {'commit':commit, 'date':datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+            'python':platform.python_version(), 'numpy':np.__version__, 'machine':platform.platform()}
+
+
+def compare(old, new, threshold=0.2):
+    '''Compare medians of two results dicts
+
+    Arguments:
+        old: Results dict from run, the reference
+        new: Results dict from run, being checked
+        threshold: Fractional slowdown of median counted as a regression
+
+    Returns:
+        List of lines of comparison table, list of names of regressed benchmarks
+    '''
+    lines = [f'{"benchmark":40} {"old ms":>10} {"new ms":>10} {"ratio":>7}']
+    regressed = []
+    for name in sorted(set(old['results']) | set(new['results'])):
+        if name not in old['results'] or name not in new['results']:
+            lines.append(f'{name:40} {"only in " + ("new" if name in new["results"] else "old"):>29}')
+            continue
+        o, n = old['results'][name]['median'], new['results'][name]['median']
+        ratio = n/o if o > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressed.append(name)
+        elif ratio < 1/(1 + threshold):
+            flag = '  faster'
+        lines.append(f'{name:40} {o*1e3:10.3f} {n*1e3:10.3f} {ratio:7.2f}{flag}')
+    return lines, regressed
+
+
+def load(filename):
+    '''Read results file written by save'''
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save(results, filename):
+    '''Write results dict as JSON'''
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=1)
@@ -0,0 +1,159 @@
+'''PyNMR, reproducible inputs for benchmarks: the recorded deuteron event from test mode, and synthetic
+chunks, eventfiles and histories built from it with seeded noise.
+'''
+import os
+import json
+import datetime
+import numpy as np
+import yaml
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')     # tabs are QWidgets, but benchmarks need no display
+from PyQt5.QtWidgets import QApplication, QWidget
+
+from app.classes import Config, Event, StageTimings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_FILE = os.path.join(ROOT, 'pynmr_config_deuteron.yaml')
+RECORDED_EVENT = os.path.join(ROOT, 'app', 'd_signal_event.txt')
+SEED = 1234
+
+qapp = QApplication.instance() or QApplication([])
+
+
+def recorded_event():
+    '''Dict of recorded eventfile line'''
+    with open(RECORDED_EVENT) as f:
+        return json.loads(f.readline())
+
+
+def load_config():
+    '''Dict of deuteron config file'''
+    with open(CONFIG_FILE) as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+
+class Window(QWidget):
+    '''Just what tabs and events need from MainWindow'''
+    def __init__(self):
+        super().__init__()
+        self.config_dict = load_config()
+        self.settings = self.config_dict['settings']
+        channel = recorded_event()['channel']       # channel the recorded event was taken on
+        self.config = Config(channel, self.settings)
+        self.settings['analysis']['d_fit_params']['wL'] = channel['cent_freq']      # start Deuteron fits at its Larmor frequency
+        self.timings = StageTimings()
+        self.chassis_temp = 0
+        self.shimA, self.shimB, self.shimC, self.shimD = 0, 0, 0, 0
+        self.event = Event(self)
+        self.previous_event = self.event
+
+    def epics_update(self, event):
+        event.epics = {k:0 for k in self.config_dict['epics_reads']}
+
+    def end_finished(self):
+        pass
+
+
+def make_event(window):
+    '''Event filled with the recorded signal and analysis, as at the end of a run'''
+    rec = recorded_event()
+    event = Event(window)
+    event.scan.num = rec['sweeps']
+    event.scan.phase = np.array(rec['phase'])
+    event.scan.diode = np.array(rec['diode'])
+    event.scan.freq_list = np.array(rec['freq_list'])
+    event.baseline = np.array(rec['baseline'])
+    event.basesweep = np.array(rec['basesweep'])
+    event.basesub = np.array(rec['basesub'])
+    event.fitcurve = np.array(rec['fitcurve'])
+    event.fitsub = np.array(rec['fitsub'])
+    event.rescurve = np.zeros(len(event.fitsub))
+    event.area, event.pol = rec['area'], rec['pol']
+    event.stop_time = datetime.datetime.now(tz=datetime.timezone.utc)
+    event.stop_stamp = event.stop_time.timestamp()
+    event.epics = rec['epics_reads']
+    event.uwave_freq = 0
+    event.beam_current_sum, event.beam_time_sum = 0, 0
+    return event
+
+
+def chunk_packets(steps=512, num_in_chunk=64, buffer_size=1460, chunk_num=0):
+    '''TCP packets for one FPGA chunk, as TCP.get_chunk receives them: header, phase sums, bb marker, diode sums
+
+    Returns:
+        List of byte strings of at most buffer_size
+    '''
+    rng = np.random.default_rng(SEED)
+    rec = recorded_event()
+    phase = (np.array(rec['phase'])*211692085*num_in_chunk*2 + rng.normal(0, 1e4, steps)).astype(np.int64)
+    diode = (np.array(rec['diode'])*829421*num_in_chunk*2 + rng.normal(0, 1e2, steps)).astype(np.int64)
+    stream = b'\xff'*5 + chunk_num.to_bytes(2, 'little') + num_in_chunk.to_bytes(2, 'little')
+    stream += b''.join(int(v).to_bytes(5, 'little', signed=True) for v in phase)
+    stream += b'\xbb'
+    stream += b''.join(int(v).to_bytes(5, 'little', signed=True) for v in diode)
+    return [stream[i:i+buffer_size] for i in range(0, len(stream), buffer_size)]
+
+
+def chunks(n, steps=512, num_in_chunk=64):
+    '''List of n chunk tuples as RunThread emits them, with seeded noise on the recorded signal'''
+    rng = np.random.default_rng(SEED)
+    rec = recorded_event()
+    phase, diode = np.array(rec['phase']), np.array(rec['diode'])
+    return [(i, num_in_chunk, phase + rng.normal(0, 1e-4, steps), diode + rng.normal(0, 1e-4, steps)) for i in range(n)]
+
+
+def event_lines(n, stop, interval=60):
+    '''Eventfile lines from the recorded event with seeded noise, one per interval seconds ending at stop
+
+    Arguments:
+        n: Number of lines
+        stop: Datetime of last event
+        interval: Seconds between events
+    '''
+    rng = np.random.default_rng(SEED)
+    rec = recorded_event()
+    fitsub = np.array(rec['fitsub'])
+    lines = []
+    for i in range(n):
+        time = stop - datetime.timedelta(seconds=interval*(n - 1 - i))
+        rec['stop_time'] = time.strftime('%Y-%m-%d %H:%M:%S.%f+00:00')     # as str of UTC event stop_time
+        rec['stop_stamp'] = time.timestamp()
+        rec['fitsub'] = (fitsub + rng.normal(0, 1e-4, len(fitsub))).tolist()
+        rec['pol'] = rec['cc']*float(np.sum(rec['fitsub']))
+        lines.append(json.dumps(rec))
+    return lines
+
+
+def write_eventfiles(dir, files, per_file, stop):
+    '''Write eventfiles named as MainWindow names them, the last as the current file
+
+    Returns:
+        List of filenames written
+    '''
+    lines = event_lines(files*per_file, stop)
+    names = []
+    for i in range(files):
+        part = lines[i*per_file:(i+1)*per_file]
+        start = datetime.datetime.strptime(json.loads(part[0])['stop_time'][:26], '%Y-%m-%d %H:%M:%S.%f')
+        end = datetime.datetime.strptime(json.loads(part[-1])['stop_time'][:26], '%Y-%m-%d %H:%M:%S.%f')
+        if i == files - 1:
+            name = f'current_{start:%Y-%m-%d_%H-%M-%S}.txt'
+        else:
+            name = f'{start:%Y-%m-%d_%H-%M-%S}__{end:%Y-%m-%d_%H-%M-%S}.txt'
+        with open(os.path.join(dir, name), 'w') as f:
+            f.write('\n'.join(part) + '\n')
+        names.append(name)
+    return names
+
+
+def history_lines(n, stop, interval=60):
+    '''History file lines as History.add_hist writes them, recorded history repeated to n points ending at stop'''
+    with open(os.path.join(ROOT, 'app', 'history.json')) as f:
+        recorded = [json.loads(l) for l in f if l.strip()]
+    lines = []
+    for i in range(n):
+        entry = dict(recorded[i % len(recorded)])
+        time = stop - datetime.timedelta(seconds=interval*(n - 1 - i))
+        entry['dt'] = str(time)
+        entry['dt_stamp'] = time.timestamp()
+        lines.append(json.dumps(entry))
+    return lines
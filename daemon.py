@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+'''PyNMR, J.Maxwell 2020
+Headless acquisition daemon, and command line client for it.
+'''
+import sys
+import json
+import getopt
+import signal
+import yaml
+
+def main():
+    '''Run daemon, or send it a command with -s, or print its events with -w
+    '''
+    usage = 'Usage: daemon.py [-c <config_file>] [-s "<command>"] [-w]'
+    config_file = 'pynmr_config.yaml'
+    command = None
+    watch = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],"hc:s:w")
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ['-h',]:
+            print(usage)
+            sys.exit()
+        elif opt in ['-c',]:
+            config_file = arg
+        elif opt in ['-s',]:
+            command = arg
+        elif opt in ['-w',]:
+            watch = True
+
+    if command or watch:            # client
+        from app.daemon_client import DaemonClient
+        with open(config_file) as f:
+            port = yaml.load(f, Loader=yaml.FullLoader)['settings']['daemon']['port']
+        client = DaemonClient(port, timeout=None if watch else 5)
+        if command:
+            print(json.dumps(client.send(command), indent=1))
+        if watch:
+            client.send('subscribe')
+            try:
+                while True:
+                    event = client.read()['event']
+                    print(f"{event['stop_time']}  pol {event['pol']:.4f}  area {event['area']:.6f}  sweeps {event['sweeps']}  {event['label']}")
+            except (ConnectionError, KeyboardInterrupt) as e:
+                print(e)
+        client.close()
+    else:
+        from PyQt5.QtCore import QCoreApplication, QTimer
+        from app.daemon import Daemon
+        app = QCoreApplication([])
+        app.setApplicationName("JLab Polarization Daemon")
+        daemon = Daemon(config_file)
+        signal.signal(signal.SIGTERM, lambda *args: daemon.quit())     # stop cleanly under a process supervisor
+        signal.signal(signal.SIGINT, lambda *args: daemon.quit())
+        timer = QTimer()            # let python handle signals while in the Qt loop
+        timer.timeout.connect(lambda: None)
+        timer.start(500)
+        app.exec_()
+
+if __name__ == '__main__':
+    main()